@@ -10,25 +10,49 @@
 #-------------------------------------------------------------------------------
 
 import time # Import time module
-start = time.time()
-print("Start of script.\n")
 
 # Import all required modules
-import arcpy, os, sys
-from arcpy.sa import *
-import arcpy.mp as MAP
+# arcpy (and the modules that need it: ingest, cost_factors) is imported by the
+# stages that use it, see requireArcpy
+import os, sys
+import cost_engine, corridor_solver, corridor_bands, focal_engine, tiling, grid_stats, zonal_engine, factor_stack
+import vector_overlay
+import task_runner, raster_cache, pipeline, scenario_sweep, map_export
+import config
+import profiling
+import argparse
 
-# Set the overwrite outputs environment
-arcpy.env.overwriteOutput = True #allow overwriting files, default is False
+# arcpy module once it's imported
+arcpy = None
 
-# Check out the Spatial extension
-arcpy.CheckOutExtension("Spatial")
+# Extensions checked out by this process
+checked_out = set()
 
 
 #-------------------------------------------------------------------------------
 # Functions
 #-------------------------------------------------------------------------------
 
+# Function to import arcpy on first use and check out the Spatial extension for the
+# stages that need it (importing arcpy takes seconds and the licence server is shared)
+# spatial checks out the Spatial Analyst extension
+def requireArcpy(spatial=False):
+    global arcpy
+    if arcpy is None:
+        print("Importing arcpy...")
+        import arcpy as arcpy_module
+        arcpy = arcpy_module
+
+        # Set the overwrite outputs environment
+        arcpy.env.overwriteOutput = True #allow overwriting files, default is False
+
+    if spatial and "Spatial" not in checked_out:
+        # Check out the Spatial extension
+        arcpy.CheckOutExtension("Spatial")
+        checked_out.add("Spatial")
+    return arcpy
+
+
 # Function to print out the first and last message from a Function Tool
 def messages():
     print(arcpy.GetMessage(0)) # print first message of tool
@@ -96,14 +120,16 @@ def saveToGDB(in_path, out_path, out_cs):
 # in_feature is the input feature name
 # out_path is the desired output path
 # out_cs is the desired output coordinate system
-def checkCS_Vector(in_feature, out_path, out_cs):
+# sr is the spatial reference of in_feature if it was already described (optional)
+def checkCS_Vector(in_feature, out_path, out_cs, sr=None):
 
     # set name
     name = os.path.splitext(os.path.basename(in_feature))[0] #gets file name and remove extension
 
     print(f"Checking coordinate system for vector feature {name}...")
 
-    sr = arcpy.Describe(in_feature).spatialReference
+    if sr is None:
+        sr = arcpy.Describe(in_feature).spatialReference
 
     # Check Coordinate system
     if sr.name == out_cs.name:
@@ -124,514 +150,840 @@ def checkCS_Vector(in_feature, out_path, out_cs):
 
 
 #-------------------------------------------------------------------------------
-# Main script block
+# Stages
+# Each stage reads its settings from ctx (the run context) and returns a dictionary
+# of results for the later stages (see pipeline.py)
 #-------------------------------------------------------------------------------
 
-# Path to required data location
-root_path = r"C:\GEOS456\FinalProject"
-
-# Output geodatabase and path for final data
-out_gdb = "KananaskisWildlife.gdb" #required name
-out_path = os.path.join(root_path, out_gdb)
-
-# Scratch geodatabase and path for intermediate data
-scratch_gdb = "Scratch.gdb"
-scratch_path = os.path.join(root_path, scratch_gdb)
-
-datasets = ["BaseFeatures", "StudyArea"]
-datasets_path = [os.path.join(out_path, datasets[0]), os.path.join(out_path, datasets[1])]
-
-# Output coordinate system
-out_cs = arcpy.SpatialReference("NAD 1983 UTM Zone 11N")
+#-------------------------------------------------------------------------------
+# Data Conversion
+def conversionStage(ctx):
+    requireArcpy(spatial=True)
+    import ingest
+
+    root_path = ctx["root_path"]
+    out_path = ctx["out_path"]
+    out_gdb = ctx["out_gdb"]
+    out_cs = arcpy.SpatialReference(ctx["out_cs"])
+    cell = ctx["cell"]
+    study_area = ctx["study_area"]
+    cache_path = ctx["cache_path"]
+
+    # Original source file of each dataset (used for the cache keys)
+    source_files = {}
+
+    arcpy.env.workspace = root_path
+
+    # Create GDB and datasets (will check for and delete existing gdb if necessary)
+    # --resume keeps the gdb of the failed run and the datasets it finished
+    if pipeline.resuming(ctx) and arcpy.Exists(out_path):
+        print(f"Resuming, keeping {out_gdb}...")
+    else:
+        createGDBandDatasets(root_path, out_gdb, ctx["datasets"], out_cs) # gdb for final outputs
 
-# Raster cell size (required)
-cell = 25 # in meters
+    print(f"\n{'- - '*20}\n") # print separator line
 
-# Name of study area file
-study_area = "KCountry_Bound"
 
+    print("= = = Data Conversion = = =")
 
-#-------------------------------------------------------------------------------
-arcpy.env.workspace = root_path
+    # Find every dataset once (one walk of the source folder), study area first
+    # configs of a batch that share the source folder share the walk
+    shared = ctx.setdefault("shared", {})
+    if ("manifest", root_path) not in shared:
+        shared[("manifest", root_path)] = list(ingest.discoverDatasets(root_path, ctx["work_paths"]))
+    manifest = ingest.studyAreaFirst(shared[("manifest", root_path)], study_area)
 
-# Create GDB and datasets (will check for and delete existing gdb if necessary)
-createGDBandDatasets(root_path, out_gdb, datasets, out_cs) # gdb for final outputs
-createGDBandDatasets(root_path, scratch_gdb, "", out_cs) # gdb for intermediate data
+    # Project/Clip all data and store in gdb (From root folder to Scratch gdb to Output gdb)
+    for dataset in manifest:
+        source_files[dataset.name] = dataset.path
 
-print(f"\n{'- - '*20}\n") # print separator line
+        if pipeline.partDone(ctx, dataset.name):
+            print(f"{dataset.name} was saved by the failed run, skipping...\n")
+            if dataset.name == study_area:
+                study_area_path = os.path.join(out_path, study_area)
+            continue
 
+        # Get Study Area / Kananaskis boundary
+        if dataset.name == study_area:
+            print(f"Found shapefile: {dataset.path}\n")
 
-print("= = = Data Conversion = = =")
+            # check the coordinates system and save to final gdb
+            study_area_path = checkCS_Vector(dataset.path, out_path, out_cs, dataset.spatial_reference)
+            print(study_area_path, "\n")
 
-# Get Study Area / Kananaskis boundary
-for dirpath, _, filenames in arcpy.da.Walk(root_path, datatype="FeatureClass"):
-    for filename in filenames:
+        elif dataset.kind == "vector":
 
-        # Check if "KCountry_Bound" is in the filename (ignore file extension)
-        if "KCountry_Bound" in filename and filename.lower().endswith(".shp"):
-            file_path = os.path.join(dirpath, filename)
-            print(f"Found shapefile: {file_path}\n")
+            print(f"Processing Shapefile: {os.path.basename(dataset.path)}\n")
 
-            # check the coordinates system and save to final gdb
-            study_area_path = checkCS_Vector(file_path, out_path, out_cs)
-            print(study_area_path, "\n")
+            # project and clip to boundary in one pass, save to output gdb
+            # overlay_type numpy only clips the features that cross the boundary (see vector_overlay.py)
+            with profiling.timed(f"Ingest {dataset.name}"):
+                if ctx["overlay_type"] == "numpy":
+                    vector_overlay.ingestVectorIndexed(dataset, study_area_path, os.path.join(out_path, dataset.name), out_cs,
+                                                       os.path.join(ctx["tile_path"], "Overlay", dataset.name),
+                                                       ctx["factor_workers"])
+                else:
+                    ingest.ingestVector(dataset, study_area_path, os.path.join(out_path, dataset.name), out_cs)
+            messages()
 
+        else:
+            raster = dataset.name
+            print(f"Processing raster: {raster}\n")
 
+            def projectAndClip():
+                # project, resample and mask the boundary window in one pass, save to output gdb
+                with profiling.timed(f"Ingest {raster}"):
+                    ingest.ingestRaster(dataset, study_area_path, os.path.join(out_path, raster), out_cs, cell)
+                messages()
 
-# Project/Clip all data and store in gdb (From root folder to Scratch gdb to Output gdb)
-for dirpath, dirnames, filenames in arcpy.da.Walk(root_path, datatype=["FeatureClass", "RasterDataset"]):
-    arcpy.env.workspace = dirpath
+            # reuse the projected/clipped raster if the source, boundary, out_cs and cell haven't changed
+            raster_cache.cachedRaster(cache_path, "IngestRaster", {"out_cs": out_cs.name, "cell": cell},
+                                      [dataset.path, source_files[study_area]],
+                                      projectAndClip, os.path.join(out_path, raster), ctx["cache_max_bytes"])
 
-    if dirpath.endswith(".gdb"):
-        continue #skips this directory
+        # checkpoint the dataset so --resume doesn't convert it again
+        pipeline.markPart(ctx, dataset.name)
 
+    print()
 
-    for filename in filenames:
+    print(f"\n{'- - '*20}\n") # print separator line
 
-        # Skip study area
-        if study_area in filename:
-            continue # skils this file
+    return {"source_files": source_files}
 
 
-        if filename.lower().endswith(".shp"):  # Check if it's a shapefile
+#-------------------------------------------------------------------------------
+# Optimal Routes Parameters
+# Scale ranking from 1 (most desirable) to 10 (least desirable)
+#-------------------------------------------------------------------------------
+def costStage(ctx):
+    requireArcpy(spatial=ctx["cost_engine_type"] == "arcpy")
 
-            print(f"Processing Shapefile: {filename}\n")
+    out_path = ctx["out_path"]
+    cell = ctx["cell"]
+    study_area = ctx["study_area"]
+    factor_scratch_path = ctx["factor_scratch_path"]
 
-            name = os.path.splitext(filename)[0]
+    arcpy.env.workspace = out_path
 
-            # check coordinate system and save to scratch gdb
-            intermediate = checkCS_Vector(filename, scratch_path, out_cs)
 
-            # clip to boundary and save to output gdb
-            print(f"Clipping to the boundary... ")
-            arcpy.analysis.Clip(in_features=intermediate, clip_features=study_area_path, out_feature_class=os.path.join(out_path, name))
-            messages()
+    print("= = = Cost Analysis = = =")
 
-        elif filename.lower().endswith(".bnd"):
-            rasters = arcpy.ListRasters()
-            for raster in rasters:
-                print(f"Processing raster: {raster}\n")
-                print(f"Saving raster to {scratch_gdb}...")
-                arcpy.conversion.RasterToOtherFormat(Input_Rasters=os.path.join(dirpath, raster), Output_Workspace=scratch_path)
-                messages()
+    if ctx["cost_engine_type"] == "numpy":
+        # Compute all the cost factors in memory and only save Combined_Cost
+        print("Processing cost factors with the NumPy cost engine:")
+        if ctx["tile_size"]:
+            tiling.combinedCostTiledFromGDB(out_path, study_area, ctx["tile_path"], ctx["tile_size"], ctx["max_distance"],
+                                            remap=dict(ctx["remap"]), weights=ctx["weights"], rescale=ctx["rescale"],
+                                            stack_path=ctx["factor_stack_path"])
+        else:
+            cost_engine.combinedCostFromGDB(out_path, study_area, remap=dict(ctx["remap"]), weights=ctx["weights"],
+                                            cache_dir=ctx["cache_path"], sources=ctx.get("source_files"),
+                                            rescale=ctx["rescale"], stack_path=ctx["factor_stack_path"],
+                                            rasterizer_workers=rasterizerWorkers(ctx))
+        print()
 
-                print("Projecting raster...")
-                out_raster_path = os.path.join(scratch_path, f"{raster}_projected")
-                arcpy.management.ProjectRaster(in_raster=os.path.join(scratch_path, raster),out_raster=out_raster_path, out_coor_system=out_cs, cell_size=cell)
+    else:
+        #-------------------------------------------------------------------------------
+        # Landcover, Hydrology, Trails, Roads and Terrain Ruggedness share no data until
+        # the weighted sum, so each branch runs as its own task (see cost_factors.py)
+        import cost_factors
+        from arcpy.sa import WeightedSum, WSTable
+
+        rescale = ctx["rescale"] # (from_scale, to_scale) of each factor
+        tasks = [
+            task_runner.task("Landcover", cost_factors.landcoverFactor, out_path, factor_scratch_path, cell, ctx["remap"]),
+            # Hydrology - (desirable), small=1 / close is preferred
+            task_runner.task("Hydro", cost_factors.distanceFactor, out_path, factor_scratch_path, cell, study_area, "Hydro", "Hydro", *rescale["Hydro"]),
+            # Trails - (avoid), large=1 / far away is preferred
+            task_runner.task("Trails", cost_factors.distanceFactor, out_path, factor_scratch_path, cell, study_area, "Trails", "Trails", *rescale["Trails"]),
+            # Road merged with Transportation - (avoid), large=1 / far away is preferred
+            task_runner.task("Road", cost_factors.distanceFactor, out_path, factor_scratch_path, cell, study_area, "Road", ["Road", "Transportation"], *rescale["Road"]),
+            # Terrain Ruggedness (dem) - (avoid rugged terrain)
+            task_runner.task("TerrainR", cost_factors.terrainFactor, out_path, factor_scratch_path, cell, study_area, "ab_dem", *rescale["TerrainR"]),
+        ]
+        factors = {}
+        for result in task_runner.runTasks(tasks, ctx["factor_workers"], cost_factors.initWorker).values():
+            factors.update(result)
+
+        # Set the environment
+        arcpy.env.workspace = out_path
+        arcpy.env.extent = study_area # makes sure the rasters cover the whole boundary extent
+        arcpy.env.mask = study_area # makes sure the rasters don't extend beyond the boundary
+        arcpy.env.cellSize = cell # makes sure the rasters are outputted in this cell size
+
+        print("Saving TerrainR to the output gdb...")
+        with profiling.timed("CopyRaster TerrainR"):
+            arcpy.management.CopyRaster(factors["TerrainR_Focal"], "TerrainR")
+        messages()
 
-                print("Extract by Mask with park boundary...")
-                out_extract = ExtractByMask(in_raster=out_raster_path, in_mask_data=study_area_path)
-                messages()
 
-                print(f"Saving raster to {out_gdb}...")
-                out_extract.save(os.path.join(out_path, raster))
-                messages()
+        #-------------------------------------------------------------------------------
+        # Combine the cost surfaces into one single cost raster
+        # All weights are equal to 1
+        weights = ctx["weights"]
 
-print()
+        #combine all rescaled and reclassified rasters together using weighted sum
+        print("Computing weighted sum...")
+        with profiling.timed("WeightedSum"):
+            weighted_sum = WeightedSum(WSTable([[factors[name], 'Value', weights[name]] for name in cost_engine.FACTORS]))
+        messages()
 
-# Delete scratch gdb and all intermediate data
-try:
-    print(f"Deleting {scratch_gdb} along with all intermediate data...")
-    arcpy.Delete_management(scratch_path)
-    messages()
-except Exception as e:
-    print(f"Failed to delete {scratch_gdb}: {e}")
+        #save the weighted sum
+        print("Saving raster...")
+        with profiling.timed("Save Combined_Cost"):
+            weighted_sum.save("Combined_Cost")
+        messages()
 
-print(f"\n{'- - '*20}\n") # print separator line
+        # Delete the scratch gdbs of the cost factor branches
+        for gdb in os.listdir(factor_scratch_path):
+            print(f"Deleting {gdb}...")
+            arcpy.management.Delete(os.path.join(factor_scratch_path, gdb))
+            messages()
 
 
 #-------------------------------------------------------------------------------
-# Optimal Routes Parameters
-# Scale ranking from 1 (most desirable) to 10 (least desirable)
-#-------------------------------------------------------------------------------
-
-arcpy.env.workspace = out_path
+# Terrain ruggedness at several window sizes (Range_9, Std_15, VRM_5, ...)
+def terrainStage(ctx):
+    requireArcpy()
+    print("= = = Terrain Metrics = = =")
 
+    settings = ctx["terrain_metrics"]
+    saved = focal_engine.focalStatisticsFromGDB(
+        ctx["out_path"], os.path.join(ctx["tile_path"], "Focal"),
+        sizes=settings.get("sizes", focal_engine.SIZES),
+        statistics=settings.get("statistics", list(focal_engine.STATISTICS)),
+        chunk_rows=settings.get("chunk_rows", 1024), workers=ctx["factor_workers"])
+    print(f"Saved {', '.join(os.path.basename(raster) for raster in saved)}")
 
-print("= = = Cost Analysis = = =")
+    print(f"\n{'- - '*20}\n") # print separator line
 
-#-------------------------------------------------------------------------------
-# Landcover - Characteristics of the area being traversed (shp)
-
-print("Processing Landcover:")
-print("Converting from polygon to raster...")
-in_features="AB_Landcover"
-value_field="LC_class"
-out_rasterdataset = in_features +"_Ras"
-arcpy.conversion.PolygonToRaster(in_features, value_field, out_rasterdataset, cellsize=cell)
-messages()
-
-landcover = arcpy.Raster(out_rasterdataset)
-#reclassify the land cover
-remap = RemapValue([
-    ['20', 10],
-    ['31', 8],
-    ['32', 7],
-    ['33', 6],
-    ['34', 10],
-    ['50', 3],
-    ['110', 2],
-    ['120', 9],
-    ['210', 1],
-    ['220', 1],
-    ['230', 1]
-])
-
-# Apply reclassification
-print("Reclassifying...")
-landcover_reclass = Reclassify(landcover, "VALUE", remap, "DATA")
-messages()
-
-#save the reclassified land cover
-print("Saving raster...")
-landcover_reclass.save(f"{in_features}_Reclass")
-messages()
-
-print(f"Deleting {out_rasterdataset}...")
-arcpy.management.Delete(landcover)
-messages()
 
-#-------------------------------------------------------------------------------
-# Hydrology, Trails, Roads
-# - Use Distance Accumulation tool (outputs a continuous raster)
-# - Use the Rescale by Function tool to apply a continuous cost value between 0-10
+# Function to get the raster names of the terrain metrics
+def terrainOutputs(ctx):
+    settings = ctx["terrain_metrics"]
+    return [focal_engine.outputName(statistic, size)
+            for statistic in settings.get("statistics", list(focal_engine.STATISTICS))
+            for size in settings.get("sizes", focal_engine.SIZES)]
 
-# Set the environment
-arcpy.env.extent = study_area # makes sure the rasters cover the whole boundary extent
-arcpy.env.mask = study_area # makes sure the rasters don't extend beyond the boundary
-arcpy.env.cellSize = cell # makes sure the rasters are outputted in this cell size
 
 #-------------------------------------------------------------------------------
-# Hydrology - (desirable)
-print("Processing Hydrology:")
-print("Computing Distance Accumulation...")
-hydro_dist = DistanceAccumulation("Hydro")
-messages()
-print("Rescale by Function...")
-hydro_rescale = RescaleByFunction(hydro_dist, "TfLarge", 10, 1) # small=1 / close is preferred
-messages()
-
-print("Saving raster...")
-hydro_rescale.save("Hydro_Rescaled")
-messages()
-
-print("Deleting Hydro Dist...")
-arcpy.management.Delete(hydro_dist)
-messages()
+# Optimal Routes
+def corridorStage(ctx):
+    requireArcpy(spatial=ctx["corridor_solver_type"] == "arcpy")
+
+    out_path = ctx["out_path"]
+    arcpy.env.workspace = out_path
+    weighted_sum = os.path.join(out_path, "Combined_Cost")
+
+    #create the routes with the optimal region connections tool
+    print("Computing optimal path...")
+    if ctx["corridor_solver_type"] == "numpy":
+        # corridor_pyramid solves on a coarse grid first and refines around the coarse routes
+        corridor_solver.optimalRegionConnectionsFromGDB(out_path, "Bear_Habitat", "Optimal_Routes", weighted_sum,
+                                                        pyramid=ctx["corridor_pyramid"])
+    else:
+        from arcpy.sa import OptimalRegionConnections
 
-#-------------------------------------------------------------------------------
-# Trails - (avoid)
-print("Processing Trails:")
+        with profiling.timed("OptimalRegionConnections"):
+            OptimalRegionConnections("Bear_Habitat", "Optimal_Routes", "", weighted_sum)
+        messages()
 
-print("Computing Distance Accumulation...")
-trails_dist = DistanceAccumulation("Trails")
-messages()
 
-print("Rescale by Function...")
-trails_rescale = RescaleByFunction(trails_dist, "TfLarge", 1, 10) # large=1 / far away is preferred
-messages()
+    #-------------------------------------------------------------------------------
+    # Delete intermediate data (reclass, rescale rasters)
+    # Combined_Cost is kept so the corridors can be rerun without the cost stage
 
-print("Saving raster...")
-trails_rescale.save("Trails_Rescaled")
-messages()
+    rasters = arcpy.ListRasters()
+    for raster in rasters:
+        if "Rescale" in raster or "Reclass" in raster:
+            try:
+                # Delete the raster
+                print(f"Deleted raster: {raster}")
+                arcpy.management.Delete(raster)
+                messages()
+            except Exception as e:
+                print(f"Error deleting raster {raster}: {e}")
 
-print("Deleting Trails Dist...")
-arcpy.management.Delete(trails_dist)
-messages()
 
 #-------------------------------------------------------------------------------
-# Road - (avoid)
-print("Processing Roads: ")
-# Merge Road and Transportation
-print("Merging Road with Transportation...")
-road_merge = arcpy.management.Merge(["Road", "Transportation"], "Road_Merged")
-messages()
+# Corridor bands (the cells near the least cost between each pair of connected regions)
+def corridorBandsStage(ctx):
+    requireArcpy()
+    print("= = = Corridor Bands = = =")
 
-print("Computing Distance Accumulation...")
-road_dist = DistanceAccumulation(road_merge)
-messages()
-print("Rescale by Function...")
-road_rescale = RescaleByFunction(road_dist, "TfLarge", 1, 10) # large=1 / far away is preferred
-messages()
+    settings = ctx["corridor_bands"]
+    table, work_folder = corridorBandPaths(ctx)
+    results = corridor_bands.corridorBandsFromGDB(
+        ctx["out_path"], "Bear_Habitat", "Optimal_Routes", os.path.join(ctx["out_path"], "Combined_Cost"),
+        work_folder, table, percent=settings.get("percent", 5), max_cost=settings.get("max_cost"),
+        workers=ctx["factor_workers"])
+    print(f"Saved {len(results)} corridor bands to Corridor_Bands and {table}")
 
-print("Saving raster...")
-road_rescale.save("Road_Rescaled")
-messages()
+    print(f"\n{'- - '*20}\n") # print separator line
 
-print("Deleting Road Merged...")
-arcpy.management.Delete(road_merge)
-messages()
 
-print("Deleting Transportation...")
-arcpy.management.Delete("Transportation")
-messages()
-
-print("Deleting Roads Dist...")
-arcpy.management.Delete(road_dist)
-messages()
+# Function to get the table and the accumulation folder of the corridor bands
+def corridorBandPaths(ctx):
+    settings = ctx["corridor_bands"]
+    return (os.path.join(ctx["root_path"], settings.get("table", "Corridor_Bands.csv")),
+            os.path.join(ctx["root_path"], settings.get("work_folder", "Accumulations")))
 
 
 #-------------------------------------------------------------------------------
-# Terrain Ruggedness (dem) - (avoid rugged terrain)
-# Rescale by Function
+# Connectivity of the corridor network (regions as nodes, corridors as weighted edges)
+def connectivityStage(ctx):
+    requireArcpy()
+    import connectivity # imports SciPy, only the runs with this stage need it
 
-dem = arcpy.Raster("ab_dem")
+    print("= = = Corridor Network Connectivity = = =")
 
-print("Processing DEM to get Terrain ruggedness: ")
+    region_table, corridor_table = connectivityPaths(ctx)
+    with profiling.timed("Connectivity metrics", "step"):
+        metrics, region_table, corridor_table = connectivity.connectivityFromGDB(
+            ctx["out_path"], "Bear_Habitat", "Optimal_Routes", region_table, corridor_table,
+            ctx["connectivity"]["dispersal_cost"])
+    print(f"Equivalent connected area: {metrics['ec'] / 1e6:.2f} km2")
+    print(f"Saved {region_table} and {corridor_table}")
 
-# Generate the terrain ruggedness
-print("Computing Focal Statistics...")
-terrainRug = FocalStatistics(dem, NbrRectangle(3,3,"CELL"), "RANGE")
-messages()
+    print(f"\n{'- - '*20}\n") # print separator line
 
-print("Saving raster...")
-terrainRug.save("TerrainR") #save to gdb
-messages()
 
-# Use the Rescale By Function to assign the classes to the continuous rasters
-print("Rescale by Function...")
-terrainRug_rescale = RescaleByFunction(terrainRug, "TfLarge", 10, 1) # small=1 / low ruggedness is preferred
-messages()
+# Function to get the region and corridor tables of the connectivity metrics
+def connectivityPaths(ctx):
+    settings = ctx["connectivity"]
+    return (os.path.join(ctx["root_path"], settings.get("region_table", "Region_Connectivity.csv")),
+            os.path.join(ctx["root_path"], settings.get("corridor_table", "Corridor_Connectivity.csv")))
 
-print("Saving raster...")
-terrainRug_rescale.save("TerrainR_Rescaled")
-messages()
 
+# Function to get the rasterizer workers of the cost factors (None for FeatureToRaster)
+# rasterizer_type numpy burns the features in the project (landcover remapped during the burn)
+# The cost and scenario stages use the same rasterizer so they share the cache entries
+def rasterizerWorkers(ctx):
+    return ctx["factor_workers"] if ctx["rasterizer_type"] == "numpy" else None
 
-#-------------------------------------------------------------------------------
-# Combine the cost surfaces into one single cost raster
-# All weights are equal to 1
 
+#-------------------------------------------------------------------------------
+# Scenario sweep (sensitivity of the corridors to the WeightedSum weights)
+def scenarioStage(ctx):
+    requireArcpy()
+    print("= = = Scenario Sweep = = =")
+
+    scenarios = scenario_sweep.weightGrid(ctx["scenario_weights"])
+    if ctx["factor_stack_path"]:
+        # the factors saved by the cost stage, shared by the worker processes
+        scenario_sweep.sweepFromStack(ctx["factor_stack_path"], ctx["out_path"], "Bear_Habitat", scenarios,
+                                      ctx["scenario_table"], workers=ctx["factor_workers"])
+    else:
+        scenario_sweep.sweepFromGDB(ctx["out_path"], ctx["study_area"], "Bear_Habitat", scenarios, ctx["scenario_table"],
+                                    remap=dict(ctx["remap"]), cache_dir=ctx["cache_path"], sources=ctx.get("source_files"),
+                                    rescale=ctx["rescale"], rasterizer_workers=rasterizerWorkers(ctx))
+    print(f"Scenario table saved to {ctx['scenario_table']}")
 
-#combine all rescaled and reclassified rasters together using weighted sum
-print("Computing weighted sum...")
-weighted_sum = WeightedSum(WSTable([[landcover_reclass, 'Value', 1], \
-    [hydro_rescale, 'Value', 1], [trails_rescale, 'Value', 1], \
-    [road_rescale, 'Value', 1], [terrainRug_rescale, 'Value', 1]]))
-messages()
+    print(f"\n{'- - '*20}\n") # print separator line
 
-#save the weighted sum
-print("Saving raster...")
-weighted_sum.save("Combined_Cost")
-messages()
 
-#create the routes with the optimal region connections tool
-print("Computing optimal path...")
-optimal_routes = OptimalRegionConnections("Bear_Habitat", "Optimal_Routes", "", weighted_sum)
-messages()
+#-------------------------------------------------------------------------------
+# Mapping
+#-------------------------------------------------------------------------------
+def mappingStage(ctx):
+    requireArcpy()
+    import arcpy.mp as MAP
+
+    root_path = ctx["root_path"]
+
+    print("= = = Map Creation = = =")
+
+    arcpy.env.workspace = ctx["out_path"]
+
+    #reference the aprx document using the mapping modules
+    aprx = MAP.ArcGISProject(ctx["aprx_path"]) #path to aprx doc
+
+    #save a copy of the aprx so we can preserve the original
+    aprx.saveACopy(ctx["aprx_copy_path"])
+
+    #save a specific map frame as a variable to reference in the script
+    m = aprx.listMaps("Map")[0] #Sets m to 'Map' from index position 0 within list
+
+    #use the mapping module to add layers
+    listFC = [ctx["study_area"], "Bear_Habitat", "Optimal_Routes"]
+    for fc in listFC:
+        #first step in the loop is to create feature layers form the list
+        layer = arcpy.MakeFeatureLayer_management(fc)
+        #next, we will save the feature layers as .lyrx files
+        lyrFile = arcpy.SaveToLayerFile_management(layer, os.path.join(root_path, fc + ".lyrx")) #creating a folder to hold the layers
+        #we then have to use the arcpy.mp.LayerFile function to create another mp module useable layer for some reason
+        #These layer files are PERMANENT!
+        lyrFile = MAP.LayerFile(lyrFile)
+        #so now, we have a layer files that can be added to the map frame
+        m.addLayer(lyrFile)
+        print(fc + " layer added.")
+
+
+    # generate a list of the layouts within the project
+    layout = aprx.listLayouts()[0] # select Bear Habitat layer
+
+    # list the elements contained in the layout
+    elements = layout.listElements()
+    for elem in elements:
+        # change the map title in the layout
+        if elem.name == "Map Title":
+            print("Changing Map title...")
+            elem.text = ctx["map_title"]
+
+        # change/add a title to the legend element
+        if elem.name == "Legend":
+            print("Changing Legend title...")
+            elem.title = "Legend"
+
+
+    # "zoom to" KCountry_Bound layer
+    lyr = m.listLayers(ctx["study_area"] + "_Layer")[0]
+    lyt = aprx.listLayouts()[0]
+    mf = lyt.listElements("mapframe_element")[0]
+    mf.camera.setExtent(mf.getLayerExtent(lyr,True))
+    aprx.save()
+
+    # export the final result to a PDF
+    print("Exporting to PDF...")
+    with profiling.timed("ExportToPDF"):
+        layout.exportToPDF(ctx["pdf_path"])
+    messages()
 
+    aprx.save()
 
-#-------------------------------------------------------------------------------
-# Delete intermediate data (reclass, rescale, cost rasters)
 
-rasters = arcpy.ListRasters()
-for raster in rasters:
-    if "Rescale" in raster or "Reclass" in raster or "Cost" in raster:
-        try:
-            # Delete the raster
-            print(f"Deleted raster: {raster}")
-            arcpy.management.Delete(raster)
-            messages()
-        except Exception as e:
-            print(f"Error deleting raster {raster}: {e}")
+    print(f"\n{'- - '*20}\n") # print separator line
 
 
-#-------------------------------------------------------------------------------
-# Mapping
-#-------------------------------------------------------------------------------
+# Batch mapping (every map of the config from the template, in parallel, without saving the aprx)
+def batchMappingStage(ctx):
+    settings = ctx["map_export"]
+    renderer = settings.get("renderer", "aprx")
+    requireArcpy()
 
-print("= = = Map Creation = = =")
+    print("= = = Map Export = = =")
 
-arcpy.env.workspace = out_path
+    jobs = map_export.jobsFromContext(ctx)
+    print(f"Exporting {len(jobs)} maps with the {renderer} renderer...")
+    with profiling.timed("ExportMaps"):
+        saved = map_export.exportMaps(jobs, ctx["aprx_path"], renderer, settings.get("workers", ctx["factor_workers"]))
+    for path in saved:
+        print(f"Saved {path}")
 
-#reference the aprx document using the mapping modules
-aprx = MAP.ArcGISProject(r"C:\GEOS456\FinalProject\GEOS456_FinalProject.aprx") #path to aprx doc
+    print(f"\n{'- - '*20}\n") # print separator line
 
-#save a copy of the aprx so we can preserve the original
-aprx.saveACopy(r"C:\GEOS456\FinalProject\GEOS456_FinalProject_Original.aprx")
 
-#save a specific map frame as a variable to reference in the script
-m = aprx.listMaps("Map")[0] #Sets m to 'Map' from index position 0 within list
+#-------------------------------------------------------------------------------
+# Grid Statistics
+#-------------------------------------------------------------------------------
+def statisticsStage(ctx):
+    numpy_engine = ctx["statistics_engine_type"] == "numpy"
+    requireArcpy(spatial=not numpy_engine)
 
-#use the mapping module to add layers
-listFC = ["KCountry_Bound", "Bear_Habitat", "Optimal_Routes"]
-for fc in listFC:
-    #first step in the loop is to create feature layers form the list
-    layer = arcpy.MakeFeatureLayer_management(fc)
-    #next, we will save the feature layers as .lyrx files
-    lyrFile = arcpy.SaveToLayerFile_management(layer, "C:\\GEOS456\\FinalProject\\" + fc + ".lyrx") #creating a folder to hold the layers
-    #we then have to use the arcpy.mp.LayerFile function to create another mp module useable layer for some reason
-    #These layer files are PERMANENT!
-    lyrFile = MAP.LayerFile(lyrFile)
-    #so now, we have a layer files that can be added to the map frame
-    m.addLayer(lyrFile)
-    print(fc + " layer added.")
+    out_path = ctx["out_path"]
+    arcpy.env.workspace = out_path
 
+    print("= = = Grid Statistics = = =")
 
-# generate a list of the layouts within the project
-layout = aprx.listLayouts()[0] # select Bear Habitat layer
+    if numpy_engine:
+        # All the statistics in bulk from arrays, the tables are written once (no read back)
+        print("Computing grid statistics with the NumPy statistics engine...")
+        with profiling.timed("Grid statistics", "step"):
+            stats = grid_stats.parkStatistics(out_path, ctx["study_area"], write_tables=ctx["statistics_tables"])
+        printStatistics(stats)
+        return {"statistics": stats}
 
-# list the elements contained in the layout
-elements = layout.listElements()
-for elem in elements:
-    # change the map title in the layout
-    if elem.name == "Map Title":
-        print("Changing Map title...")
-        elem.text = "Connecting Bear Habitats"
+    from arcpy.sa import ZonalStatisticsAsTable
 
-    # change/add a title to the legend element
-    if elem.name == "Legend":
-        print("Changing Legend title...")
-        elem.title = "Legend"
+    # Results are returned so they are saved in the pipeline state (--print-stats)
+    stats = {}
 
+    # Average elevation of Kananaskis Country
 
-# "zoom to" KCountry_Bound layer
-lyr = m.listLayers("KCountry_Bound_Layer")[0]
-lyt = aprx.listLayouts()[0]
-mf = lyt.listElements("mapframe_element")[0]
-mf.camera.setExtent(mf.getLayerExtent(lyr,True))
-aprx.save()
+    InZoneData = ctx["study_area"]
+    ZoneField = "GEONAME" #any field since it's 1 polygon
+    InValueRaster = "ab_dem"
+    OutTable = "ab_dem_stats"
+    StatsType = "MEAN"
 
-# export the final result to a PDF
-print("Exporting to PDF...")
-layout.exportToPDF(r"C:\GEOS456\FinalProject\GEOS456_FP_Guan_Kristy.pdf")
-messages()
+    print("\nZonal Statistics to compute the average elevation of the park...")
+    with profiling.timed("ZonalStatisticsAsTable"):
+        ZonalStatisticsAsTable(InZoneData, ZoneField, InValueRaster, OutTable, "", StatsType)
+    messages()
 
-aprx.save()
+    with arcpy.da.SearchCursor(OutTable, ["MEAN"]) as scursor:
+        for row in scursor:
+            stats["mean_elevation"] = row[0]
 
 
-print(f"\n{'- - '*20}\n") # print separator line
+    #-------------------------------------------------------------------------------
+    # The area of each landcover type within the park boundary
 
-#-------------------------------------------------------------------------------
-# Grid Statistics
-#-------------------------------------------------------------------------------
-arcpy.env.workspace = out_path
+    # Use landcover polygon
+    in_table="AB_Landcover"
+    out_table=in_table+"_stats"
+    statistics_fields="Shape_Area SUM"
+    case_field="LC_class"
 
-print("= = = Grid Statistics = = =")
+    print("\nSummary statistics to compute total area of each landcover type...")
+    with profiling.timed("Statistics"):
+        arcpy.analysis.Statistics(in_table, out_table, statistics_fields, case_field)
+    messages()
 
-# Average elevation of Kananaskis Country
+    with arcpy.da.SearchCursor(out_table, ["LC_class", "SUM_Shape_Area"]) as scursor:
+        stats["landcover_areas"] = [list(row) for row in scursor]
 
-InZoneData = study_area
-ZoneField = "GEONAME" #any field since it's 1 polygon
-InValueRaster = dem
-OutTable = "ab_dem_stats"
-StatsType = "MEAN"
 
-print("\nZonal Statistics to compute the average elevation of the park...")
-ZonalStatisticsAsTable(InZoneData, ZoneField, InValueRaster, OutTable, "", StatsType)
-messages()
+    #-------------------------------------------------------------------------------
+    # Use a geometry token to get the length of the optimal routes
+    optimal_routes = os.path.join(out_path, "Optimal_Routes")
+    with arcpy.da.SearchCursor(optimal_routes, ["REGION1", "REGION2","SHAPE@LENGTH"]) as scursor:
+        stats["route_lengths"] = [list(row) for row in scursor]
 
-with arcpy.da.SearchCursor(OutTable, ["MEAN"]) as scursor:
-    for row in scursor:
-        print(f"The average elevation of Kananaskis Country is {round(row[0], 2):,} meters.")
+    #-------------------------------------------------------------------------------
+    # The NTS and the TWP-TGE-MER that covers the park
 
+    nts = "NTS50"
+    print("\nGetting NTS grid count...")
+    with arcpy.da.SearchCursor(nts, ["NAME"]) as scursor:
+        stats["nts"] = [row[0] for row in scursor]
 
-#-------------------------------------------------------------------------------
-# The area of each landcover type within the park boundary
+    township = "AB_Township"
+    print("\nGetting township count...")
+    with arcpy.da.SearchCursor(township, ["DESCRIPTOR"]) as scursor:
+        stats["townships"] = [row[0] for row in scursor]
 
-# Use landcover polygon
-in_table="AB_Landcover"
-out_table=in_table+"_stats"
-statistics_fields="Shape_Area SUM"
-case_field="LC_class"
+    printStatistics(stats)
+    return {"statistics": stats}
 
-print("\nSummary statistics to compute total area of each landcover type...")
-arcpy.analysis.Statistics(in_table, out_table, statistics_fields, case_field)
-messages()
 
-with arcpy.da.SearchCursor(out_table, ["LC_class", "SUM_Shape_Area"]) as scursor:
-    print("The area of each landcover type:")
-    for row in scursor:
-        print(f"\tLandcover type {row[0]} | Total Area: {round(row[1], 2):,} m2")
+# Function to print the Grid Statistics
+# stats is the dictionary made by statisticsStage (also saved in the pipeline state)
+def printStatistics(stats):
+    print(f"\nThe average elevation of Kananaskis Country is {round(stats['mean_elevation'], 2):,} meters.")
 
+    print("\nThe area of each landcover type:")
+    for lc_class, area in stats["landcover_areas"]:
+        print(f"\tLandcover type {lc_class} | Total Area: {round(area, 2):,} m2")
 
-#-------------------------------------------------------------------------------
-# Use a geometry token to print the total length of the optimal routes
-with arcpy.da.SearchCursor(optimal_routes, ["REGION1", "REGION2","SHAPE@LENGTH"]) as scursor:
     total = 0
     print(f"\nLength of the optimal routes: ")
-    for row in scursor:
-        print(f"\tFrom Region {row[0]} to Region {row[1]}: {round(row[2], 2):,} meters")
-        total += row[2]
+    for region1, region2, length in stats["route_lengths"]:
+        print(f"\tFrom Region {region1} to Region {region2}: {round(length, 2):,} meters")
+        total += length
     print(f"Total length of the optimal routes: {round(total, 2):,} meters")
 
-#-------------------------------------------------------------------------------
-# Print the NTS and the TWP-TGE-MER that covers the park
+    print(f"\nThere are {len(stats['nts'])} NTS grids covering the park: ")
+    for name in stats["nts"]:
+        print(f"\t{name}")
+
+    print(f"\nThere are {len(stats['townships'])} Townships covering the park: ")
+    for name in stats["townships"]:
+        print(f"\t{name}")
+
+    print()
+
 
-nts = "NTS50"
-print("\nGetting NTS grid count...")
-row_count = arcpy.management.GetCount(nts)
-messages()
-with arcpy.da.SearchCursor(nts, ["NAME"]) as scursor:
-    print(f"There are {row_count} NTS grids covering the park: ")
-    for row in scursor:
-        print(f"\t{row[0]}")
+#-------------------------------------------------------------------------------
+# Zonal statistics of many zones (habitat patches, route segments, NTS sheets, ...)
+def zonalStage(ctx):
+    requireArcpy()
+
+    print("= = = Zonal Statistics = = =")
+
+    settings = ctx["zonal_statistics"]
+    with profiling.timed("Zonal statistics", "step"):
+        tables = zonal_engine.zonalStatisticsFromGDB(
+            ctx["out_path"], settings["zones"], settings["values"], zonalFolder(ctx),
+            percentiles=settings.get("percentiles", (10, 50, 90)),
+            route_buffer=settings.get("route_buffer", 100), segment_length=settings.get("segment_length", 1000))
+    for table in tables:
+        print(f"Saved {table}")
 
+    print(f"\n{'- - '*20}\n") # print separator line
 
-township = "AB_Township"
-print("\nGetting township count...")
-row_count = arcpy.management.GetCount(township)
-messages()
-with arcpy.da.SearchCursor(township, ["DESCRIPTOR"]) as scursor:
-    print(f"There are {row_count} Townships covering the park: ")
-    for row in scursor:
-        print(f"\t{row[0]}")
 
-print()
+# Function to get the folder of the zonal statistics tables
+def zonalFolder(ctx):
+    return os.path.join(ctx["root_path"], ctx["zonal_statistics"].get("out_folder", "Zonal_Statistics"))
 
 
 #-------------------------------------------------------------------------------
 # Final datasets
 #-------------------------------------------------------------------------------
+def finalDatasetsStage(ctx):
+    requireArcpy()
 
-# Generate a list of final datasets, rasters and tables
-print("= = = Final Datasets = = =")
+    # Generate a list of final datasets, rasters and tables
+    print("= = = Final Datasets = = =")
 
-arcpy.env.workspace = out_path
+    arcpy.env.workspace = ctx["out_path"]
 
-fcList = arcpy.ListFeatureClasses()
-if fcList: #is not empty
-    print("\nList of feature classes: ")
-    for fc in fcList:
-        desc = arcpy.Describe(fc)
-        print(f"\tFeature class: {fc} | Geometry: {desc.shapeType} | Spatial Reference: {desc.spatialReference.name}")
-else:
-    print("No feature classes found.")
-
-rasters = arcpy.ListRasters()
-if rasters:
-    print("\nList of rasters: ")
-    for raster in rasters:
-        # Get cell size and spatial reference
-        desc = arcpy.Describe(raster)
-        print(f"\tRaster: {raster} | Cell size: {desc.meanCellWidth} | Spatial Reference: {desc.spatialReference.name}")
-else:
-    print("No rasters found.")
+    fcList = arcpy.ListFeatureClasses()
+    if fcList: #is not empty
+        print("\nList of feature classes: ")
+        for fc in fcList:
+            desc = arcpy.Describe(fc)
+            print(f"\tFeature class: {fc} | Geometry: {desc.shapeType} | Spatial Reference: {desc.spatialReference.name}")
+    else:
+        print("No feature classes found.")
+
+    rasters = arcpy.ListRasters()
+    if rasters:
+        print("\nList of rasters: ")
+        for raster in rasters:
+            # Get cell size and spatial reference
+            desc = arcpy.Describe(raster)
+            print(f"\tRaster: {raster} | Cell size: {desc.meanCellWidth} | Spatial Reference: {desc.spatialReference.name}")
+    else:
+        print("No rasters found.")
 
 
-# List tables (non-spatial data)
-tables = arcpy.ListTables()
-if tables:
-    print("\nList of tables: ")
-    for table in tables:
-        print(f"\tTable: {table}")
-else:
-    print("No tables found.")
+    # List tables (non-spatial data)
+    tables = arcpy.ListTables()
+    if tables:
+        print("\nList of tables: ")
+        for table in tables:
+            print(f"\tTable: {table}")
+    else:
+        print("No tables found.")
+
+    print(f"\n{'- - '*20}\n") # print separator line
+
+
+# Function to declare the stages of the pipeline with their inputs, outputs and parameters
+# The outputs are names in the output gdb or file paths
+def buildStages(ctx):
+    study_area = ctx["study_area"]
+
+    # the NumPy statistics engine can skip the tables (the stage then always runs)
+    statistics_tables = ["ab_dem_stats", "AB_Landcover_stats"]
+    if ctx["statistics_engine_type"] == "numpy" and not ctx["statistics_tables"]:
+        statistics_tables = []
+
+    # the factor stack is an output of the cost stage (its header is written last)
+    cost_outputs = ["Combined_Cost", "TerrainR"]
+    if ctx["factor_stack_path"]:
+        cost_outputs.append(factor_stack.headerPath(ctx["factor_stack_path"]))
+    stages = [
+        pipeline.Stage("conversion", conversionStage, [ctx["root_path"]],
+                       [study_area, "ab_dem", "AB_Landcover", "Hydro", "Trails", "Road", "Transportation",
+                        "Bear_Habitat", "NTS50", "AB_Township"],
+                       {"out_cs": ctx["out_cs"], "cell": ctx["cell"], "overlay": ctx["overlay_type"]}),
+        pipeline.Stage("cost", costStage,
+                       [study_area, "ab_dem", "AB_Landcover", "Hydro", "Trails", "Road", "Transportation"],
+                       cost_outputs,
+                       {"engine": ctx["cost_engine_type"], "rasterizer": ctx["rasterizer_type"], "remap": ctx["remap"],
+                        "weights": ctx["weights"], "rescale": ctx["rescale"], "tile_size": ctx["tile_size"],
+                        "max_distance": ctx["max_distance"]}),
+        pipeline.Stage("corridors", corridorStage, ["Combined_Cost", "Bear_Habitat"], ["Optimal_Routes"],
+                       {"solver": ctx["corridor_solver_type"], "pyramid": ctx["corridor_pyramid"]}),
+        # the aprx is saved by the mapping stage so it isn't an input,
+        # use --only-stage mapping to export again after a layout change
+        pipeline.Stage("mapping", mappingStage, [study_area, "Bear_Habitat", "Optimal_Routes"],
+                       [ctx["pdf_path"]], {"title": ctx["map_title"]}),
+        pipeline.Stage("statistics", statisticsStage,
+                       [study_area, "ab_dem", "AB_Landcover", "Optimal_Routes", "NTS50", "AB_Township"],
+                       statistics_tables, {"engine": ctx["statistics_engine_type"]}),
+        pipeline.Stage("final_datasets", finalDatasetsStage, [], [], {}),
+    ]
+
+    if ctx["scenario_weights"]:
+        scenario_inputs = [study_area, "ab_dem", "AB_Landcover", "Hydro", "Trails", "Road", "Transportation"]
+        if ctx["factor_stack_path"]:
+            scenario_inputs = [factor_stack.headerPath(ctx["factor_stack_path"])]
+        stages.insert(3, pipeline.Stage("scenarios", scenarioStage, scenario_inputs + ["Bear_Habitat"],
+                                        [ctx["scenario_table"]],
+                                        {"weights": ctx["scenario_weights"], "remap": ctx["remap"],
+                                         "rescale": ctx["rescale"], "rasterizer": ctx["rasterizer_type"]}))
+
+    if ctx["corridor_bands"]:
+        stages.insert(3, pipeline.Stage("corridor_bands", corridorBandsStage,
+                                        ["Combined_Cost", "Bear_Habitat", "Optimal_Routes"],
+                                        ["Corridor_Bands", corridorBandPaths(ctx)[0]], ctx["corridor_bands"]))
+
+    if ctx["connectivity"]:
+        stages.insert(3, pipeline.Stage("connectivity", connectivityStage, ["Bear_Habitat", "Optimal_Routes"],
+                                        list(connectivityPaths(ctx)), ctx["connectivity"]))
+
+    if ctx["terrain_metrics"]:
+        stages.insert(2, pipeline.Stage("terrain", terrainStage, ["ab_dem"], terrainOutputs(ctx),
+                                        ctx["terrain_metrics"]))
+
+    if ctx["map_export"]:
+        # the template is only read, so the batch export uses it as an input
+        jobs = map_export.jobsFromContext(ctx)
+        map_inputs = sorted({layer for job in jobs for layer in job.layers})
+        if ctx["map_export"].get("renderer", "aprx") == "aprx":
+            map_inputs.append(ctx["aprx_path"])
+        else:
+            map_inputs += sorted({job.background for job in jobs if job.background})
+        index = [stage.name for stage in stages].index("mapping")
+        stages[index] = pipeline.Stage("mapping", batchMappingStage, map_inputs, map_export.jobOutputs(ctx),
+                                       {"title": ctx["map_title"], "map_export": ctx["map_export"]})
+
+    if ctx["zonal_statistics"]:
+        zonal = ctx["zonal_statistics"]
+        stages.insert(len(stages) - 1, pipeline.Stage(
+            "zonal", zonalStage, list(zonal["zones"]) + list(zonal["values"]) + ["AB_Landcover"],
+            [os.path.join(zonalFolder(ctx), f"{layer}_zonal.csv") for layer in zonal["zones"]], zonal))
+    return stages
+
+
+# Function to get the work folders and output files a config writes in its source folder
+# They are left out of the source fingerprint and of the dataset discovery (an exported
+# .png map would be found as a raster)
+def workPaths(ctx):
+    paths = [ctx["out_path"], ctx["cache_path"], ctx["tile_path"], ctx["profile_path"], ctx["factor_scratch_path"],
+             ctx["factor_stack_path"]]
+    if ctx["corridor_bands"]:
+        paths.append(corridorBandPaths(ctx)[1])
+    if ctx["zonal_statistics"]:
+        paths.append(zonalFolder(ctx))
+    paths += map_export.jobOutputs(ctx)
+    return sorted(path for path in paths if path)
+
+
+# Function to set the paths each config skips in its source folder (work_paths), the
+# work paths of every config of the batch with the same source folder
+def setWorkPaths(contexts):
+    for ctx in contexts:
+        ctx["work_paths"] = sorted({path for other in contexts if other["root_path"] == ctx["root_path"]
+                                    for path in workPaths(other)})
+    return contexts
+
+
+# Function to run the pipeline of one config
+# ctx is the run context of the config, args are the pipeline options of the command line
+def runConfig(ctx, args):
+    print(f"= = = = = Config {ctx['name']} = = = = =\n")
+    out_path = ctx["out_path"]
+
+    # Run the stages, skipping the ones whose inputs and parameters haven't changed
+    # (--from-stage / --only-stage / --force to rerun stages, --resume to continue a failed run)
+    stages = buildStages(ctx)
+
+    def exists(output):
+        if os.path.isabs(output):
+            return os.path.exists(output)
+        return requireArcpy().Exists(os.path.join(out_path, output))
+
+    # validity hash of an output (None when it's missing), recorded in the checkpoint of
+    # its stage and checked before the stage is skipped
+    # files use their size and modified time, gdb datasets their content (see
+    # raster_cache.datasetFingerprint, rasters are sampled)
+    def outputHash(output):
+        if os.path.isabs(output):
+            return str(raster_cache.fingerprint(output)[1:]) if os.path.exists(output) else None
+        path = os.path.join(out_path, output)
+        if not requireArcpy().Exists(path):
+            return None
+        return raster_cache.datasetFingerprint(path)
+
+    # Record the time, memory and I/O of every stage (and cProfile them with --profile)
+    profiling.startReport(ctx["profile_path"] if args.profile else None)
+    try:
+        pipeline.runPipeline(stages, ctx, exists, ctx["state_path"], args.from_stage, args.only_stage, args.force,
+                             args.resume, outputHash, ctx["work_paths"])
+    finally:
+        report = profiling.stopReport()
+        profiling.writeReport(report, ctx["report_path"], ctx["report_table"])
+        print("\nRun report:")
+        profiling.printSummary(report)
+
+
+# Function to list the stages of a config with their outputs and status (no arcpy needed)
+def listOutputs(ctx):
+    print(f"= = = = = Config {ctx['name']} = = = = =")
+    for name, status, outputs in pipeline.stageStatus(buildStages(ctx), ctx["state_path"], ctx["work_paths"]):
+        print(f"Stage {name} ({status})")
+        for output in outputs:
+            print(f"\t{output}")
+    print()
 
-print(f"\n{'- - '*20}\n") # print separator line
 
-#-------------------------------------------------------------------------------
-# Check in the extension
-arcpy.CheckInExtension("Spatial")
+# Function to print the Grid Statistics saved by the last run of the statistics stage
+def printLastStatistics(ctx):
+    print(f"= = = = = Config {ctx['name']} = = = = =")
+    last = pipeline.loadState(ctx["state_path"]).get("statistics", {})
+    stats = (last.get("results") or {}).get("statistics")
+    if stats:
+        printStatistics(stats)
+    else:
+        print("The statistics stage hasn't run yet.\n")
+
 
 #-------------------------------------------------------------------------------
-# Record end time
-end = time.time()
-total_seconds = end-start
-minutes = int(total_seconds // 60)  # Get the number of full minutes
-seconds_remain = round(total_seconds % 60, 2)
-# Print the difference between start and end time in seconds
-print(f"\nThe time to execute the script was {minutes} min and {seconds_remain} seconds!")
-
-print("\nEnd of script.")
+# Main script block
+#-------------------------------------------------------------------------------
+
+# The parallel cost factor branches start worker processes that import this script,
+# only the main process runs the script block
+if __name__ == "__main__":
+    start = time.time()
+    print("Start of script.\n")
+
+    # Settings of each run are in the config files (configs/kananaskis_bear.json by default)
+    # More than one config runs them all in this process, sharing the imports, the
+    # Spatial licence and the inputs they have in common
+    parser = argparse.ArgumentParser(description="Connecting Wildlife Habitat pipeline")
+    parser.add_argument("configs", nargs="*", default=[config.DEFAULT_CONFIG], help="config files (JSON) to run")
+    pipeline.addArguments(parser)
+    # commands that only read the configs and the pipeline state (they don't import arcpy)
+    parser.add_argument("--validate", action="store_true", help="check the configs and stop")
+    parser.add_argument("--list-outputs", action="store_true", help="list the stages, their outputs and status and stop")
+    parser.add_argument("--print-stats", action="store_true", help="print the Grid Statistics of the last run and stop")
+    args = parser.parse_args()
+
+    configs = [config.loadConfig(path) for path in args.configs]
+    problems = config.validateBatch(configs)
+    if problems:
+        print("\n".join(problems))
+        sys.exit(1)
+
+    if args.validate:
+        print(f"{len(configs)} config(s) OK.")
+        sys.exit(0)
+
+    contexts = setWorkPaths([config.buildContext(settings) for settings in configs])
+
+    if args.list_outputs or args.print_stats:
+        for ctx in contexts:
+            if args.list_outputs:
+                listOutputs(ctx)
+            if args.print_stats:
+                printLastStatistics(ctx)
+        sys.exit(0)
+
+    shared = {} # inputs shared by the configs (e.g. the source data manifest)
+    failed = []
+    for ctx in contexts:
+        ctx["shared"] = shared
+        try:
+            runConfig(ctx, args)
+        except Exception as e:
+            if len(configs) == 1:
+                raise
+            # keep going with the other configs of the batch
+            print(f"Config {ctx['name']} failed: {e}\n")
+            failed.append(ctx["name"])
+
+    #-------------------------------------------------------------------------------
+    # Check in the extension (only if a stage checked it out)
+    if "Spatial" in checked_out:
+        arcpy.CheckInExtension("Spatial")
+
+    #-------------------------------------------------------------------------------
+    # Record end time
+    end = time.time()
+    total_seconds = end-start
+    minutes = int(total_seconds // 60)  # Get the number of full minutes
+    seconds_remain = round(total_seconds % 60, 2)
+    # Print the difference between start and end time in seconds
+    print(f"\nThe time to execute the script was {minutes} min and {seconds_remain} seconds!")
+
+    if failed:
+        print(f"\nFailed configs: {', '.join(failed)}")
+    print("\nEnd of script.")
+    sys.exit(1 if failed else 0)
 
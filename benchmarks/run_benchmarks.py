@@ -0,0 +1,248 @@
+#-------------------------------------------------------------------------------
+# Name:        Benchmarks
+# Purpose:     Times the stages of the pipeline on synthetic study areas at 1x,
+#              10x and 100x the Kananaskis extent with the in-project engines
+#              (no ArcGIS needed), and saves the timings as JSON so runs can be
+#              compared to catch performance regressions.
+#
+# Usage:       python benchmarks/run_benchmarks.py
+#              python benchmarks/run_benchmarks.py --fraction 0.01 --compare benchmarks/results/baseline.json
+#-------------------------------------------------------------------------------
+
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+# the project modules are in the folder above
+REPO_PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_PATH)
+
+import cost_engine
+import corridor_solver
+import profiling
+import scenario_sweep
+import synthetic
+import tiling
+
+
+# Stages that can be benchmarked (in the order they run)
+STAGES = ["cost", "cost_tiled", "corridors", "corridors_pyramid", "scenarios"]
+
+# Weights of the scenario stage (2 scenarios)
+SCENARIO_WEIGHTS = {"Hydro": [1, 2]}
+
+
+#-------------------------------------------------------------------------------
+# Stages
+#-------------------------------------------------------------------------------
+
+# Function to run the NumPy cost engine on the whole extent at once
+def costStage(area, settings, results):
+    layers = {name: np.asarray(layer) for name, layer in area.layers.items()}
+    results["cost"] = cost_engine.combinedCost(layers["landcover"], layers["hydro"], layers["trails"],
+                                               layers["road"], layers["dem"], area.cell, layers["mask"])
+
+
+# Function to run the tiled cost engine (memory-mapped, tile by tile)
+def costTiledStage(area, settings, results):
+    work_dir = os.path.join(settings["work_dir"], f"{area.name}_tiled")
+    os.makedirs(work_dir, exist_ok=True)
+    cost = tiling.tiledCombinedCost(area.layers, area.cell, work_dir, os.path.join(work_dir, "Combined_Cost.npy"),
+                                    settings["tile_size"], settings["max_distance"])
+    results.setdefault("cost", cost)
+
+
+# Function to run the corridor solver on the combined cost
+def corridorStage(area, settings, results):
+    regions = np.asarray(area.layers["regions"])
+    results["routes"] = corridor_solver.optimalRegionConnections(regions, np.asarray(results["cost"]), area.cell)
+
+
+# Function to run the coarse to fine corridor solver on the combined cost
+def corridorPyramidStage(area, settings, results):
+    regions = np.asarray(area.layers["regions"])
+    results["pyramid_routes"] = corridor_solver.pyramidRegionConnections(
+        regions, np.asarray(results["cost"]), area.cell, coarse_cell=settings["coarse_cell"])
+
+
+# Function to run a small scenario sweep (factor stack, tensordot, corridors per scenario)
+def scenarioStage(area, settings, results):
+    layers = {name: np.asarray(layer) for name, layer in area.layers.items()}
+    mask = layers["mask"]
+    factors = {"Landcover": cost_engine.reclassify(layers["landcover"], cost_engine.LANDCOVER_REMAP)}
+    for name in ("Hydro", "Trails", "Road"):
+        factors[name] = cost_engine.distanceFactor(name, layers[name.lower()], area.cell, mask)
+    factors["TerrainR"] = cost_engine.terrainFactor(cost_engine.focalRange(layers["dem"]), mask)
+
+    scenarios = scenario_sweep.weightGrid(SCENARIO_WEIGHTS)
+    scenario_sweep.runSweep(scenario_sweep.factorStack(factors), mask, layers["regions"], area.cell, scenarios)
+
+
+STAGE_FUNCS = {"cost": costStage, "cost_tiled": costTiledStage, "corridors": corridorStage,
+               "corridors_pyramid": corridorPyramidStage, "scenarios": scenarioStage}
+
+
+# Function to check if a stage is too large for this run (returns the reason or None)
+def skipReason(stage, cells, settings, results):
+    if stage in ("cost", "scenarios") and cells > settings["max_memory_cells"]:
+        return f"{cells:,} cells is more than --max-memory-cells"
+    if stage in ("corridors", "scenarios") and cells > settings["max_solver_cells"]:
+        return f"{cells:,} cells is more than --max-solver-cells"
+    if stage == "corridors_pyramid" and cells > settings["max_memory_cells"]:
+        return f"{cells:,} cells is more than --max-memory-cells"
+    if stage in ("corridors", "corridors_pyramid") and "cost" not in results:
+        return "no combined cost (run cost or cost_tiled first)"
+    return None
+
+
+#-------------------------------------------------------------------------------
+# Runs
+#-------------------------------------------------------------------------------
+
+# Function to run the benchmark stages on one study area
+# Returns the run record (study area, sizes and the profiling records)
+def benchmarkArea(area, stages, settings):
+    cells = area.shape[0] * area.shape[1]
+    run = {"study_area": area.name, "shape": list(area.shape), "cells": cells, "skipped": {}, "records": []}
+    results = {}
+
+    profiling.startReport()
+    try:
+        for stage in stages:
+            reason = skipReason(stage, cells, settings, results)
+            if reason:
+                print(f"Skipping {stage}: {reason}")
+                run["skipped"][stage] = reason
+                continue
+
+            print(f"Running {stage} on {area.name}...")
+            for n in range(settings["repeat"]):
+                with profiling.timed(stage, "stage"):
+                    STAGE_FUNCS[stage](area, settings, results)
+    finally:
+        run["records"] = profiling.stopReport()["records"]
+
+    if "routes" in results:
+        run["routes"] = len(results["routes"])
+    return run
+
+
+# Function to get the commit of the project (None outside a git checkout)
+def gitCommit():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], cwd=REPO_PATH, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+# Function to get the best wall time of each (study area scale, stage) of a result file
+def bestTimes(result):
+    times = {}
+    for run in result["runs"]:
+        for record in run["records"]:
+            if record["kind"] == "stage":
+                key = (run["scale"], record["name"])
+                times[key] = min(times.get(key, np.inf), record["wall_s"])
+    return times
+
+
+# Function to compare a result with a baseline result
+# Returns the list of (scale, stage, baseline s, new s) that are slower than threshold
+def compareResults(result, baseline, threshold):
+    new = bestTimes(result)
+    old = bestTimes(baseline)
+    slower = []
+    print(f"\n{'Scale':<8}{'Stage':<14}{'Baseline (s)':>14}{'New (s)':>12}{'Ratio':>8}")
+    for key in sorted(new):
+        if key not in old:
+            continue
+        ratio = new[key] / old[key] if old[key] else np.inf
+        print(f"{str(key[0]) + 'x':<8}{key[1]:<14}{old[key]:>14.3f}{new[key]:>12.3f}{ratio:>8.2f}")
+        if ratio > threshold:
+            slower.append((key[0], key[1], old[key], new[key]))
+    return slower
+
+
+# Function to read the benchmark options from the command line
+def parseArgs(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the pipeline stages on synthetic study areas")
+    parser.add_argument("--scales", type=float, nargs="+", default=[1, 10, 100],
+                        help="study area sizes as multiples of the Kananaskis extent")
+    parser.add_argument("--fraction", type=float, default=1.0,
+                        help="shrink the base area (e.g. 0.01 for a quick run)")
+    parser.add_argument("--cell", type=float, default=25, help="cell size in meters")
+    parser.add_argument("--seed", type=int, default=0, help="seed of the synthetic data")
+    parser.add_argument("--stages", nargs="+", choices=STAGES, default=STAGES, help="stages to run")
+    parser.add_argument("--repeat", type=int, default=1, help="runs of each stage (the best is compared)")
+    parser.add_argument("--tile-size", type=int, default=2048, help="tile size of the tiled engine in cells")
+    parser.add_argument("--max-distance", type=float, default=5000, help="distance cap of the tiled engine")
+    parser.add_argument("--coarse-cell", type=float, default=100, help="coarse cell size of the pyramid solver")
+    parser.add_argument("--max-memory-cells", type=int, default=100_000_000,
+                        help="skip the in-memory stages above this many cells")
+    parser.add_argument("--max-solver-cells", type=int, default=10_000_000,
+                        help="skip the corridor stages above this many cells")
+    parser.add_argument("--work-dir", default=os.path.join(tempfile.gettempdir(), "wildlife_benchmarks"),
+                        help="folder for the synthetic data and the tiled work files")
+    parser.add_argument("--out", default=os.path.join(REPO_PATH, "benchmarks", "results"),
+                        help="folder for the result JSON files")
+    parser.add_argument("--compare", help="baseline result JSON to compare with")
+    parser.add_argument("--threshold", type=float, default=1.25,
+                        help="fail when a stage is this many times slower than the baseline")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parseArgs(argv)
+    os.makedirs(args.work_dir, exist_ok=True)
+    os.makedirs(args.out, exist_ok=True)
+
+    settings = {"work_dir": args.work_dir, "tile_size": args.tile_size, "max_distance": args.max_distance,
+                "max_memory_cells": args.max_memory_cells, "max_solver_cells": args.max_solver_cells,
+                "coarse_cell": args.coarse_cell, "repeat": args.repeat}
+    stages = [stage for stage in STAGES if stage in args.stages]
+
+    result = {
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "commit": gitCommit(),
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "settings": dict(settings, fraction=args.fraction, cell=args.cell, seed=args.seed, stages=stages),
+        "runs": [],
+    }
+
+    for scale in args.scales:
+        scale = int(scale) if float(scale).is_integer() else scale
+        start = time.perf_counter()
+        area = synthetic.makeStudyArea(args.work_dir, scale, args.cell, args.fraction, args.seed, args.tile_size)
+        print(f"Study area {area.name} ready in {time.perf_counter() - start:.1f} s")
+
+        run = benchmarkArea(area, stages, settings)
+        run["scale"] = scale
+        result["runs"].append(run)
+
+    out_json = os.path.join(args.out, f"benchmark_{time.strftime('%Y%m%d_%H%M%S')}.json")
+    with open(out_json, "w") as f:
+        json.dump(result, f, indent=2)
+    print(f"\nSaved {out_json}")
+
+    if args.compare:
+        with open(args.compare) as f:
+            slower = compareResults(result, json.load(f), args.threshold)
+        for scale, stage, old, new in slower:
+            print(f"Regression: {stage} at {scale}x went from {old:.3f} s to {new:.3f} s")
+        return 1 if slower else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
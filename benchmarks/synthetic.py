@@ -0,0 +1,224 @@
+#-------------------------------------------------------------------------------
+# Name:        Synthetic Study Areas
+# Purpose:     Generates Kananaskis-like test inputs for the benchmarks without
+#              ArcGIS: a DEM, landcover using the LC_class codes of the remap
+#              table, hydro/trail/road lines and Bear_Habitat patches. The layers
+#              are written tile by tile to memory-mapped .npy files so the 100x
+#              study area never has to fit in memory.
+#-------------------------------------------------------------------------------
+
+import json
+import os
+from collections import namedtuple
+
+import numpy as np
+
+import tiling
+
+
+# Area of Kananaskis Country in square meters (about 4,200 km2)
+KANANASKIS_AREA = 4200e6
+
+# Elevation range of the park in meters
+ELEVATION = (1400, 3400)
+
+# Bear_Habitat patches per Kananaskis-sized area and their radius in meters
+PATCHES = 12
+PATCH_RADIUS = 1000
+
+# Distance between the main roads in meters
+ROAD_SPACING = 12000
+
+# One synthetic study area
+# name is the folder name, shape is (rows, cols), cell is the cell size in meters
+# layers is a dictionary of memmaps: dem, landcover, hydro, trails, road, mask, regions
+StudyArea = namedtuple("StudyArea", ["name", "shape", "cell", "layers"])
+
+# Layer name: data type of the memmap (and the fill value before generating)
+LAYERS = {
+    "dem": (np.float32, np.nan),
+    "landcover": (np.int16, 0),
+    "hydro": (bool, False),
+    "trails": (bool, False),
+    "road": (bool, False),
+    "mask": (bool, False),
+    "regions": (np.int32, 0),
+}
+
+
+#-------------------------------------------------------------------------------
+# Noise
+#-------------------------------------------------------------------------------
+
+# Function to make the random lattice of a value noise layer
+# spacing is the distance between lattice points in cells
+def noiseLattice(rng, shape, spacing):
+    return rng.random((shape[0] // spacing + 2, shape[1] // spacing + 2)).astype(np.float32)
+
+
+# Function to evaluate a value noise layer on a window of the grid (smooth 0-1 values)
+# The lattice is shared by the whole grid so neighbouring tiles line up
+def valueNoise(lattice, spacing, row0, row1, col0, col1):
+    r = np.arange(row0, row1, dtype=np.float32) / spacing
+    c = np.arange(col0, col1, dtype=np.float32) / spacing
+    ri = r.astype(np.int32)
+    ci = c.astype(np.int32)
+    fr = r - ri
+    fc = c - ci
+    fr = (fr * fr * (3 - 2 * fr))[:, None] # smoothstep
+    fc = (fc * fc * (3 - 2 * fc))[None, :]
+
+    top = lattice[ri[:, None], ci[None, :]] * (1 - fc) + lattice[ri[:, None], ci[None, :] + 1] * fc
+    bottom = lattice[ri[:, None] + 1, ci[None, :]] * (1 - fc) + lattice[ri[:, None] + 1, ci[None, :] + 1] * fc
+    return top * (1 - fr) + bottom * fr
+
+
+# Function to add up octaves of value noise (fractal noise, 0-1)
+# octaves is a list of (lattice, spacing, amplitude)
+def fractalNoise(octaves, row0, row1, col0, col1):
+    total = sum(amplitude * valueNoise(lattice, spacing, row0, row1, col0, col1)
+                for lattice, spacing, amplitude in octaves)
+    return total / sum(amplitude for _, _, amplitude in octaves)
+
+
+#-------------------------------------------------------------------------------
+# Layers
+#-------------------------------------------------------------------------------
+
+# Function to classify the landcover (LC_class codes of the remap table)
+# from the elevation and a moisture noise layer (both 0-1)
+def landcoverClasses(elevation, moisture):
+    lc = np.full(elevation.shape, 210, dtype=np.int16) # coniferous forest
+    lc[moisture > 0.55] = 230 # mixed forest
+    lc[moisture > 0.62] = 220 # broadleaf forest
+    lc[moisture > 0.70] = 50 # shrubland
+    lc[moisture > 0.78] = 110 # grassland
+    lc[(moisture > 0.85) & (elevation < 0.45)] = 120 # agriculture in the valleys
+    lc[(moisture > 0.92) & (elevation < 0.45)] = 34 # developed
+    lc[elevation > 0.62] = 33 # exposed land
+    lc[elevation > 0.70] = 32 # rock
+    lc[elevation > 0.80] = 31 # snow and ice
+    lc[moisture < 0.12] = 20 # water
+    return lc
+
+
+# Function to get the cells on the contour of a noise layer (thin line network)
+# width is the half width of the line in noise units
+def contourLines(noise, level, width):
+    return np.abs(noise - level) < width
+
+
+# Function to draw the main roads (east-west and north-south lines with some bends)
+# spacing is the distance between the roads in cells
+def roadLines(row0, row1, col0, col1, spacing):
+    r = np.arange(row0, row1, dtype=np.float32)[:, None]
+    c = np.arange(col0, col1, dtype=np.float32)[None, :]
+    bend = 0.1 * spacing
+    east_west = np.abs((r - bend * np.sin(c / spacing * 2 * np.pi) + spacing / 2) % spacing - spacing / 2) < 0.75
+    north_south = np.abs((c - bend * np.sin(r / spacing * 2 * np.pi) + spacing / 2) % spacing - spacing / 2) < 0.75
+    return east_west | north_south
+
+
+# Function to get the study area boundary (an ellipse with a noisy edge)
+def boundaryMask(edge_noise, shape, row0, row1, col0, col1):
+    v = (np.arange(row0, row1, dtype=np.float32)[:, None] + 0.5) / shape[0] - 0.5
+    u = (np.arange(col0, col1, dtype=np.float32)[None, :] + 0.5) / shape[1] - 0.5
+    return (u * u + v * v) / 0.45**2 + 0.4 * (edge_noise - 0.5) < 1
+
+
+# Function to pick the centres of the habitat patches (inside the boundary)
+def patchCentres(rng, shape, count):
+    angle = rng.uniform(0, 2 * np.pi, count)
+    radius = 0.3 * np.sqrt(rng.uniform(0, 1, count))
+    rows = ((0.5 + radius * np.sin(angle)) * shape[0]).astype(np.int64)
+    cols = ((0.5 + radius * np.cos(angle)) * shape[1]).astype(np.int64)
+    return list(zip(rows, cols))
+
+
+# Function to burn the habitat patches (discs numbered from 1) into a window
+def burnPatches(centres, radius, row0, row1, col0, col1):
+    out = np.zeros((row1 - row0, col1 - col0), dtype=np.int32)
+    for n, (pr, pc) in enumerate(centres):
+        if pr + radius < row0 or pr - radius >= row1 or pc + radius < col0 or pc - radius >= col1:
+            continue
+        r = np.arange(row0, row1)[:, None] - pr
+        c = np.arange(col0, col1)[None, :] - pc
+        out[r * r + c * c <= radius * radius] = n + 1
+    return out
+
+
+#-------------------------------------------------------------------------------
+# Study areas
+#-------------------------------------------------------------------------------
+
+# Function to get the grid size of a study area
+# scale is the area as a multiple of Kananaskis Country, fraction shrinks the base area
+# (e.g. 0.01 for quick runs), cell is the cell size in meters
+def studyAreaShape(scale, cell=25, fraction=1.0):
+    side = int(round(np.sqrt(KANANASKIS_AREA * scale * fraction) / cell))
+    return side, side
+
+
+# Function to generate a synthetic study area into work_dir (or reuse it if it's there)
+# Returns a StudyArea with the layers opened as read-only memmaps
+def makeStudyArea(work_dir, scale, cell=25, fraction=1.0, seed=0, tile_size=2048):
+    shape = studyAreaShape(scale, cell, fraction)
+    name = f"synthetic_{scale}x_{shape[0]}x{shape[1]}_{cell}m_seed{seed}"
+    folder = os.path.join(work_dir, name)
+    meta_path = os.path.join(folder, "meta.json")
+    meta = {"scale": scale, "fraction": fraction, "shape": shape, "cell": cell, "seed": seed}
+
+    if os.path.exists(meta_path):
+        with open(meta_path) as f:
+            if json.load(f) == json.loads(json.dumps(meta)):
+                return openStudyArea(folder)
+
+    print(f"Generating {name}...")
+    os.makedirs(folder, exist_ok=True)
+    rng = np.random.default_rng(seed)
+    km = int(1000 // cell) # cells per kilometer
+
+    terrain = [(noiseLattice(rng, shape, 40 * km), 40 * km, 1.0),
+               (noiseLattice(rng, shape, 10 * km), 10 * km, 0.5),
+               (noiseLattice(rng, shape, 2 * km), 2 * km, 0.2)]
+    moisture = [(noiseLattice(rng, shape, 8 * km), 8 * km, 1.0),
+                (noiseLattice(rng, shape, 2 * km), 2 * km, 0.3)]
+    streams = [(noiseLattice(rng, shape, 6 * km), 6 * km, 1.0)]
+    trails = [(noiseLattice(rng, shape, 5 * km), 5 * km, 1.0)]
+    edge = [(noiseLattice(rng, shape, 30 * km), 30 * km, 1.0)]
+    centres = patchCentres(rng, shape, max(2, int(round(PATCHES * scale * fraction))))
+    radius = int(PATCH_RADIUS // cell)
+
+    layers = {name: tiling.createMemmap(os.path.join(folder, f"{name}.npy"), shape, dtype, fill)
+              for name, (dtype, fill) in LAYERS.items()}
+
+    for tile in tiling.iterTiles(shape[0], shape[1], tile_size):
+        window = (tile.row0, tile.row1, tile.col0, tile.col1)
+        core = (slice(tile.row0, tile.row1), slice(tile.col0, tile.col1))
+
+        elevation = fractalNoise(terrain, *window)
+        mask = boundaryMask(fractalNoise(edge, *window), shape, *window)
+        landcover = landcoverClasses(elevation, fractalNoise(moisture, *window))
+
+        layers["dem"][core] = ELEVATION[0] + elevation * (ELEVATION[1] - ELEVATION[0])
+        layers["landcover"][core] = landcover
+        layers["hydro"][core] = contourLines(fractalNoise(streams, *window), 0.5, 0.004) | (landcover == 20)
+        layers["trails"][core] = contourLines(fractalNoise(trails, *window), 0.5, 0.003) & (elevation < 0.7)
+        layers["road"][core] = roadLines(*window, int(ROAD_SPACING // cell))
+        layers["mask"][core] = mask
+        layers["regions"][core] = burnPatches(centres, radius, *window) * mask
+
+    for layer in layers.values():
+        layer.flush()
+    with open(meta_path, "w") as f:
+        json.dump(meta, f, indent=2)
+    del layers
+    return openStudyArea(folder)
+
+
+# Function to open a generated study area
+def openStudyArea(folder):
+    with open(os.path.join(folder, "meta.json")) as f:
+        meta = json.load(f)
+    layers = {name: tiling.openMemmap(os.path.join(folder, f"{name}.npy")) for name in LAYERS}
+    return StudyArea(os.path.basename(folder), tuple(meta["shape"]), meta["cell"], layers)
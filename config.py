@@ -0,0 +1,202 @@
+#-------------------------------------------------------------------------------
+# Name:        Config
+# Purpose:     Loads the settings of a run (paths, cell size, landcover remap,
+#              rescale scales, weights, map settings, ...) from a JSON file so the
+#              pipeline is driven by configuration files instead of literals in
+#              the script. A config can extend another one, e.g. one file per
+#              species on top of the file of the study area.
+#-------------------------------------------------------------------------------
+
+import json
+import os
+
+import corridor_solver
+import cost_engine
+import focal_engine
+import map_export
+
+
+# Config used when none is given on the command line
+DEFAULT_CONFIG = os.path.join(os.path.dirname(os.path.abspath(__file__)), "configs", "kananaskis_bear.json")
+
+# Settings that every config must have (after extends)
+REQUIRED = ["root_path", "out_gdb", "study_area", "out_cs", "cell", "remap", "weights"]
+
+# Default values of the optional settings
+DEFAULTS = {
+    "datasets": ["BaseFeatures", "StudyArea"],
+    "rescale": {name: list(scales) for name, scales in cost_engine.RESCALE.items()},
+    "scenario_weights": None,
+    "scenario_table": "Scenario_Comparison.csv",
+    "cost_engine_type": "arcpy",
+    "corridor_solver_type": "arcpy",
+    "statistics_engine_type": "arcpy",
+    "rasterizer_type": "arcpy",
+    "overlay_type": "arcpy",
+    "statistics_tables": True,
+    "zonal_statistics": None,
+    "corridor_bands": None,
+    "corridor_pyramid": None,
+    "terrain_metrics": None,
+    "map_export": None,
+    "connectivity": None,
+    "tile_size": None,
+    "max_distance": 5000,
+    "tile_path": "Tiles",
+    "factor_stack_path": None,
+    "factor_workers": 5,
+    "factor_scratch_path": "FactorScratch",
+    "cache_path": "Cache",
+    "cache_max_bytes": 20 * 1024**3,
+    "aprx_path": "GEOS456_FinalProject.aprx",
+    "aprx_copy_path": "GEOS456_FinalProject_Original.aprx",
+    "pdf_path": "GEOS456_FP_Guan_Kristy.pdf",
+    "map_title": "Connecting Bear Habitats",
+    "report_path": "Run_Report.json",
+    "report_table": "Run_Report.csv",
+    "profile_path": "Profiles",
+    "state_path": "pipeline_state.json",
+}
+
+# Settings that are paths, relative paths are in root_path
+PATH_KEYS = ["scenario_table", "tile_path", "factor_stack_path", "factor_scratch_path", "cache_path", "aprx_path", "aprx_copy_path",
+             "pdf_path", "report_path", "report_table", "profile_path", "state_path"]
+
+# Choices of the engine settings
+ENGINES = ("arcpy", "numpy")
+
+
+# Function to read a config file (and the config it extends)
+# Returns the settings with the defaults filled in, name is the file name by default
+def loadConfig(path):
+    with open(path) as f:
+        settings = json.load(f)
+
+    base = dict(DEFAULTS)
+    if "extends" in settings:
+        base = loadConfig(os.path.join(os.path.dirname(os.path.abspath(path)), settings.pop("extends")))
+    base.pop("name", None)
+    base.update(settings)
+    base.setdefault("name", os.path.splitext(os.path.basename(path))[0])
+    base["config_path"] = os.path.abspath(path)
+    return base
+
+
+# Function to check the settings of a config
+# Returns a list of problems (empty when the config is fine)
+def validateConfig(settings):
+    name = settings.get("name", "config")
+    problems = [f"{name}: missing setting {key}" for key in REQUIRED if key not in settings]
+    if problems:
+        return problems
+
+    if not isinstance(settings["cell"], (int, float)) or settings["cell"] <= 0:
+        problems.append(f"{name}: cell must be a positive number")
+
+    for row in settings["remap"]:
+        if len(row) != 2 or not str(row[0]).isdigit() or not isinstance(row[1], (int, float)):
+            problems.append(f"{name}: remap rows must be [LC_class, cost], got {row}")
+
+    for key, names in (("weights", cost_engine.FACTORS), ("rescale", list(cost_engine.RESCALE))):
+        missing = [factor for factor in names if factor not in settings[key]]
+        if missing:
+            problems.append(f"{name}: {key} has no value for {', '.join(missing)}")
+    for factor, scales in settings["rescale"].items():
+        if len(scales) != 2:
+            problems.append(f"{name}: rescale of {factor} must be [from_scale, to_scale]")
+
+    for key in ("cost_engine_type", "corridor_solver_type", "statistics_engine_type", "rasterizer_type",
+                "overlay_type"):
+        if settings[key] not in ENGINES:
+            problems.append(f"{name}: {key} must be one of {', '.join(ENGINES)}")
+
+    if settings["tile_size"] is not None and settings["cost_engine_type"] != "numpy":
+        problems.append(f"{name}: tile_size needs cost_engine_type numpy")
+    if settings["rasterizer_type"] == "numpy" and (settings["cost_engine_type"] != "numpy" or settings["tile_size"]):
+        problems.append(f"{name}: rasterizer_type numpy needs cost_engine_type numpy without tile_size")
+    if settings["factor_stack_path"] and settings["cost_engine_type"] != "numpy":
+        problems.append(f"{name}: factor_stack_path needs cost_engine_type numpy")
+
+    unknown = [factor for factor in settings["scenario_weights"] or {} if factor not in cost_engine.FACTORS]
+    if unknown:
+        problems.append(f"{name}: scenario_weights has unknown factors {', '.join(unknown)}")
+
+    pyramid = settings["corridor_pyramid"]
+    if pyramid:
+        if settings["corridor_solver_type"] != "numpy":
+            problems.append(f"{name}: corridor_pyramid needs corridor_solver_type numpy")
+        if pyramid.get("aggregation", "mean") not in corridor_solver.AGGREGATIONS:
+            problems.append(f"{name}: corridor_pyramid aggregation must be one of {', '.join(corridor_solver.AGGREGATIONS)}")
+        if not pyramid.get("coarse_cell", 100) > settings["cell"]:
+            problems.append(f"{name}: corridor_pyramid coarse_cell must be larger than cell")
+
+    terrain = settings["terrain_metrics"]
+    if terrain:
+        if any(not isinstance(size, int) or size < 3 or size % 2 == 0 for size in terrain.get("sizes", [])):
+            problems.append(f"{name}: terrain_metrics sizes must be odd numbers of cells (3 or more)")
+        unknown = [s for s in terrain.get("statistics", []) if s not in focal_engine.STATISTICS]
+        if unknown:
+            problems.append(f"{name}: terrain_metrics has unknown statistics {', '.join(unknown)}")
+
+    bands = settings["corridor_bands"]
+    if bands and not (isinstance(bands.get("percent", 5), (int, float)) and bands.get("percent", 5) >= 0):
+        problems.append(f"{name}: corridor_bands percent must be a number of 0 or more")
+
+    maps = settings["map_export"]
+    if maps:
+        if maps.get("renderer", "aprx") not in map_export.RENDERERS:
+            problems.append(f"{name}: map_export renderer must be one of {', '.join(map_export.RENDERERS)}")
+        if any("out" not in job for job in maps.get("jobs", [])):
+            problems.append(f"{name}: every map_export job needs an out file")
+
+    connectivity = settings["connectivity"]
+    if connectivity and not (isinstance(connectivity.get("dispersal_cost"), (int, float))
+                             and connectivity["dispersal_cost"] > 0):
+        problems.append(f"{name}: connectivity needs a positive dispersal_cost")
+
+    zonal = settings["zonal_statistics"]
+    if zonal and not (zonal.get("zones") and zonal.get("values")):
+        problems.append(f"{name}: zonal_statistics needs zones and values")
+    return problems
+
+
+# Function to check a batch of configs (each config and the outputs they share)
+def validateBatch(configs):
+    problems = []
+    outputs = {}
+    for settings in configs:
+        config_problems = validateConfig(settings)
+        problems += config_problems
+        if config_problems:
+            continue
+        # two configs writing the same gdb with different state files would undo each other
+        paths = resolvePaths(settings)
+        for key in ("out_path", "state_path", "pdf_path", "report_path"):
+            other = outputs.setdefault((key, os.path.normcase(paths[key])), settings["name"])
+            if other != settings["name"]:
+                problems.append(f"{settings['name']}: {key} is the same as in {other}")
+        for job in (settings["map_export"] or {}).get("jobs", []):
+            out = os.path.normcase(os.path.join(settings["root_path"], job["out"]))
+            other = outputs.setdefault(("map", out), settings["name"])
+            if other != settings["name"]:
+                problems.append(f"{settings['name']}: map {job['out']} is the same as in {other}")
+    return problems
+
+
+# Function to get the settings with absolute paths (and out_path, the output gdb path)
+def resolvePaths(settings):
+    settings = dict(settings)
+    root_path = settings["root_path"]
+    for key in PATH_KEYS:
+        if settings[key] and not os.path.isabs(settings[key]):
+            settings[key] = os.path.join(root_path, settings[key])
+    settings["out_path"] = os.path.join(root_path, settings["out_gdb"])
+    return settings
+
+
+# Function to build the run context of the pipeline from the settings of a config
+# out_cs stays a name, the stages that need arcpy make the SpatialReference
+def buildContext(settings):
+    ctx = resolvePaths(settings)
+    ctx["rescale"] = {factor: tuple(scales) for factor, scales in settings["rescale"].items()}
+    return ctx
@@ -0,0 +1,415 @@
+#-------------------------------------------------------------------------------
+# Name:        Connectivity
+# Purpose:     Network metrics of the corridor network. The habitat regions are
+#              the nodes of a sparse graph and the least-cost corridors its
+#              weighted edges. Effective resistance and current-flow betweenness
+#              come from the inverse of the grounded Laplacian of each connected
+#              component, shortest-path betweenness from the shortest path trees,
+#              and the probability of connectivity loss (dPC) from removing each
+#              patch or corridor only recomputes the sources whose paths used it.
+#              Needs SciPy (installed with ArcGIS Pro).
+#-------------------------------------------------------------------------------
+
+import csv
+import math
+import os
+from collections import namedtuple
+
+import numpy as np
+from scipy import sparse
+from scipy.sparse import csgraph
+from scipy.sparse.linalg import splu
+
+
+# The corridor network
+# nodes is the region id of each node, areas the area of each region
+# edges is an (m x 2) array of node indices (first < second), costs the least cost of
+# each corridor (its resistance) and lengths its length in meters
+Graph = namedtuple("Graph", ["nodes", "areas", "edges", "costs", "lengths"])
+
+# Smallest edge cost (csgraph drops zero weights, which would remove the edge)
+MIN_COST = 1e-9
+
+# Columns of the inverse solved at a time
+SOLVE_BLOCK = 512
+
+# Dispersal probability below which a pair of regions counts as not connected (keeps the
+# searches of the removals local, the PC sum changes by less than this share of a pair)
+CUTOFF = 1e-6
+
+
+#-------------------------------------------------------------------------------
+# Graph
+#-------------------------------------------------------------------------------
+
+# Function to build the graph of the corridor network
+# regions is {region id: area}, routes is a list of (region1, region2, cost, length)
+# Routes between the same regions keep the cheapest one, routes to unknown regions
+# and loops are left out
+def buildGraph(regions, routes):
+    nodes = np.array(sorted(regions), dtype=np.int64)
+    index = {region: n for n, region in enumerate(nodes)}
+    areas = np.array([regions[region] for region in nodes], dtype=np.float64)
+
+    best = {}
+    for region1, region2, cost, length in routes:
+        if region1 not in index or region2 not in index or region1 == region2:
+            continue
+        key = (min(index[region1], index[region2]), max(index[region1], index[region2]))
+        if key not in best or cost < best[key][0]:
+            best[key] = (float(cost), float(length))
+
+    keys = sorted(best)
+    edges = np.array(keys, dtype=np.int64).reshape(-1, 2)
+    costs = np.array([best[key][0] for key in keys], dtype=np.float64)
+    lengths = np.array([best[key][1] for key in keys], dtype=np.float64)
+    return Graph(nodes, areas, edges, np.maximum(costs, MIN_COST), lengths)
+
+
+# Function to get the symmetric sparse matrix of edge values (e.g. the costs)
+# keep is a boolean mask of the edges to use (all by default)
+def adjacency(graph, values, keep=None):
+    n = len(graph.nodes)
+    edges, values = graph.edges, np.asarray(values, dtype=np.float64)
+    if keep is not None:
+        edges, values = edges[keep], values[keep]
+    rows = np.concatenate([edges[:, 0], edges[:, 1]])
+    cols = np.concatenate([edges[:, 1], edges[:, 0]])
+    return sparse.csr_matrix((np.concatenate([values, values]), (rows, cols)), shape=(n, n))
+
+
+# Function to drop edges from an adjacency matrix (quicker than a new matrix for each
+# removal), edge_ids is the edge of each stored value (adjacency of the edge numbers)
+def withoutEdges(matrix, edge_ids, keep):
+    matrix = matrix.copy()
+    matrix.data[~keep[edge_ids]] = 0
+    matrix.eliminate_zeros()
+    return matrix
+
+
+# Function to get the Laplacian of the graph with conductance 1 / cost on each edge
+def laplacian(graph):
+    conductance = adjacency(graph, 1.0 / graph.costs)
+    return sparse.diags(np.asarray(conductance.sum(axis=1)).ravel()) - conductance
+
+
+#-------------------------------------------------------------------------------
+# Current flow
+#-------------------------------------------------------------------------------
+
+# Function to get the inverse of the grounded Laplacian of each connected component
+# The first node of a component is grounded (its row and column are 0), the other
+# columns are solved in blocks from one sparse LU factorization
+# Returns a list of (node indices, dense inverse), components of one node have none
+def groundedInverses(graph):
+    lap = laplacian(graph).tocsc()
+    count, labels = csgraph.connected_components(adjacency(graph, graph.costs), directed=False)
+    inverses = []
+    for component in range(count):
+        members = np.flatnonzero(labels == component)
+        if len(members) < 2:
+            continue
+        grounded = lap[members[1:]][:, members[1:]].tocsc()
+        lu = splu(grounded)
+        inverse = np.zeros((len(members), len(members)))
+        for start in range(0, len(members) - 1, SOLVE_BLOCK):
+            stop = min(start + SOLVE_BLOCK, len(members) - 1)
+            identity = np.zeros((len(members) - 1, stop - start))
+            identity[np.arange(start, stop), np.arange(stop - start)] = 1
+            inverse[1:, 1 + start:1 + stop] = lu.solve(identity)
+        inverses.append((members, inverse))
+    return inverses
+
+
+# Function to get the effective resistance between every pair of regions
+# (the resistance of the corridor network between them, lower when there are more
+# and cheaper parallel corridors; inf between regions that aren't connected)
+# Returns an (n x n) array
+def effectiveResistance(graph, inverses=None):
+    n = len(graph.nodes)
+    resistance = np.full((n, n), np.inf)
+    np.fill_diagonal(resistance, 0)
+    for members, inverse in inverses if inverses is not None else groundedInverses(graph):
+        diagonal = np.diag(inverse)
+        resistance[np.ix_(members, members)] = diagonal[:, None] + diagonal[None, :] - 2 * inverse
+    return resistance
+
+
+# Function to get the sum of |x[i] - x[j]| over every pair i < j of each row
+def pairwiseAbsoluteSums(values):
+    values = np.sort(values, axis=1)
+    n = values.shape[1]
+    return values @ (2 * np.arange(n) - n + 1).astype(np.float64)
+
+
+# Function to get the current-flow betweenness of the regions and corridors
+# (Newman's random-walk betweenness: the current through a region or corridor summed
+# over every pair of regions of its component, with a unit current between them)
+# Returns (node betweenness, edge betweenness), the node betweenness leaves out the
+# pairs the region is an end of
+def currentFlowBetweenness(graph, inverses=None):
+    others = np.zeros(len(graph.nodes))
+    edge_flow = np.zeros(len(graph.edges))
+    for members, inverse in inverses if inverses is not None else groundedInverses(graph):
+        local = np.full(len(graph.nodes), -1)
+        local[members] = np.arange(len(members))
+        in_component = np.flatnonzero(local[graph.edges[:, 0]] >= 0)
+        for start in range(0, len(in_component), SOLVE_BLOCK):
+            block = in_component[start:start + SOLVE_BLOCK]
+            u, v = local[graph.edges[block, 0]], local[graph.edges[block, 1]]
+            # the current through the edge from s to t is w (b[s] - b[t]), b = G[u] - G[v]
+            potentials = (inverse[u] - inverse[v]) / graph.costs[block][:, None]
+            edge_flow[block] = pairwiseAbsoluteSums(potentials)
+        others[members] = len(members) - 1
+
+    # the pairs a region is an end of send 1 through its edges, the others pass twice through them
+    incident = np.bincount(graph.edges.ravel(), weights=np.repeat(edge_flow, 2), minlength=len(graph.nodes))
+    node_flow = (incident - others) / 2
+    return node_flow, edge_flow
+
+
+#-------------------------------------------------------------------------------
+# Shortest paths
+#-------------------------------------------------------------------------------
+
+# Function to get the least-cost distance between every pair of regions over the corridors
+# keep is a boolean mask of the edges to use, sources limits the rows
+# limit stops the searches at that cost (the regions further away are inf)
+# Returns (distances, predecessors) as from scipy.sparse.csgraph.dijkstra
+def leastCostDistances(graph, keep=None, sources=None, limit=np.inf):
+    return csgraph.dijkstra(adjacency(graph, graph.costs, keep), directed=False, indices=sources,
+                            return_predecessors=True, limit=limit)
+
+
+# Function to count the descendants of every node in the shortest path tree of every source
+# (each tree is walked from its furthest node in, one step for all the sources at once)
+# Returns an (n x n) array, sizes[s, v] is 1 + the descendants of v in the tree of s
+def subtreeSizes(distances, predecessors):
+    n = distances.shape[1]
+    sizes = np.ones(distances.shape)
+    sources = np.arange(distances.shape[0])
+    order = np.argsort(-np.where(np.isinf(distances), -1, distances), axis=1, kind="stable")
+    for k in range(n):
+        v = order[:, k]
+        parent = predecessors[sources, v]
+        has_parent = parent >= 0
+        np.add.at(sizes, (sources[has_parent], parent[has_parent]), sizes[sources[has_parent], v[has_parent]])
+    return sizes
+
+
+# Function to get the shortest-path betweenness of the regions and corridors
+# (the number of pairs of regions whose least-cost path goes through a region, or
+# along a corridor)
+# Returns (node betweenness, edge betweenness, sizes of subtreeSizes)
+def shortestPathBetweenness(graph, distances, predecessors):
+    n = len(graph.nodes)
+    sizes = subtreeSizes(distances, predecessors)
+    reached = ~np.isinf(distances)
+    inner = np.where(reached, sizes - 1, 0)
+    np.fill_diagonal(inner, 0)
+    node_between = inner.sum(axis=0) / 2
+
+    # the edge from a node to its parent carries the paths to the node and its descendants
+    # (the edges are sorted by their nodes, so the edge of a pair is found by its key)
+    sources, targets = np.nonzero(predecessors >= 0)
+    parents = predecessors[sources, targets]
+    keys = np.minimum(parents, targets) * n + np.maximum(parents, targets)
+    edges = np.searchsorted(graph.edges[:, 0] * n + graph.edges[:, 1], keys)
+    edge_between = np.bincount(edges, weights=sizes[sources, targets], minlength=len(graph.edges)) / 2
+    return node_between, edge_between, sizes
+
+
+#-------------------------------------------------------------------------------
+# Probability of connectivity
+#-------------------------------------------------------------------------------
+
+# Function to turn least-cost distances into dispersal probabilities
+# dispersal_cost is the cost at which the probability is 0.5 (exponential decay)
+# Probabilities below cutoff are 0
+def dispersalProbability(distances, dispersal_cost, cutoff=CUTOFF):
+    probability = np.exp(-distances * math.log(2) / dispersal_cost)
+    probability[probability < cutoff] = 0
+    return probability
+
+
+# Function to get the least cost at which the dispersal probability drops below cutoff
+def dispersalLimit(dispersal_cost, cutoff=CUTOFF):
+    return dispersal_cost * math.log2(1 / cutoff)
+
+
+# Function to get the branch of the shortest path tree of root that holds each node
+# (the child of root it hangs from, found by pointer jumping, -1 for root and unreached)
+def treeBranches(predecessors, root):
+    nodes = np.arange(len(predecessors))
+    up = np.where(predecessors == root, nodes, predecessors)
+    up[predecessors < 0] = -1
+    while True:
+        jumped = np.where(up >= 0, up[np.maximum(up, 0)], -1)
+        if np.array_equal(jumped, up):
+            return up
+        up = jumped
+
+
+# Function to get the PC loss of removing a region or corridor
+# costs is the cost matrix without the removed edges, sources the regions whose pairs can
+# change and sides their side of the removed element (a pair on the same side doesn't go
+# through it)
+# Pairs left in different components lose their probability without a search, the other
+# pairs that cross sides are searched from every side but the largest one
+def removalLoss(graph, costs, sources, sides, probability, dispersal_cost, cutoff, limit):
+    labels = csgraph.connected_components(costs, directed=False)[1][sources]
+    same_side = sides[:, None] == sides[None, :]
+    before = probability[np.ix_(sources, sources)]
+    after = np.where(same_side, before, 0)
+
+    search = ~same_side & (labels[:, None] == labels[None, :])
+    rows = search.any(axis=1)
+    if rows.any():
+        side_ids, counts = np.unique(sides[rows], return_counts=True)
+        rows &= sides != side_ids[np.argmax(counts)]
+        new_distances = csgraph.dijkstra(costs, directed=False, indices=sources[rows], limit=limit)
+        found = dispersalProbability(new_distances[:, sources], dispersal_cost, cutoff)
+        after[rows] = np.where(search[rows], found, after[rows])
+        after[:, rows] = after[rows].T
+    areas = graph.areas[sources]
+    return areas @ (before - after) @ areas
+
+
+# Function to get the connectivity loss (dPC, Saura & Pascual-Hortal) of removing each
+# region and each corridor, in percent of PC
+# A region's loss is split into intra (its own area), flux (its connections) and
+# connector (the paths between other regions that go through it). Only the sources
+# whose shortest path tree uses the region or corridor within the dispersal limit are
+# looked at again (see removalLoss), and only up to that limit.
+# Returns a dictionary: pc (the PC sum without the landscape area), ec (equivalent
+# connected area), node_dpc, node_intra, node_flux, node_connector, edge_dpc
+def connectivityLoss(graph, distances, predecessors, sizes, dispersal_cost, cutoff=CUTOFF):
+    areas = graph.areas
+    probability = dispersalProbability(distances, dispersal_cost, cutoff)
+    pc = float(areas @ probability @ areas)
+    n = len(graph.nodes)
+    limit = dispersalLimit(dispersal_cost, cutoff)
+    costs = adjacency(graph, graph.costs)
+    edge_ids = adjacency(graph, np.arange(1, len(graph.edges) + 1)).data.astype(np.int64) - 1
+
+    intra = areas**2
+    flux = 2 * areas * (probability @ areas - areas)
+    connector = np.zeros(n)
+    for k in np.flatnonzero((sizes > 1).any(axis=0)):
+        # sources that reach some other region through k (k is inside their tree),
+        # their side is the branch of the tree of k they are in
+        sources = np.flatnonzero((sizes[:, k] > 1) & (np.arange(n) != k) & (distances[:, k] <= limit))
+        if len(sources) == 0:
+            continue
+        keep = (graph.edges[:, 0] != k) & (graph.edges[:, 1] != k)
+        sides = treeBranches(predecessors[k], k)[sources]
+        connector[k] = removalLoss(graph, withoutEdges(costs, edge_ids, keep), sources, sides, probability,
+                                   dispersal_cost, cutoff, limit)
+
+    edge_loss = np.zeros(len(graph.edges))
+    for e, (u, v) in enumerate(graph.edges):
+        # sources whose tree uses the corridor, their side is the end they reach it from
+        from_u = predecessors[:, v] == u
+        sources = np.flatnonzero((from_u | (predecessors[:, u] == v))
+                                 & (np.minimum(distances[:, u], distances[:, v]) <= limit))
+        if len(sources) == 0:
+            continue
+        keep = np.ones(len(graph.edges), dtype=bool)
+        keep[e] = False
+        sides = from_u[sources].astype(np.int64)
+        edge_loss[e] = removalLoss(graph, withoutEdges(costs, edge_ids, keep), sources, sides, probability,
+                                   dispersal_cost, cutoff, limit)
+
+    scale = 100.0 / pc if pc else 0.0
+    return {
+        "pc": pc,
+        "ec": math.sqrt(pc),
+        "node_dpc": (intra + flux + connector) * scale,
+        "node_intra": intra * scale,
+        "node_flux": flux * scale,
+        "node_connector": connector * scale,
+        "edge_dpc": edge_loss * scale,
+    }
+
+
+# Function to compute every metric of the corridor network
+# Returns a dictionary with the node and edge metrics (see writeTables) and pc, ec
+def networkMetrics(graph, dispersal_cost):
+    inverses = groundedInverses(graph)
+    resistance = effectiveResistance(graph, inverses)
+    node_flow, edge_flow = currentFlowBetweenness(graph, inverses)
+    distances, predecessors = leastCostDistances(graph)
+    node_between, edge_between, sizes = shortestPathBetweenness(graph, distances, predecessors)
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        finite = np.where(np.isinf(resistance), 0, resistance)
+        reached = (~np.isinf(resistance)).sum(axis=1) - 1
+        closeness = np.where(reached > 0, reached / finite.sum(axis=1), 0)
+
+    metrics = connectivityLoss(graph, distances, predecessors, sizes, dispersal_cost)
+    metrics.update({
+        "degree": np.bincount(graph.edges.ravel(), minlength=len(graph.nodes)),
+        "node_betweenness": node_between,
+        "node_current_flow": node_flow,
+        "current_flow_closeness": closeness,
+        "edge_betweenness": edge_between,
+        "edge_current_flow": edge_flow,
+        "edge_resistance": resistance[graph.edges[:, 0], graph.edges[:, 1]],
+    })
+    return metrics
+
+
+# Function to write the region and corridor tables of the metrics
+# Returns the two table paths
+def writeTables(graph, metrics, region_csv, corridor_csv):
+    with open(region_csv, "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(["REGION", "AREA", "DEGREE", "BETWEENNESS", "CF_BETWEENNESS", "CF_CLOSENESS",
+                         "DPC", "DPC_INTRA", "DPC_FLUX", "DPC_CONNECTOR"])
+        for n, region in enumerate(graph.nodes):
+            writer.writerow([region, round(graph.areas[n], 2), metrics["degree"][n],
+                             round(metrics["node_betweenness"][n], 2), round(metrics["node_current_flow"][n], 4),
+                             round(metrics["current_flow_closeness"][n], 8), round(metrics["node_dpc"][n], 4),
+                             round(metrics["node_intra"][n], 4), round(metrics["node_flux"][n], 4),
+                             round(metrics["node_connector"][n], 4)])
+
+    with open(corridor_csv, "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(["REGION1", "REGION2", "COST", "LENGTH", "BETWEENNESS", "CF_BETWEENNESS",
+                         "EFFECTIVE_RESISTANCE", "DPC"])
+        for e, (u, v) in enumerate(graph.edges):
+            writer.writerow([graph.nodes[u], graph.nodes[v], round(graph.costs[e], 2), round(graph.lengths[e], 2),
+                             round(metrics["edge_betweenness"][e], 2), round(metrics["edge_current_flow"][e], 4),
+                             round(metrics["edge_resistance"][e], 4), round(metrics["edge_dpc"][e], 4)])
+    return region_csv, corridor_csv
+
+
+#-------------------------------------------------------------------------------
+# arcpy input
+#-------------------------------------------------------------------------------
+
+# Function to read the corridor network from the gdb
+# in_regions is the habitat patches (OBJECTID is the region id), routes the corridors
+# (REGION1, REGION2 and PATH_COST when the corridor solver wrote it, the length otherwise)
+def graphFromGDB(workspace, in_regions, routes):
+    import arcpy
+    import grid_stats
+
+    patches = grid_stats.featureArray(os.path.join(workspace, in_regions), ["OID@", "SHAPE@AREA"])
+    regions = {int(oid): float(area) for oid, area in patches}
+
+    routes_path = os.path.join(workspace, routes)
+    has_cost = "PATH_COST" in [field.name for field in arcpy.ListFields(routes_path)]
+    fields = ["REGION1", "REGION2", "PATH_COST" if has_cost else "SHAPE@LENGTH", "SHAPE@LENGTH"]
+    rows = grid_stats.featureArray(routes_path, fields)
+    return buildGraph(regions, [(int(r1), int(r2), float(cost), float(length)) for r1, r2, cost, length in rows])
+
+
+# Function to compute the connectivity metrics of the corridor network of the gdb
+# dispersal_cost is the least cost at which the dispersal probability is 0.5
+# Returns (metrics, region table, corridor table)
+def connectivityFromGDB(workspace, in_regions, routes, region_csv, corridor_csv, dispersal_cost):
+    graph = graphFromGDB(workspace, in_regions, routes)
+    print(f"Computing the metrics of {len(graph.nodes)} regions and {len(graph.edges)} corridors...")
+    metrics = networkMetrics(graph, dispersal_cost)
+    return (metrics,) + writeTables(graph, metrics, region_csv, corridor_csv)
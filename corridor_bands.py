@@ -0,0 +1,174 @@
+#-------------------------------------------------------------------------------
+# Name:        Corridor Bands
+# Purpose:     Corridor bands between habitat regions instead of single-cell routes.
+#              The accumulated cost from each region is computed once and kept on
+#              disk, then the band of every connected pair is the cells where the
+#              sum of the two accumulations is within a percent of the least cost
+#              (like the Corridor tool with a slice). One accumulation per region
+#              instead of one per pair, and the regions and pairs run in parallel.
+#-------------------------------------------------------------------------------
+
+import csv
+import hashlib
+import json
+import os
+
+import numpy as np
+
+import corridor_solver
+import task_runner
+
+
+#-------------------------------------------------------------------------------
+# Accumulations
+#-------------------------------------------------------------------------------
+
+# Function to get the key of a set of accumulations (changes with the cost,
+# the regions, the cell size and max_cost)
+def accumulationKey(cost, regions, cell, max_cost=None):
+    h = hashlib.sha256()
+    h.update(np.ascontiguousarray(cost, dtype=np.float32).tobytes())
+    h.update(np.ascontiguousarray(regions, dtype=np.int32).tobytes())
+    h.update(json.dumps({"cell": cell, "max_cost": max_cost}).encode())
+    return h.hexdigest()[:32]
+
+
+# Function to accumulate cost outwards from one region
+# (see corridor_solver.accumulate, unreached cells are inf)
+# Returns a float32 array of the shape of cost
+def regionAccumulation(cost, regions, region, cell, max_cost=None):
+    dist, _, _ = corridor_solver.accumulate(cost, (np.asarray(regions) == region).astype(np.int32), cell, max_cost)
+    return dist.reshape(cost.shape).astype(np.float32)
+
+
+# Function to get the accumulation of one region, from work_dir if it was saved with
+# the same key or computed and saved (a task of corridorBands)
+# work_dir has the cost and regions arrays saved by corridorBands
+# Returns the path of the accumulation .npy
+def accumulationTask(work_dir, key, region, cell, max_cost=None):
+    path = os.path.join(work_dir, f"Region_{region}.npy")
+    meta_path = os.path.join(work_dir, f"Region_{region}.json")
+    if os.path.exists(path) and os.path.exists(meta_path):
+        with open(meta_path) as f:
+            if json.load(f).get("key") == key:
+                return path
+
+    cost = np.load(os.path.join(work_dir, "cost.npy"), mmap_mode="r")
+    regions = np.load(os.path.join(work_dir, "regions.npy"), mmap_mode="r")
+    np.save(path, regionAccumulation(cost, regions, region, cell, max_cost))
+    with open(meta_path, "w") as f:
+        json.dump({"key": key, "region": region}, f)
+    return path
+
+
+#-------------------------------------------------------------------------------
+# Bands
+#-------------------------------------------------------------------------------
+
+# Function to get the corridor band between two regions from their accumulations
+# percent is how much more than the least cost a path through a cell can cost
+# Returns (band, least cost), band is the cost above the least cost inside the band
+# and NaN outside (None, inf when the regions can't reach each other)
+def corridorBand(acc_a, acc_b, percent=5):
+    total = np.add(acc_a, acc_b, dtype=np.float64)
+    least = float(total.min())
+    if not np.isfinite(least):
+        return None, np.inf
+    extra = total - least
+    band = np.where(extra <= least * percent / 100.0, extra, np.nan).astype(np.float32)
+    return band, least
+
+
+# Function to save the band of one pair of regions (a task of corridorBands)
+# path_a, path_b are the accumulations of the two regions (results of accumulationTask)
+# Returns (region1, region2, least cost, band cells)
+def bandTask(work_dir, region1, region2, percent, path_a, path_b):
+    band, least = corridorBand(np.load(path_a, mmap_mode="r"), np.load(path_b, mmap_mode="r"), percent)
+    if band is None:
+        return region1, region2, least, 0
+    np.save(os.path.join(work_dir, f"Corridor_{region1}_{region2}.npy"), band)
+    return region1, region2, least, int(np.count_nonzero(~np.isnan(band)))
+
+
+# Function to get the corridor bands of the pairs of regions
+# regions is an integer array of region ids (0 = not a region), cost the cost array
+# pairs is a list of (region1, region2), e.g. the routes of the corridor solver
+# work_dir keeps the accumulations, they are reused while the cost and regions don't change
+# workers is the number of processes for the accumulations and the bands
+# Returns a list of (region1, region2, least cost, band cells)
+def corridorBands(cost, regions, cell, pairs, work_dir, percent=5, max_cost=None, workers=1):
+    os.makedirs(work_dir, exist_ok=True)
+    key = accumulationKey(cost, regions, cell, max_cost)
+    np.save(os.path.join(work_dir, "cost.npy"), np.asarray(cost, dtype=np.float32))
+    np.save(os.path.join(work_dir, "regions.npy"), np.asarray(regions, dtype=np.int32))
+
+    pairs = sorted({(min(a, b), max(a, b)) for a, b in pairs})
+    used = sorted({region for pair in pairs for region in pair})
+    print(f"Computing {len(used)} accumulations for {len(pairs)} corridor bands...")
+
+    tasks = [task_runner.task(f"Region {region}", accumulationTask, work_dir, key, region, cell, max_cost)
+             for region in used]
+    tasks += [task_runner.task(f"Corridor {a}-{b}", bandTask, work_dir, a, b, percent,
+                               depends=[f"Region {a}", f"Region {b}"])
+              for a, b in pairs]
+    results = task_runner.runTasks(tasks, workers)
+    return [results[f"Corridor {a}-{b}"] for a, b in pairs]
+
+
+# Function to merge the bands saved by corridorBands into one array
+# Each cell keeps the lowest cost above the least cost of the bands it's in
+def mergeBands(work_dir, results, shape):
+    merged = np.full(shape, np.nan, dtype=np.float32)
+    for region1, region2, _, cells in results:
+        if cells:
+            band = np.load(os.path.join(work_dir, f"Corridor_{region1}_{region2}.npy"), mmap_mode="r")
+            np.fmin(merged, band, out=merged)
+    return merged
+
+
+# Function to write the table of the corridor bands
+# lengths is a dictionary of {(region1, region2): route length}, the mean width of a
+# band is its area divided by the length of its route
+def writeBandTable(results, cell, out_csv, lengths=None):
+    lengths = lengths or {}
+    with open(out_csv, "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(["REGION1", "REGION2", "LEAST_COST", "CELLS", "AREA", "MEAN_WIDTH"])
+        for region1, region2, least, cells in results:
+            area = cells * cell**2
+            length = lengths.get((region1, region2))
+            writer.writerow([region1, region2, round(least, 2) if np.isfinite(least) else "", cells,
+                             round(area, 2), round(area / length, 2) if length else ""])
+    return out_csv
+
+
+#-------------------------------------------------------------------------------
+# arcpy input/output
+#-------------------------------------------------------------------------------
+
+# Function to make the corridor bands of the routes from the gdb
+# workspace is the output gdb, in_regions the habitat patches, routes the feature class
+# of the corridor stage (REGION1, REGION2), cost_raster the Combined_Cost raster
+# The merged bands are saved as out_name and the table as out_csv
+# Returns the list of (region1, region2, least cost, band cells)
+def corridorBandsFromGDB(workspace, in_regions, routes, cost_raster, work_dir, out_csv, out_name="Corridor_Bands",
+                         percent=5, max_cost=None, workers=1):
+    import arcpy
+    import cost_engine
+    import grid_stats
+
+    grid = cost_engine.gridFromRaster(cost_raster)
+    with arcpy.EnvManager(workspace=workspace, extent=cost_raster, snapRaster=cost_raster, cellSize=grid.cell):
+        cost = cost_engine.readRaster(cost_raster, grid)
+        regions = cost_engine.featuresToArray(in_regions, "OBJECTID", grid)
+    regions = np.nan_to_num(regions, nan=0).astype(np.int32)
+
+    rows = grid_stats.featureArray(os.path.join(workspace, routes), ["REGION1", "REGION2", "SHAPE@LENGTH"])
+    lengths = {(min(int(r1), int(r2)), max(int(r1), int(r2))): float(length) for r1, r2, length in rows}
+
+    results = corridorBands(cost, regions, grid.cell, list(lengths), work_dir, percent, max_cost, workers)
+
+    print("Saving corridor bands...")
+    cost_engine.writeRaster(mergeBands(work_dir, results, cost.shape), grid, os.path.join(workspace, out_name))
+    writeBandTable(results, grid.cell, out_csv, lengths)
+    return results
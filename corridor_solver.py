@@ -0,0 +1,457 @@
+#-------------------------------------------------------------------------------
+# Name:        Corridor Solver
+# Purpose:     Least-cost corridors between habitat regions over the Combined_Cost
+#              array, in place of the OptimalRegionConnections tool.
+#              A multi-source Dijkstra grows out from every region at once, the
+#              cheapest connection between each pair of touching regions is kept
+#              and a minimum spanning tree picks the corridors.
+#-------------------------------------------------------------------------------
+
+import heapq
+import math
+import os
+from collections import namedtuple
+
+import numpy as np
+
+
+# One corridor between two regions
+# region1, region2 are the region ids (region1 < region2)
+# cost is the accumulated cost of the path, length is the path length in meters
+# cells is the list of flat cell indices from region1 to region2
+Route = namedtuple("Route", ["region1", "region2", "cost", "length", "cells"])
+
+SQRT2 = math.sqrt(2)
+
+# 8 neighbours (row offset, column offset, distance factor)
+NEIGHBOURS = [(-1, -1, SQRT2), (-1, 0, 1.0), (-1, 1, SQRT2), (0, -1, 1.0),
+              (0, 1, 1.0), (1, -1, SQRT2), (1, 0, 1.0), (1, 1, SQRT2)]
+
+
+#-------------------------------------------------------------------------------
+# Searches
+#-------------------------------------------------------------------------------
+
+# Function to accumulate cost outwards from all the regions at once (multi-source Dijkstra)
+# cost is the cost array (NaN cells can't be crossed)
+# regions is an integer array of region ids (0 = not a region)
+# cell is the cell size, moving between cells costs the mean of both cells times the distance
+# max_cost stops the search once every cell under that accumulated cost is done
+# Returns flat arrays: dist (accumulated cost), alloc (id of the closest region),
+# pred (int32 index of the previous cell on the path, -1 at the regions)
+def accumulate(cost, regions, cell, max_cost=None):
+    rows, cols = cost.shape
+    c = np.asarray(cost, dtype=np.float64).ravel()
+    labels = np.asarray(regions).ravel()
+
+    dist = np.full(c.size, np.inf)
+    pred = np.full(c.size, -1, dtype=np.int32)
+    alloc = np.zeros(c.size, dtype=np.int32)
+    done = np.zeros(c.size, dtype=bool)
+
+    seeds = np.flatnonzero((labels > 0) & ~np.isnan(c)).astype(np.int32)
+    dist[seeds] = 0.0
+    alloc[seeds] = labels[seeds]
+
+    heap = [(0.0, int(i)) for i in seeds]
+    heapq.heapify(heap)
+    pop, push = heapq.heappop, heapq.heappush
+    half = 0.5 * cell
+
+    while heap:
+        d, i = pop(heap)
+        if done[i]:
+            continue
+        if max_cost is not None and d > max_cost:
+            break
+        done[i] = True
+
+        r, col = divmod(i, cols)
+        ci = c[i]
+        label = alloc[i]
+        for dr, dc, f in NEIGHBOURS:
+            rr = r + dr
+            cc = col + dc
+            if rr < 0 or rr >= rows or cc < 0 or cc >= cols:
+                continue
+            j = rr * cols + cc
+            cj = c[j]
+            if done[j] or cj != cj:  # done or NoData
+                continue
+            nd = d + (ci + cj) * half * f
+            if nd < dist[j]:
+                dist[j] = nd
+                pred[j] = i
+                alloc[j] = label
+                push(heap, (nd, j))
+
+    # cells that were not finished (early termination) are unreached
+    dist[~done] = np.inf
+    alloc[~done] = 0
+    pred[~done] = -1
+    return dist, alloc, pred
+
+
+# Function to find the least-cost path between two sets of cells (A*)
+# start, goal are boolean arrays of the start and goal cells
+# heuristic_weight scales the straight-line estimate to the goal, 1 gives the exact
+# least-cost path, larger values search fewer cells but the path can cost more
+# max_cost gives up once the accumulated cost passes that value
+# Returns (cost, list of flat cell indices from start to goal) or None if not reached
+def leastCostPath(cost, start, goal, cell, heuristic_weight=1.0, max_cost=None):
+    rows, cols = cost.shape
+    c = np.asarray(cost, dtype=np.float64).ravel()
+
+    goal_flat = np.asarray(goal).ravel()
+    goal_rows, goal_cols = np.nonzero(goal)
+    if goal_rows.size == 0:
+        return None
+    r0, r1 = goal_rows.min(), goal_rows.max()
+    c0, c1 = goal_cols.min(), goal_cols.max()
+
+    # cheapest possible step per meter, keeps the estimate from over-shooting
+    unit = float(np.nanmin(c)) * cell * heuristic_weight
+
+    # octile distance to the bounding box of the goal cells
+    def estimate(i):
+        r, col = divmod(i, cols)
+        dy = max(r0 - r, 0, r - r1)
+        dx = max(c0 - col, 0, col - c1)
+        return unit * (max(dx, dy) + (SQRT2 - 1) * min(dx, dy))
+
+    dist = np.full(c.size, np.inf)
+    pred = np.full(c.size, -1, dtype=np.int32)
+    done = np.zeros(c.size, dtype=bool)
+
+    heap = []
+    for i in np.flatnonzero(np.asarray(start).ravel() & ~np.isnan(c)):
+        i = int(i)
+        dist[i] = 0.0
+        heap.append((estimate(i), 0.0, i))
+    heapq.heapify(heap)
+    pop, push = heapq.heappop, heapq.heappush
+    half = 0.5 * cell
+
+    while heap:
+        _, d, i = pop(heap)
+        if done[i]:
+            continue
+        if max_cost is not None and d > max_cost:
+            return None
+        done[i] = True
+
+        if goal_flat[i]:
+            return d, tracePath(pred, i)[::-1]
+
+        r, col = divmod(i, cols)
+        ci = c[i]
+        for dr, dc, f in NEIGHBOURS:
+            rr = r + dr
+            cc = col + dc
+            if rr < 0 or rr >= rows or cc < 0 or cc >= cols:
+                continue
+            j = rr * cols + cc
+            cj = c[j]
+            if done[j] or cj != cj:
+                continue
+            nd = d + (ci + cj) * half * f
+            if nd < dist[j]:
+                dist[j] = nd
+                pred[j] = i
+                push(heap, (nd + estimate(j), nd, j))
+    return None
+
+
+# Function to follow the back pointers from a cell to the region it came from
+# Returns the list of flat cell indices starting at the cell
+def tracePath(pred, i):
+    path = [int(i)]
+    while pred[i] >= 0:
+        i = pred[i]
+        path.append(int(i))
+    return path
+
+
+# Function to get the length in meters of a path of flat cell indices
+def pathLength(cells, cols, cell):
+    if len(cells) < 2:
+        return 0.0
+    r, c = np.divmod(np.asarray(cells, dtype=np.int64), cols)
+    diagonal = (np.diff(r) != 0) & (np.diff(c) != 0)
+    return float(cell * (np.count_nonzero(~diagonal) + SQRT2 * np.count_nonzero(diagonal)))
+
+
+#-------------------------------------------------------------------------------
+# Region connections
+#-------------------------------------------------------------------------------
+
+# Function to find the cheapest connection between every pair of touching regions
+# Uses the results of accumulate(), two neighbouring cells that belong to different
+# regions give a path of cost dist[a] + step + dist[b]
+# Returns a list of (cost, region1, region2, cell a, cell b) sorted by cost
+def candidateConnections(dist, alloc, cost, cell):
+    rows, cols = cost.shape
+    d = dist.reshape(rows, cols)
+    a = alloc.reshape(rows, cols)
+    c = np.asarray(cost, dtype=np.float64)
+    index = np.arange(rows * cols, dtype=np.int64).reshape(rows, cols)
+
+    keys, totals, cells_a, cells_b = [], [], [], []
+    # each pair of neighbours only has to be checked once (E, S, SE, SW)
+    for dr, dc, f in [(0, 1, 1.0), (1, 0, 1.0), (1, 1, SQRT2), (1, -1, SQRT2)]:
+        src = (slice(0, rows - dr), slice(max(-dc, 0), cols - max(dc, 0)))
+        dst = (slice(dr, rows), slice(max(dc, 0), cols - max(-dc, 0)))
+
+        la, lb = a[src], a[dst]
+        touch = (la > 0) & (lb > 0) & (la != lb)
+        if not touch.any():
+            continue
+
+        step = (c[src][touch] + c[dst][touch]) * 0.5 * cell * f
+        lo = np.minimum(la[touch], lb[touch]).astype(np.int64)
+        hi = np.maximum(la[touch], lb[touch]).astype(np.int64)
+        keys.append(lo << 32 | hi)
+        totals.append(d[src][touch] + step + d[dst][touch])
+        cells_a.append(index[src][touch])
+        cells_b.append(index[dst][touch])
+
+    if not keys:
+        return []
+
+    keys = np.concatenate(keys)
+    totals = np.concatenate(totals)
+    cells_a = np.concatenate(cells_a)
+    cells_b = np.concatenate(cells_b)
+
+    # keep the cheapest crossing for each pair of regions
+    order = np.lexsort((totals, keys))
+    first = np.ones(order.size, dtype=bool)
+    first[1:] = keys[order][1:] != keys[order][:-1]
+    best = order[first]
+    best = best[np.argsort(totals[best], kind="stable")]
+
+    return [(float(totals[k]), int(keys[k] >> 32), int(keys[k] & 0xFFFFFFFF),
+             int(cells_a[k]), int(cells_b[k])) for k in best]
+
+
+# Function to pick the connections that form a minimum spanning tree (Kruskal)
+# candidates is the sorted list from candidateConnections()
+def minimumSpanningTree(candidates):
+    parent = {}
+
+    def find(x):
+        parent.setdefault(x, x)
+        while parent[x] != x:
+            parent[x] = parent[parent[x]]
+            x = parent[x]
+        return x
+
+    tree = []
+    for candidate in candidates:
+        root1, root2 = find(candidate[1]), find(candidate[2])
+        if root1 != root2:
+            parent[root2] = root1
+            tree.append(candidate)
+    return tree
+
+
+# Function to connect the regions with least-cost corridors (like OptimalRegionConnections)
+# regions is an integer array of region ids (0 = not a region)
+# cost is the cost array, cell is the cell size
+# all_connections keeps every connection between touching regions instead of only the
+# minimum spanning tree
+# max_cost stops the search early, regions further apart than twice that cost aren't connected
+# Returns a list of Route
+def optimalRegionConnections(regions, cost, cell, all_connections=False, max_cost=None):
+    rows, cols = cost.shape
+    dist, alloc, pred = accumulate(cost, regions, cell, max_cost)
+
+    candidates = candidateConnections(dist, alloc, cost, cell)
+    if not all_connections:
+        candidates = minimumSpanningTree(candidates)
+
+    routes = []
+    for total, region1, region2, cell_a, cell_b in candidates:
+        # cell a is in the zone of one region and cell b in the other
+        path_a = tracePath(pred, cell_a)[::-1]
+        path_b = tracePath(pred, cell_b)
+        if alloc[cell_a] != region1:
+            path_a, path_b = path_b[::-1], path_a[::-1]
+        cells = path_a + path_b
+        routes.append(Route(region1, region2, total, pathLength(cells, cols, cell), cells))
+    return routes
+
+
+#-------------------------------------------------------------------------------
+# Pyramid (coarse to fine)
+#-------------------------------------------------------------------------------
+
+# Cost aggregations of the coarse grid
+# min never over-estimates the cost of a block, mean follows the cells more closely
+AGGREGATIONS = ("mean", "min")
+
+
+# Function to aggregate the cost array to blocks of factor x factor cells
+# NaN cells are left out, a block of only NaN cells is NaN
+def aggregateCost(cost, factor, aggregation="mean"):
+    rows, cols = cost.shape
+    out_rows, out_cols = -(-rows // factor), -(-cols // factor)
+    padded = np.full((out_rows * factor, out_cols * factor), np.nan, dtype=np.float32)
+    padded[:rows, :cols] = cost
+    blocks = padded.reshape(out_rows, factor, out_cols, factor)
+    valid = ~np.isnan(blocks)
+    counts = valid.sum(axis=(1, 3))
+
+    if aggregation == "min":
+        out = np.where(valid, blocks, np.inf).min(axis=(1, 3))
+    elif aggregation == "mean":
+        out = np.where(valid, blocks, 0).sum(axis=(1, 3), dtype=np.float64) / np.maximum(counts, 1)
+    else:
+        raise ValueError(f"Unknown aggregation {aggregation}, use one of {', '.join(AGGREGATIONS)}")
+    return np.where(counts > 0, out, np.nan).astype(np.float32)
+
+
+# Function to aggregate the region array to blocks of factor x factor cells
+# A block gets the highest region id of its cells (0 if it has none)
+def aggregateRegions(regions, factor):
+    rows, cols = regions.shape
+    out_rows, out_cols = -(-rows // factor), -(-cols // factor)
+    padded = np.zeros((out_rows * factor, out_cols * factor), dtype=np.int32)
+    padded[:rows, :cols] = regions
+    return padded.reshape(out_rows, factor, out_cols, factor).max(axis=(1, 3))
+
+
+# Function to get the cells within radius cells (square window) of a path
+# Returns (boolean band, (row0, row1, col0, col1) bounding box of the band)
+def pathBand(cells, shape, radius):
+    r, c = np.divmod(np.asarray(cells, dtype=np.int64), shape[1])
+    row0, row1 = max(r.min() - radius, 0), min(r.max() + radius + 1, shape[0])
+    col0, col1 = max(c.min() - radius, 0), min(c.max() + radius + 1, shape[1])
+
+    band = np.zeros((row1 - row0, col1 - col0), dtype=bool)
+    band[r - row0, c - col0] = True
+    # grow the path one cell at a time along the rows, then the columns
+    for axis in (0, 1):
+        grown = band.copy()
+        for step in range(1, radius + 1):
+            lead = [slice(None), slice(None)]
+            trail = [slice(None), slice(None)]
+            lead[axis], trail[axis] = slice(step, None), slice(None, -step)
+            grown[tuple(lead)] |= band[tuple(trail)]
+            grown[tuple(trail)] |= band[tuple(lead)]
+        band = grown
+    return band, (row0, row1, col0, col1)
+
+
+# Function to find the least-cost path between two regions inside a band of the fine grid
+# band is the boolean band of the coarse grid, box its bounding box (see pathBand)
+# Returns (cost, list of flat cell indices of the fine grid) or None if not reached
+def refinePath(regions, cost, cell, region1, region2, band, box, factor, heuristic_weight=1.0):
+    rows, cols = cost.shape
+    row0, row1 = box[0] * factor, min(box[1] * factor, rows)
+    col0, col1 = box[2] * factor, min(box[3] * factor, cols)
+    inside = np.repeat(np.repeat(band, factor, axis=0), factor, axis=1)[:row1 - row0, :col1 - col0]
+
+    window = np.where(inside, cost[row0:row1, col0:col1], np.nan)
+    labels = regions[row0:row1, col0:col1]
+    found = leastCostPath(window, inside & (labels == region1), inside & (labels == region2), cell, heuristic_weight)
+    if found is None:
+        return None
+
+    total, local = found
+    r, c = np.divmod(np.asarray(local, dtype=np.int64), col1 - col0)
+    return total, [int(i) for i in (r + row0) * cols + (c + col0)]
+
+
+# Function to connect the regions on a coarse grid first and refine each route at full
+# resolution inside a band around the coarse route
+# coarse_cell is the cell size of the coarse grid (e.g. 100 or 400 m), aggregation is
+# "mean" or "min" (see aggregateCost)
+# band_width is the distance in meters kept on each side of the coarse route, the band
+# is doubled until the refined path is found
+# The optimality traded away is set by band_width (the path can't leave the band) and
+# heuristic_weight (see leastCostPath, 1 is exact inside the band)
+# Regions smaller than a coarse cell can be hidden by a bigger neighbour in the same block
+# Returns a list of Route of the fine grid
+def pyramidRegionConnections(regions, cost, cell, coarse_cell=100, aggregation="mean", band_width=500,
+                             heuristic_weight=1.0, all_connections=False, max_cost=None):
+    factor = max(int(round(coarse_cell / cell)), 1)
+    coarse_cost = aggregateCost(cost, factor, aggregation)
+    coarse_regions = aggregateRegions(regions, factor)
+    print(f"Solving corridors on a {coarse_cost.shape[0]} x {coarse_cost.shape[1]} grid of {cell * factor} m cells...")
+    coarse = optimalRegionConnections(coarse_regions, coarse_cost, cell * factor, all_connections, max_cost)
+
+    routes = []
+    for route in coarse:
+        radius = max(int(math.ceil(band_width / (cell * factor))), 1)
+        while True:
+            band, box = pathBand(route.cells, coarse_cost.shape, radius)
+            found = refinePath(regions, cost, cell, route.region1, route.region2, band, box, factor,
+                               heuristic_weight)
+            whole_grid = box == (0, coarse_cost.shape[0], 0, coarse_cost.shape[1]) and band.all()
+            if found is not None or whole_grid:
+                break
+            radius *= 2
+
+        if found is None:
+            print(f"No path between regions {route.region1} and {route.region2} at {cell} m.")
+            continue
+        total, cells = found
+        routes.append(Route(route.region1, route.region2, total, pathLength(cells, cost.shape[1], cell), cells))
+    return routes
+
+
+#-------------------------------------------------------------------------------
+# arcpy input/output
+#-------------------------------------------------------------------------------
+
+# Function to save the routes as a polyline feature class with REGION1, REGION2 fields
+# routes is the list of Route, grid is the cost_engine.Grid of the cost array
+# out_fc is the output feature class path
+def writeRoutes(routes, grid, out_fc):
+    import arcpy
+
+    sr = None
+    if grid.spatial_reference:
+        sr = arcpy.SpatialReference()
+        sr.loadFromString(grid.spatial_reference)
+
+    out_path, out_name = os.path.split(out_fc)
+    arcpy.management.CreateFeatureclass(out_path, out_name, "POLYLINE", spatial_reference=sr)
+    arcpy.management.AddField(out_fc, "REGION1", "LONG")
+    arcpy.management.AddField(out_fc, "REGION2", "LONG")
+    arcpy.management.AddField(out_fc, "PATH_COST", "DOUBLE")
+
+    with arcpy.da.InsertCursor(out_fc, ["SHAPE@", "REGION1", "REGION2", "PATH_COST"]) as icursor:
+        for route in routes:
+            # cell centres, row 0 is the top of the grid
+            r, c = np.divmod(np.asarray(route.cells, dtype=np.int64), grid.cols)
+            xs = grid.x_min + (c + 0.5) * grid.cell
+            ys = grid.y_min + (grid.rows - r - 0.5) * grid.cell
+            line = arcpy.Polyline(arcpy.Array([arcpy.Point(x, y) for x, y in zip(xs, ys)]), sr)
+            icursor.insertRow([line, route.region1, route.region2, route.cost])
+    return out_fc
+
+
+# Function to run the corridor solver on the gdb data (same inputs as OptimalRegionConnections)
+# workspace is the output gdb, in_regions is the habitat feature class
+# out_fc is the name of the output routes, cost_raster is the Combined_Cost raster
+# pyramid is a dictionary of pyramidRegionConnections settings to solve coarse to fine
+# Returns the path of the routes feature class
+def optimalRegionConnectionsFromGDB(workspace, in_regions, out_fc, cost_raster, pyramid=None, **kwargs):
+    import arcpy
+    import cost_engine
+
+    grid = cost_engine.gridFromRaster(cost_raster)
+    with arcpy.EnvManager(workspace=workspace, extent=cost_raster, snapRaster=cost_raster,
+                          cellSize=grid.cell):
+        cost = cost_engine.readRaster(cost_raster, grid)
+        regions = cost_engine.featuresToArray(in_regions, "OBJECTID", grid)
+        regions = np.nan_to_num(regions, nan=0).astype(np.int32)
+
+        if pyramid:
+            routes = pyramidRegionConnections(regions, cost, grid.cell, **pyramid, **kwargs)
+        else:
+            routes = optimalRegionConnections(regions, cost, grid.cell, **kwargs)
+        print(f"Found {len(routes)} routes between {len(np.unique(regions)) - 1} regions.")
+        return writeRoutes(routes, grid, os.path.join(workspace, out_fc))
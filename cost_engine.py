@@ -0,0 +1,359 @@
+#-------------------------------------------------------------------------------
+# Name:        Cost Engine
+# Purpose:     NumPy version of the Cost Analysis block. Reads the input rasters
+#              once as aligned arrays and does the reclassify, rescale and
+#              weighted sum in memory, so no intermediate rasters are saved.
+#-------------------------------------------------------------------------------
+
+import os
+from collections import namedtuple
+
+import numpy as np
+
+import profiling
+
+
+#-------------------------------------------------------------------------------
+# Parameters (same values as the arcpy Cost Analysis block)
+#-------------------------------------------------------------------------------
+
+# Description of the grid that every array is aligned to
+# x_min, y_min is the lower left corner of the grid
+# cell is the cell size in meters, rows/cols the size of the arrays
+# spatial_reference is the coordinate system as a string (or None)
+Grid = namedtuple("Grid", ["x_min", "y_min", "cell", "rows", "cols", "spatial_reference"])
+
+# Order of the cost factors in the weighted sum
+FACTORS = ["Landcover", "Hydro", "Trails", "Road", "TerrainR"]
+
+# Landcover reclassification (LC_class: cost)
+LANDCOVER_REMAP = {
+    20: 10,
+    31: 8,
+    32: 7,
+    33: 6,
+    34: 10,
+    50: 3,
+    110: 2,
+    120: 9,
+    210: 1,
+    220: 1,
+    230: 1,
+}
+
+# RescaleByFunction "TfLarge" scales (from_scale, to_scale) for each factor
+RESCALE = {
+    "Hydro": (10, 1),     # small=1 / close is preferred
+    "Trails": (1, 10),    # large=1 / far away is preferred
+    "Road": (1, 10),      # large=1 / far away is preferred
+    "TerrainR": (10, 1),  # small=1 / low ruggedness is preferred
+}
+
+# WSTable weights (all weights are equal to 1)
+WEIGHTS = {"Landcover": 1, "Hydro": 1, "Trails": 1, "Road": 1, "TerrainR": 1}
+
+
+#-------------------------------------------------------------------------------
+# Array functions
+#-------------------------------------------------------------------------------
+
+# Function to reclassify an array with a remap table (like Reclassify)
+# values is the input array (NoData stored as NaN)
+# remap is a dictionary of {old value: new value}, keys can be strings like RemapValue
+# missing is "DATA" to keep values not in the remap or "NODATA" to set them to NoData
+def reclassify(values, remap, missing="DATA"):
+    old = np.array(sorted(float(k) for k in remap), dtype=np.float64)
+    lookup = {float(k): v for k, v in remap.items()}
+    new = np.array([lookup[k] for k in old], dtype=np.float32)
+
+    out = np.array(values, dtype=np.float32, copy=True)
+    if missing == "NODATA":
+        out[:] = np.nan
+
+    # find each value in the sorted remap keys
+    idx = np.clip(np.searchsorted(old, values), 0, len(old) - 1)
+    hit = old[idx] == values
+    out[hit] = new[idx[hit]]
+    return out
+
+
+# Function for the "TfLarge" transformation (large values are favoured)
+# values is the input array, midpoint and spread are the function parameters
+def tfLarge(values, midpoint, spread=5):
+    with np.errstate(divide="ignore", over="ignore", invalid="ignore"):
+        return 1.0 / (1.0 + np.power(midpoint / values, spread))
+
+
+# Function to rescale an array with the TfLarge function (like RescaleByFunction)
+# values is the input array (NoData stored as NaN)
+# from_scale, to_scale are the output scale (e.g. 10, 1)
+# lower, upper, midpoint default to the min, max and mean of the input like the tool,
+# they can be passed in when the statistics come from somewhere else (e.g. tiles)
+def rescaleByFunction(values, from_scale, to_scale, lower=None, upper=None, midpoint=None, spread=5):
+    if lower is None:
+        lower = float(np.nanmin(values))
+    if upper is None:
+        upper = float(np.nanmax(values))
+    if midpoint is None:
+        midpoint = float(np.nanmean(values))
+
+    f = tfLarge(np.clip(values, lower, upper), midpoint, spread)
+    f_lower = tfLarge(np.float64(lower), midpoint, spread)
+    f_upper = tfLarge(np.float64(upper), midpoint, spread)
+
+    # a flat input has nothing to rescale, everything gets the from scale
+    if f_upper == f_lower:
+        out = np.full(np.shape(values), from_scale, dtype=np.float32)
+    else:
+        out = from_scale + (f - f_lower) / (f_upper - f_lower) * (to_scale - from_scale)
+        out = out.astype(np.float32)
+    out[np.isnan(values)] = np.nan
+    return out
+
+
+# Function to compute the 3x3 focal range (like FocalStatistics RANGE)
+# NoData cells are ignored and the edges use the cells that are available
+def focalRange(dem):
+    rows, cols = dem.shape
+    padded = np.pad(dem.astype(np.float32), 1, constant_values=np.nan)
+
+    high = np.full((rows, cols), -np.inf, dtype=np.float32)
+    low = np.full((rows, cols), np.inf, dtype=np.float32)
+    for dy in range(3):
+        for dx in range(3):
+            window = padded[dy:dy + rows, dx:dx + cols]
+            np.fmax(high, window, out=high)
+            np.fmin(low, window, out=low)
+
+    out = high - low
+    out[np.isnan(dem)] = np.nan
+    return out
+
+
+# Function to compute the euclidean distance to the source cells (like DistanceAccumulation
+# without a cost surface), see distance_engine.py
+# sources is a boolean array (True where a feature is), cell is the cell size
+def euclideanDistance(sources, cell):
+    import distance_engine
+
+    if not sources.any():
+        raise ValueError("no source cells to compute the distance from")
+    return distance_engine.euclideanDistance(sources, cell)
+
+
+# Function to compute the weighted sum of the cost factors (like WeightedSum)
+# layers is a dictionary of {factor name: array}
+# weights is a dictionary of {factor name: weight}
+def weightedSum(layers, weights=WEIGHTS):
+    total = None
+    for name, layer in layers.items():
+        if total is None:
+            total = np.zeros(layer.shape, dtype=np.float32)
+        total += np.float32(weights[name]) * layer
+    return total
+
+
+# Function to compute a distance cost factor (distance then TfLarge rescale)
+# name is the factor name in rescale, sources is a boolean array of the source cells
+# rescale is a dictionary of {factor name: (from_scale, to_scale)}
+def distanceFactor(name, sources, cell, mask=None, rescale=RESCALE):
+    dist = euclideanDistance(sources, cell)
+    if mask is not None:
+        dist[~mask] = np.nan
+    return rescaleByFunction(dist, *rescale[name])
+
+
+# Function to compute the terrain ruggedness cost factor from the focal range
+def terrainFactor(terrain, mask=None, rescale=RESCALE):
+    if mask is not None:
+        terrain = np.where(mask, terrain, np.nan)
+    return rescaleByFunction(terrain, *rescale["TerrainR"])
+
+
+# Function to run the whole Cost Analysis block in one pass over the arrays
+# landcover is the LC_class array, dem is the elevation array
+# hydro, trails, road are boolean arrays of the source cells
+# cell is the cell size, mask is a boolean array of the study area (True inside)
+# Each factor is added to the sum as soon as it is computed so only one factor
+# is held in memory at a time
+def combinedCost(landcover, hydro, trails, road, dem, cell, mask=None,
+                 remap=LANDCOVER_REMAP, weights=WEIGHTS, rescale=RESCALE):
+    total = np.float32(weights["Landcover"]) * reclassify(landcover, remap)
+
+    for name, sources in (("Hydro", hydro), ("Trails", trails), ("Road", road)):
+        total += np.float32(weights[name]) * distanceFactor(name, sources, cell, mask, rescale)
+
+    total += np.float32(weights["TerrainR"]) * terrainFactor(focalRange(dem), mask, rescale)
+
+    if mask is not None:
+        total[~mask] = np.nan
+    return total
+
+
+#-------------------------------------------------------------------------------
+# arcpy input/output (only needed when reading from / writing to a gdb)
+#-------------------------------------------------------------------------------
+
+# Function to get the grid of an existing raster
+def gridFromRaster(in_raster):
+    import arcpy
+
+    desc = arcpy.Describe(in_raster)
+    ext = desc.extent
+    return Grid(ext.XMin, ext.YMin, desc.meanCellWidth, desc.height, desc.width,
+                desc.spatialReference.exportToString())
+
+
+# Function to read a raster into an array aligned to the grid (NoData as NaN)
+def readRaster(in_raster, grid):
+    import arcpy
+
+    raster = arcpy.Raster(in_raster)
+    corner = arcpy.Point(grid.x_min, grid.y_min)
+
+    # integer rasters can't hold NaN, read them with a placeholder value first
+    if raster.isInteger:
+        nodata = np.iinfo(np.int32).min
+        array = arcpy.RasterToNumPyArray(raster, corner, grid.cols, grid.rows, nodata_to_value=nodata)
+        out = array.astype(np.float32)
+        out[array == nodata] = np.nan
+        return out
+
+    array = arcpy.RasterToNumPyArray(raster, corner, grid.cols, grid.rows, nodata_to_value=np.nan)
+    return array.astype(np.float32)
+
+
+# Function to save an array as a raster (NaN, or the nodata value, is saved as NoData)
+# The pixel type comes from the array dtype
+def writeRaster(array, grid, out_raster, nodata=np.nan):
+    import arcpy
+
+    corner = arcpy.Point(grid.x_min, grid.y_min)
+    raster = arcpy.NumPyArrayToRaster(array, corner, grid.cell, grid.cell, value_to_nodata=nodata)
+    raster.save(out_raster)
+    if grid.spatial_reference:
+        sr = arcpy.SpatialReference()
+        sr.loadFromString(grid.spatial_reference)
+        arcpy.management.DefineProjection(out_raster, sr)
+    return out_raster
+
+
+# Function to convert features to an array aligned to the grid
+# The raster only lives in the memory workspace and is deleted after reading
+# in_features is the input feature class(es), value_field is the field to burn
+def featuresToArray(in_features, value_field, grid):
+    import arcpy
+
+    if isinstance(in_features, str):
+        in_features = [in_features]
+
+    out = np.full((grid.rows, grid.cols), np.nan, dtype=np.float32)
+    for fc in in_features:
+        temp = os.path.join("memory", f"{os.path.basename(fc)}_Ras")
+        arcpy.conversion.FeatureToRaster(fc, value_field, temp, grid.cell)
+        array = readRaster(temp, grid)
+        arcpy.management.Delete(temp)
+        out = np.where(np.isnan(out), array, out)
+    return out
+
+
+# Function to read the inputs from the gdb and compute the five cost factor arrays
+# workspace is the output gdb, study_area is the boundary feature class
+# dem_name is the elevation raster (sets the grid)
+# cache_dir turns on the raster_cache for the cost factors, sources is a dictionary of
+# {dataset name: original source file} used for the cache keys (a factor is only
+# cached when all of its sources are known)
+# rescale is the dictionary of RescaleByFunction scales (see RESCALE)
+# rasterizer_workers burns the features with the in-project rasterizer on that many
+# processes (see rasterizer.py) instead of FeatureToRaster, landcover is then remapped
+# during the burn
+# Returns (grid, mask, {factor name: array}, terrain ruggedness array)
+def factorLayersFromGDB(workspace, study_area, dem_name="ab_dem", remap=LANDCOVER_REMAP,
+                        cache_dir=None, sources=None, rescale=RESCALE, rasterizer_workers=None):
+    import arcpy
+    import distance_engine
+    import raster_cache
+
+    dem_path = os.path.join(workspace, dem_name)
+    grid = gridFromRaster(dem_path)
+    sources = sources or {}
+
+    # run a step through the cache if the source files of the step are known
+    def cached(step, params, names, compute):
+        with profiling.timed(step, "step"):
+            if cache_dir is None or not all(name in sources for name in names):
+                return compute()
+            params = dict(params, grid=grid._asdict())
+            return raster_cache.cached(cache_dir, step, params, [sources[name] for name in names], compute)
+
+    # features to an array, with FeatureToRaster or the in-project rasterizer
+    def burn(fcs, field, burn_remap=None):
+        if rasterizer_workers is None:
+            values = featuresToArray(fcs, field, grid)
+            return values if burn_remap is None else reclassify(values, burn_remap)
+        import rasterizer
+        return rasterizer.rasterizeFeatures(fcs, field, grid, burn_remap, workers=rasterizer_workers)
+
+    def presence(fcs):
+        return lambda: ~np.isnan(burn(fcs, "OBJECTID"))
+
+    # the two rasterizers can differ on edge cells, so they don't share cache entries
+    burn_params = {"rasterizer": "numpy"} if rasterizer_workers is not None else {}
+
+    with arcpy.EnvManager(workspace=workspace, extent=dem_path, snapRaster=dem_path,
+                          cellSize=grid.cell, outputCoordinateSystem=dem_path):
+        print("Reading rasters into arrays...")
+        mask = cached("Mask", burn_params, [study_area], presence(study_area))
+
+        layers = {}
+        layers["Landcover"] = cached("Landcover", dict(burn_params, remap=remap), ["AB_Landcover"],
+                                     lambda: burn("AB_Landcover", "LC_class", remap))
+
+        # the three distance factors share one label grid and one distance transform pass
+        print("Computing Hydro, Trails and Road factors...")
+        distance_sources = {"Hydro": ["Hydro"], "Trails": ["Trails"], "Road": ["Road", "Transportation"]}
+
+        def distanceLayers():
+            labels = distance_engine.labelGrid({name: presence(fcs)() for name, fcs in distance_sources.items()})
+            factors = distance_engine.distanceFactors(labels, grid.cell, mask, list(distance_sources), rescale=rescale)
+            return np.stack([factors[name] for name in distance_sources])
+
+        params = dict(burn_params, function="TfLarge", scale={name: rescale[name] for name in distance_sources})
+        names = [fc for fcs in distance_sources.values() for fc in fcs] + [study_area]
+        layers.update(zip(distance_sources, cached("Distance", params, names, distanceLayers)))
+
+        print("Computing TerrainR factor...")
+        terrain = cached("TerrainR", {"statistics": "RANGE", "window": 3}, [dem_name],
+                         lambda: focalRange(readRaster(dem_path, grid)))
+        layers["TerrainR"] = terrainFactor(terrain, mask, rescale)
+
+    return grid, mask, layers, terrain
+
+
+# Function to run the Cost Analysis from the gdb and save only the Combined_Cost raster
+# (see factorLayersFromGDB for the parameters)
+# stack_path also saves the factors as a factor stack (see factor_stack.py)
+# Returns the path of the saved Combined_Cost raster
+def combinedCostFromGDB(workspace, study_area, dem_name="ab_dem", out_name="Combined_Cost",
+                        terrain_name="TerrainR", remap=LANDCOVER_REMAP, weights=WEIGHTS,
+                        cache_dir=None, sources=None, rescale=RESCALE, stack_path=None, rasterizer_workers=None):
+    grid, mask, layers, terrain = factorLayersFromGDB(workspace, study_area, dem_name, remap, cache_dir, sources, rescale,
+                                                      rasterizer_workers)
+
+    if stack_path:
+        import factor_stack
+
+        print("Saving the factor stack...")
+        with profiling.timed("Save factor stack", "step"):
+            factor_stack.writeStack(stack_path, layers, grid, mask)
+
+    print("Computing combined cost...")
+    with profiling.timed("Weighted sum", "step"):
+        cost = weightedSum(layers, weights)
+        cost[~mask] = np.nan
+
+    print("Saving raster...")
+    with profiling.timed("Save rasters", "step"):
+        if terrain_name:
+            writeRaster(np.where(mask, terrain, np.nan), grid, os.path.join(workspace, terrain_name))
+        return writeRaster(cost, grid, os.path.join(workspace, out_name))
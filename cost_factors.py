@@ -0,0 +1,155 @@
+#-------------------------------------------------------------------------------
+# Name:        Cost Factors
+# Purpose:     The arcpy cost factor branches (Landcover, Hydrology, Trails, Roads,
+#              Terrain Ruggedness) as separate functions so they can run at the
+#              same time. Each branch reads from the output gdb and writes only to
+#              its own scratch gdb, the results are joined at the WeightedSum.
+#-------------------------------------------------------------------------------
+
+import os
+
+import arcpy
+from arcpy.sa import *
+
+
+# Function to print out the first and last message from a Function Tool
+def messages():
+    print(arcpy.GetMessage(0)) # print first message of tool
+    count = (arcpy.GetMessageCount())
+    print(arcpy.GetMessage(count-1)) # print last message of tool
+    print()
+
+
+# Function to set up a worker process (overwrite outputs and the Spatial extension)
+def initWorker():
+    arcpy.env.overwriteOutput = True
+    arcpy.CheckOutExtension("Spatial")
+
+
+# Function to create the scratch gdb of one branch
+# scratch_folder is the folder that holds all the branch gdbs, name is the branch name
+# Returns the path of the gdb
+def createBranchGDB(scratch_folder, name):
+    os.makedirs(scratch_folder, exist_ok=True)
+    gdb_name = f"Scratch_{name}.gdb"
+    gdb_path = os.path.join(scratch_folder, gdb_name)
+    if arcpy.Exists(gdb_path):
+        arcpy.management.Delete(gdb_path)
+    arcpy.management.CreateFileGDB(scratch_folder, gdb_name)
+    return gdb_path
+
+
+# Function to set the environments shared by the distance and terrain branches
+# workspace is the output gdb, gdb_path is the branch scratch gdb
+def setBranchEnv(workspace, gdb_path, cell, study_area):
+    study_area_path = os.path.join(workspace, study_area)
+    arcpy.env.workspace = workspace
+    arcpy.env.scratchWorkspace = gdb_path
+    arcpy.env.extent = study_area_path # makes sure the rasters cover the whole boundary extent
+    arcpy.env.mask = study_area_path # makes sure the rasters don't extend beyond the boundary
+    arcpy.env.cellSize = cell # makes sure the rasters are outputted in this cell size
+
+
+#-------------------------------------------------------------------------------
+# Landcover - Characteristics of the area being traversed (shp)
+# workspace is the output gdb, scratch_folder holds the branch gdbs
+# remap is the RemapValue list of [LC_class, cost]
+# Returns a dictionary of the outputs
+def landcoverFactor(workspace, scratch_folder, cell, remap):
+    gdb_path = createBranchGDB(scratch_folder, "Landcover")
+    arcpy.env.workspace = workspace
+    arcpy.env.scratchWorkspace = gdb_path
+
+    print("Processing Landcover:")
+    print("Converting from polygon to raster...")
+    out_rasterdataset = os.path.join(gdb_path, "AB_Landcover_Ras")
+    arcpy.conversion.PolygonToRaster("AB_Landcover", "LC_class", out_rasterdataset, cellsize=cell)
+    messages()
+
+    # Apply reclassification
+    print("Reclassifying...")
+    landcover_reclass = Reclassify(arcpy.Raster(out_rasterdataset), "VALUE", RemapValue(remap), "DATA")
+    messages()
+
+    print("Saving raster...")
+    out_raster = os.path.join(gdb_path, "AB_Landcover_Reclass")
+    landcover_reclass.save(out_raster)
+    messages()
+
+    print(f"Deleting {out_rasterdataset}...")
+    arcpy.management.Delete(out_rasterdataset)
+    messages()
+
+    return {"Landcover": out_raster}
+
+
+#-------------------------------------------------------------------------------
+# Hydrology, Trails, Roads
+# - Use Distance Accumulation tool (outputs a continuous raster)
+# - Use the Rescale by Function tool to apply a continuous cost value between 0-10
+# name is the factor name, sources is the feature class(es) to measure the distance from
+# (more than one feature class is merged first)
+# from_scale, to_scale are the RescaleByFunction scales
+# Returns a dictionary of the outputs
+def distanceFactor(workspace, scratch_folder, cell, study_area, name, sources, from_scale, to_scale):
+    gdb_path = createBranchGDB(scratch_folder, name)
+    setBranchEnv(workspace, gdb_path, cell, study_area)
+
+    print(f"Processing {name}:")
+    if isinstance(sources, (list, tuple)):
+        print(f"Merging {' with '.join(sources)}...")
+        sources = arcpy.management.Merge(sources, os.path.join(gdb_path, f"{name}_Merged"))
+        messages()
+
+    print("Computing Distance Accumulation...")
+    dist = DistanceAccumulation(sources)
+    messages()
+
+    print("Rescale by Function...")
+    rescale = RescaleByFunction(dist, "TfLarge", from_scale, to_scale)
+    messages()
+
+    print("Saving raster...")
+    out_raster = os.path.join(gdb_path, f"{name}_Rescaled")
+    rescale.save(out_raster)
+    messages()
+
+    print(f"Deleting {name} Dist...")
+    arcpy.management.Delete(dist)
+    messages()
+
+    return {name: out_raster}
+
+
+#-------------------------------------------------------------------------------
+# Terrain Ruggedness (dem) - (avoid rugged terrain)
+# Returns a dictionary of the outputs (TerrainR is kept as a final output)
+# from_scale, to_scale are the RescaleByFunction scales
+def terrainFactor(workspace, scratch_folder, cell, study_area, dem_name="ab_dem", from_scale=10, to_scale=1):
+    gdb_path = createBranchGDB(scratch_folder, "TerrainR")
+    setBranchEnv(workspace, gdb_path, cell, study_area)
+
+    print("Processing DEM to get Terrain ruggedness: ")
+    dem = arcpy.Raster(os.path.join(workspace, dem_name))
+
+    # Generate the terrain ruggedness
+    print("Computing Focal Statistics...")
+    terrainRug = FocalStatistics(dem, NbrRectangle(3,3,"CELL"), "RANGE")
+    messages()
+
+    print("Saving raster...")
+    terrain_raster = os.path.join(gdb_path, "TerrainR")
+    terrainRug.save(terrain_raster)
+    messages()
+
+    # Use the Rescale By Function to assign the classes to the continuous rasters
+    print("Rescale by Function...")
+    terrainRug_rescale = RescaleByFunction(terrainRug, "TfLarge", from_scale, to_scale) # small=1 / low ruggedness is preferred
+    messages()
+
+    print("Saving raster...")
+    out_raster = os.path.join(gdb_path, "TerrainR_Rescaled")
+    terrainRug_rescale.save(out_raster)
+    messages()
+
+    return {"TerrainR": out_raster, "TerrainR_Focal": terrain_raster}
@@ -0,0 +1,130 @@
+#-------------------------------------------------------------------------------
+# Name:        Distance Engine
+# Purpose:     Exact euclidean distance transform in linear time (Felzenszwalb &
+#              Huttenlocher lower envelope of parabolas, one pass down the columns
+#              and one along the rows). Hydro, Trails and Road_Merged are burned
+#              once into a shared label grid and their three distance fields are
+#              computed together in one multi-label pass, then rescaled with TfLarge.
+#-------------------------------------------------------------------------------
+
+import numpy as np
+
+import cost_engine
+
+
+# Bits of the shared label grid (a cell can be a source for more than one factor)
+LABELS = {"Hydro": 1, "Trails": 2, "Road": 4}
+
+# Stand-in for "no source" in the squared distances (keeps the envelope maths finite)
+FAR = 1e30
+
+
+#-------------------------------------------------------------------------------
+# Distance transform
+#-------------------------------------------------------------------------------
+
+# Function to compute the 1D squared distance transform of many lines at once
+# f is a (lines x n) array of squared distances (0 at sources, FAR elsewhere)
+# Every line keeps its own lower envelope of parabolas, the lines are processed
+# together one position at a time
+def squaredDistance1D(f):
+    lines, n = f.shape
+    rows = np.arange(lines)
+    positions = np.arange(n, dtype=np.float64)
+
+    v = np.zeros((lines, n), dtype=np.int32) # positions of the parabolas in the envelope
+    z = np.empty((lines, n + 1)) # boundaries between the parabolas
+    z[:, 0] = -np.inf
+    z[:, 1] = np.inf
+    k = np.zeros(lines, dtype=np.int64) # index of the last parabola of each line
+
+    # intersection of the parabola at q with the parabola at v[k]
+    def intersect(sel, q):
+        p = v[sel, k[sel]]
+        return ((f[sel, q] + q * q) - (f[sel, p] + positions[p] ** 2)) / (2 * q - 2 * p)
+
+    for q in range(1, n):
+        s = intersect(rows, q)
+        pop = np.flatnonzero(s <= z[rows, k])
+        while pop.size:
+            # drop the last parabola of these lines, it's hidden by the new one
+            k[pop] -= 1
+            s[pop] = intersect(pop, q)
+            pop = pop[s[pop] <= z[pop, k[pop]]]
+        k += 1
+        v[rows, k] = q
+        z[rows, k] = s
+        z[rows, k + 1] = np.inf
+
+    out = np.empty_like(f)
+    k[:] = 0
+    for q in range(n):
+        move = np.flatnonzero(z[rows, k + 1] < q)
+        while move.size:
+            k[move] += 1
+            move = move[z[move, k[move] + 1] < q]
+        p = v[rows, k]
+        out[:, q] = (q - p) ** 2 + f[rows, p]
+    return out
+
+
+# Function to run the 1D transform along one axis of an array, a chunk of lines at a time
+def transformAxis(f, axis, chunk_lines):
+    moved = np.moveaxis(f, axis, -1)
+    shape = moved.shape
+    lines = moved.reshape(-1, shape[-1])
+    out = np.empty_like(lines)
+    for first in range(0, lines.shape[0], chunk_lines):
+        out[first:first + chunk_lines] = squaredDistance1D(np.ascontiguousarray(lines[first:first + chunk_lines]))
+    return np.moveaxis(out.reshape(shape), -1, axis)
+
+
+# Function to compute the exact euclidean distance to the source cells
+# sources is a boolean array (rows x cols) or a stack of them (labels x rows x cols),
+# a stack is transformed in the same pass
+# cell is the cell size, chunk_lines limits how many lines are in memory at once
+def euclideanDistance(sources, cell, chunk_lines=4096):
+    f = np.where(sources, 0.0, FAR)
+    f = transformAxis(f, f.ndim - 2, chunk_lines) # down the columns
+    f = transformAxis(f, f.ndim - 1, chunk_lines) # along the rows
+
+    out = np.sqrt(f) * cell
+    out[f >= FAR / 2] = np.inf # no source in the grid
+    return out.astype(np.float32)
+
+
+#-------------------------------------------------------------------------------
+# Shared label grid
+#-------------------------------------------------------------------------------
+
+# Function to burn the source layers into one label grid
+# layers is a dictionary of {factor name: boolean array}
+def labelGrid(layers):
+    labels = None
+    for name, sources in layers.items():
+        if labels is None:
+            labels = np.zeros(sources.shape, dtype=np.uint8)
+        labels[sources] |= LABELS[name]
+    return labels
+
+
+# Function to compute the distance factors (distance then TfLarge rescale) of every
+# label in one multi-label pass
+# labels is the label grid, names are the factors to compute, mask is the study area
+# rescale is the dictionary of RescaleByFunction scales (see cost_engine.RESCALE)
+# Returns a dictionary of {factor name: rescaled array}
+def distanceFactors(labels, cell, mask=None, names=("Hydro", "Trails", "Road"), chunk_lines=4096,
+                    rescale=cost_engine.RESCALE):
+    stack = np.stack([(labels & LABELS[name]) > 0 for name in names])
+    for name, sources in zip(names, stack):
+        if not sources.any():
+            raise ValueError(f"no source cells to compute the {name} distance from")
+
+    distances = euclideanDistance(stack, cell, chunk_lines)
+
+    factors = {}
+    for name, dist in zip(names, distances):
+        if mask is not None:
+            dist[~mask] = np.nan
+        factors[name] = cost_engine.rescaleByFunction(dist, *rescale[name])
+    return factors
@@ -0,0 +1,175 @@
+#-------------------------------------------------------------------------------
+# Name:        Factor Stack
+# Purpose:     Saves the cost factors as one aligned multi-band file instead of a
+#              raster per factor. The stack is a folder with a header (grid,
+#              band names, chunk size), the bands as one memory-mapped .npy array
+#              (bands x rows x cols) and the study area mask. Opening the stack
+#              maps it without reading it, so a stage only reads the windows it
+#              uses and worker processes share one copy through the page cache.
+#-------------------------------------------------------------------------------
+
+import json
+import os
+from collections import namedtuple
+
+import numpy as np
+
+import cost_engine
+import tiling
+
+
+# An opened factor stack
+# path is the stack folder, grid is the cost_engine.Grid of every band
+# names is the list of band names, bands is the (bands x rows x cols) memmap
+# mask is the (rows x cols) study area memmap, chunk is the window size in cells
+Stack = namedtuple("Stack", ["path", "grid", "names", "bands", "mask", "chunk"])
+
+# Version of the stack format (saved in the header)
+VERSION = 1
+
+# Files of a stack folder
+HEADER = "header.json"
+BANDS = "bands.npy"
+MASK = "mask.npy"
+
+
+# Function to get the header path of a stack (written last, so it marks a complete stack)
+def headerPath(path):
+    return os.path.join(path, HEADER)
+
+
+#-------------------------------------------------------------------------------
+# Export / import
+#-------------------------------------------------------------------------------
+
+# Function to create an empty stack to fill window by window
+# names is the list of band names, grid the cost_engine.Grid of the study area
+# mask is the study area array or memmap (True inside)
+# chunk is the window size used to write and read the stack
+# Returns a writable Stack, call finishStack when the bands are written
+def createStack(path, names, grid, mask, chunk=1024):
+    os.makedirs(path, exist_ok=True)
+    # an old header would describe a stack that is being overwritten
+    if os.path.exists(headerPath(path)):
+        os.remove(headerPath(path))
+
+    shape = (grid.rows, grid.cols)
+    bands = np.lib.format.open_memmap(os.path.join(path, BANDS), mode="w+", dtype=np.float32,
+                                      shape=(len(names),) + shape)
+    out_mask = np.lib.format.open_memmap(os.path.join(path, MASK), mode="w+", dtype=bool, shape=shape)
+    for row0 in range(0, shape[0], chunk):
+        out_mask[row0:row0 + chunk] = np.asarray(mask[row0:row0 + chunk], dtype=bool)
+    return Stack(path, grid, list(names), bands, out_mask, chunk)
+
+
+# Function to flush a stack created by createStack and write its header
+def finishStack(stack):
+    stack.bands.flush()
+    stack.mask.flush()
+    header = {
+        "version": VERSION,
+        "grid": stack.grid._asdict(),
+        "names": stack.names,
+        "chunk": stack.chunk,
+        "dtype": "float32",
+        "nodata": "nan",
+    }
+    with open(headerPath(stack.path) + ".tmp", "w") as f:
+        json.dump(header, f, indent=2)
+    os.replace(headerPath(stack.path) + ".tmp", headerPath(stack.path))
+    return stack.path
+
+
+# Function to save a dictionary of factor arrays as a stack
+# layers is {band name: array}, the bands are saved in cost_engine.FACTORS order
+# (then any other layers), cells outside the mask are saved as NaN
+# Returns the stack folder
+def writeStack(path, layers, grid, mask, chunk=1024):
+    names = [name for name in cost_engine.FACTORS if name in layers]
+    names += [name for name in layers if name not in names]
+    stack = createStack(path, names, grid, mask, chunk)
+    for n, name in enumerate(names):
+        for row0 in range(0, grid.rows, chunk):
+            rows = slice(row0, row0 + chunk)
+            stack.bands[n, rows] = np.where(stack.mask[rows], layers[name][rows], np.nan)
+    return finishStack(stack)
+
+
+# Function to open a stack (nothing is read until a window is used)
+# mode "r" is read-only, "r+" lets a stage update the bands in place
+def openStack(path, mode="r"):
+    with open(headerPath(path)) as f:
+        header = json.load(f)
+    if header["version"] != VERSION:
+        raise ValueError(f"{path} is a version {header['version']} factor stack, expected version {VERSION}")
+
+    grid = cost_engine.Grid(**header["grid"])
+    bands = tiling.openMemmap(os.path.join(path, BANDS), mode)
+    mask = tiling.openMemmap(os.path.join(path, MASK), mode)
+    if bands.shape != (len(header["names"]), grid.rows, grid.cols) or mask.shape != (grid.rows, grid.cols):
+        raise ValueError(f"{path} doesn't match its header, export the stack again")
+    return Stack(path, grid, header["names"], bands, mask, header["chunk"])
+
+
+#-------------------------------------------------------------------------------
+# Windows
+#-------------------------------------------------------------------------------
+
+# Function to get one band of a stack (a view of the memmap, nothing is copied)
+def band(stack, name):
+    return stack.bands[stack.names.index(name)]
+
+
+# Function to get the five cost factors in cost_engine.FACTORS order
+# (factors x rows x cols), a view when the stack has them in that order
+def factorBands(stack):
+    index = [stack.names.index(name) for name in cost_engine.FACTORS]
+    if index == list(range(len(index))):
+        return stack.bands[:len(index)]
+    return stack.bands[index]
+
+
+# Function to get a window of some bands (names, all bands by default)
+# Returns a (bands x rows x cols) view of the memmap
+def readWindow(stack, row0, row1, col0, col1, names=None):
+    if names is None:
+        return stack.bands[:, row0:row1, col0:col1]
+    index = [stack.names.index(name) for name in names]
+    return stack.bands[index, row0:row1, col0:col1]
+
+
+# Function to loop over the stack in windows of the chunk size
+# halo is the overlap around each window (see tiling.iterTiles)
+# Yields (tile, window of the bands, window of the mask)
+def iterWindows(stack, halo=0, names=None):
+    for tile in tiling.iterTiles(stack.grid.rows, stack.grid.cols, stack.chunk, halo):
+        window = readWindow(stack, tile.halo_row0, tile.halo_row1, tile.halo_col0, tile.halo_col1, names)
+        yield tile, window, tiling.readWindow(stack.mask, tile)
+
+
+# Function to compute the combined cost of a stack window by window
+# out is an array or memmap for the result (a new array by default)
+def combinedCost(stack, weights=cost_engine.WEIGHTS, out=None):
+    if out is None:
+        out = np.empty((stack.grid.rows, stack.grid.cols), dtype=np.float32)
+    factors = factorBands(stack)
+    w = np.array([weights[name] for name in cost_engine.FACTORS], dtype=np.float32)
+    for tile in tiling.iterTiles(stack.grid.rows, stack.grid.cols, stack.chunk):
+        core = (slice(tile.row0, tile.row1), slice(tile.col0, tile.col1))
+        out[core] = np.tensordot(w, factors[(slice(None),) + core], axes=(0, 0))
+    return out
+
+
+#-------------------------------------------------------------------------------
+# arcpy input
+#-------------------------------------------------------------------------------
+
+# Function to export the cost factors of the gdb to a stack
+# (see cost_engine.factorLayersFromGDB for the parameters)
+# Returns the stack folder
+def exportStackFromGDB(workspace, study_area, path, dem_name="ab_dem", remap=cost_engine.LANDCOVER_REMAP,
+                       cache_dir=None, sources=None, rescale=cost_engine.RESCALE, chunk=1024):
+    grid, mask, layers, _ = cost_engine.factorLayersFromGDB(workspace, study_area, dem_name, remap, cache_dir,
+                                                            sources, rescale)
+    print(f"Saving the factor stack to {path}...")
+    return writeStack(path, layers, grid, mask, chunk)
@@ -0,0 +1,226 @@
+#-------------------------------------------------------------------------------
+# Name:        Focal Engine
+# Purpose:     Terrain ruggedness at several window sizes in one pass over the DEM.
+#              Moving-window range uses separable sliding min/max (van Herk /
+#              Gil-Werman), std, TRI and VRM use integral images, so the cost per
+#              cell is the same for a 3x3 and a 15x15 window. The DEM is split
+#              into bands of rows (with a halo) that can run on several cores.
+#-------------------------------------------------------------------------------
+
+import os
+
+import numpy as np
+
+import task_runner
+import tiling
+
+
+# Statistics of the focal engine and the raster name of each one (<name>_<size>)
+STATISTICS = {"range": "Range", "std": "Std", "tri": "TRI", "vrm": "VRM"}
+
+# Window sizes in cells (odd, square windows)
+SIZES = [3, 5, 9, 15]
+
+
+#-------------------------------------------------------------------------------
+# Kernels
+#-------------------------------------------------------------------------------
+
+# Function to get the moving maximum along one axis (van Herk / Gil-Werman)
+# values must have no NaN (use -inf for NoData), size is the odd window size
+# The window is centred on each cell and cut at the edges
+# Each cell costs 3 comparisons whatever the window size
+def slidingMax(values, size, axis):
+    values = np.moveaxis(values, axis, -1)
+    n = values.shape[-1]
+    half = size // 2
+    blocks = -(-(n + 2 * half) // size)
+
+    padded = np.full(values.shape[:-1] + (blocks * size,), -np.inf, dtype=values.dtype)
+    padded[..., half:half + n] = values
+    split = padded.reshape(values.shape[:-1] + (blocks, size))
+
+    # running max from the start (g) and from the end (h) of each block
+    g = np.maximum.accumulate(split, axis=-1).reshape(padded.shape)
+    h = np.maximum.accumulate(split[..., ::-1], axis=-1)[..., ::-1].reshape(padded.shape)
+    out = np.maximum(h[..., :n], g[..., size - 1:size - 1 + n])
+    return np.moveaxis(out, -1, axis)
+
+
+# Function to get the focal min and max of a window size (NoData cells are ignored)
+# Returns (low, high), NaN where the window has no data
+def focalMinMax(dem, size):
+    missing = np.isnan(dem)
+    high = np.where(missing, -np.inf, dem)
+    high = slidingMax(slidingMax(high, size, 0), size, 1)
+    low = np.where(missing, -np.inf, -dem)
+    low = -slidingMax(slidingMax(low, size, 0), size, 1)
+    empty = np.isinf(high)
+    high[empty] = np.nan
+    low[empty] = np.nan
+    return low, high
+
+
+# Function to get the integral image of an array (a row and a column of zeros first)
+def integralImage(values):
+    out = np.zeros((values.shape[0] + 1, values.shape[1] + 1), dtype=np.float64)
+    np.cumsum(np.cumsum(values, axis=0, dtype=np.float64), axis=1, out=out[1:, 1:])
+    return out
+
+
+# Function to get the sum of a centred window of every cell from an integral image
+# shape is the shape of the array the integral image was made from
+def boxSum(integral, shape, size):
+    rows, cols = shape
+    half = size // 2
+    r0 = np.clip(np.arange(rows) - half, 0, rows)[:, None]
+    r1 = np.clip(np.arange(rows) + half + 1, 0, rows)[:, None]
+    c0 = np.clip(np.arange(cols) - half, 0, cols)[None, :]
+    c1 = np.clip(np.arange(cols) + half + 1, 0, cols)[None, :]
+    return integral[r1, c1] - integral[r0, c1] - integral[r1, c0] + integral[r0, c0]
+
+
+# Function to get the unit normal of the surface of every cell (Horn's method)
+# Returns (x, y, z) arrays, NaN where a cell of the 3x3 window is NoData
+def surfaceNormals(dem, cell):
+    p = np.pad(dem.astype(np.float64), 1, constant_values=np.nan)
+    rows, cols = dem.shape
+
+    def at(dy, dx):
+        return p[1 + dy:1 + dy + rows, 1 + dx:1 + dx + cols]
+
+    dz_dx = ((at(-1, 1) + 2 * at(0, 1) + at(1, 1)) - (at(-1, -1) + 2 * at(0, -1) + at(1, -1))) / (8 * cell)
+    dz_dy = ((at(1, -1) + 2 * at(1, 0) + at(1, 1)) - (at(-1, -1) + 2 * at(-1, 0) + at(-1, 1))) / (8 * cell)
+    norm = np.sqrt(dz_dx * dz_dx + dz_dy * dz_dy + 1)
+    return -dz_dx / norm, -dz_dy / norm, 1 / norm
+
+
+# Function to compute the focal statistics of a DEM window for every window size
+# dem is a 2D array (NaN is NoData), sizes is a list of odd window sizes
+# statistics is a list of STATISTICS keys, cell is the cell size
+# range is max - min, std is the standard deviation of the window, tri is
+# sqrt(sum of (z - z centre)^2) over the window (Riley et al. for 3x3) and vrm is
+# 1 - |sum of the unit normals| / count (Sappington et al.)
+# Returns a dictionary of {(statistic, size): float32 array}
+def focalStatistics(dem, sizes=SIZES, statistics=tuple(STATISTICS), cell=25):
+    dem = np.asarray(dem, dtype=np.float32)
+    valid = ~np.isnan(dem)
+    out = {}
+
+    if "range" in statistics:
+        for size in sizes:
+            low, high = focalMinMax(dem, size)
+            out[("range", size)] = high - low
+
+    if "std" in statistics or "tri" in statistics:
+        # centre the values first so the sums of squares keep their precision
+        offset = float(np.nanmean(dem)) if valid.any() else 0.0
+        z = np.where(valid, dem - offset, 0).astype(np.float64)
+        counts = integralImage(valid)
+        sums = integralImage(z)
+        squares = integralImage(z * z)
+        for size in sizes:
+            n = boxSum(counts, dem.shape, size)
+            s1 = boxSum(sums, dem.shape, size)
+            s2 = boxSum(squares, dem.shape, size)
+            with np.errstate(invalid="ignore", divide="ignore"):
+                if "std" in statistics:
+                    mean = s1 / n
+                    out[("std", size)] = np.sqrt(np.maximum(s2 / n - mean * mean, 0))
+                if "tri" in statistics:
+                    out[("tri", size)] = np.sqrt(np.maximum(s2 - 2 * z * s1 + n * z * z, 0))
+
+    if "vrm" in statistics:
+        normals = surfaceNormals(dem, cell)
+        has_normal = ~np.isnan(normals[0])
+        counts = integralImage(has_normal)
+        parts = [integralImage(np.where(has_normal, part, 0)) for part in normals]
+        for size in sizes:
+            n = boxSum(counts, dem.shape, size)
+            x, y, z = (boxSum(part, dem.shape, size) for part in parts)
+            with np.errstate(invalid="ignore", divide="ignore"):
+                out[("vrm", size)] = 1 - np.sqrt(x * x + y * y + z * z) / n
+
+    for key in out:
+        out[key] = out[key].astype(np.float32)
+        out[key][~valid] = np.nan
+    return out
+
+
+#-------------------------------------------------------------------------------
+# Chunks
+#-------------------------------------------------------------------------------
+
+# Function to get the halo in cells that makes a chunk exact for the largest window
+# (VRM also needs the 3x3 window of the normals)
+def focalHalo(sizes, statistics):
+    return max(sizes) // 2 + (1 if "vrm" in statistics else 0)
+
+
+# Function to get the file name of one output memmap
+def outputName(statistic, size):
+    return f"{STATISTICS[statistic]}_{size}"
+
+
+# Function to compute the focal statistics of one band of rows into the output memmaps
+# (a task of tiledFocalStatistics, it opens the memmaps itself so it can run in a worker)
+def focalTask(dem_path, out_dir, row0, row1, sizes, statistics, cell):
+    dem = tiling.openMemmap(dem_path)
+    halo = focalHalo(sizes, statistics)
+    top, bottom = max(row0 - halo, 0), min(row1 + halo, dem.shape[0])
+
+    results = focalStatistics(np.asarray(dem[top:bottom]), sizes, statistics, cell)
+    for (statistic, size), values in results.items():
+        out = tiling.openMemmap(os.path.join(out_dir, f"{outputName(statistic, size)}.npy"), "r+")
+        out[row0:row1] = values[row0 - top:row0 - top + row1 - row0]
+        out.flush()
+    return row1 - row0
+
+
+# Function to compute the focal statistics of a DEM band by band of rows
+# dem_path is the DEM as a .npy file, out_dir gets one memmap per statistic and size
+# chunk_rows is the height of a band, workers the number of processes
+# Returns a dictionary of {(statistic, size): memmap}
+def tiledFocalStatistics(dem_path, out_dir, sizes=SIZES, statistics=tuple(STATISTICS), cell=25,
+                         chunk_rows=1024, workers=1):
+    os.makedirs(out_dir, exist_ok=True)
+    shape = tiling.openMemmap(dem_path).shape
+    paths = {}
+    for statistic in statistics:
+        for size in sizes:
+            paths[(statistic, size)] = os.path.join(out_dir, f"{outputName(statistic, size)}.npy")
+            tiling.createMemmap(paths[(statistic, size)], shape).flush()
+
+    tasks = [task_runner.task(f"Rows {row0}-{min(row0 + chunk_rows, shape[0])}", focalTask, dem_path, out_dir,
+                              row0, min(row0 + chunk_rows, shape[0]), list(sizes), list(statistics), cell)
+             for row0 in range(0, shape[0], chunk_rows)]
+    task_runner.runTasks(tasks, workers)
+    return {key: tiling.openMemmap(path) for key, path in paths.items()}
+
+
+#-------------------------------------------------------------------------------
+# arcpy input/output
+#-------------------------------------------------------------------------------
+
+# Function to compute the terrain statistics of the DEM in the gdb and save them as
+# rasters (<Statistic>_<size>, e.g. Range_9, VRM_15)
+# work_dir holds the DEM and the outputs as memmaps while they're computed
+# Returns the list of saved rasters
+def focalStatisticsFromGDB(workspace, work_dir, dem_name="ab_dem", sizes=SIZES, statistics=tuple(STATISTICS),
+                           chunk_rows=1024, workers=1):
+    import cost_engine
+
+    dem_path = os.path.join(workspace, dem_name)
+    grid = cost_engine.gridFromRaster(dem_path)
+    os.makedirs(work_dir, exist_ok=True)
+    np.save(os.path.join(work_dir, "dem.npy"), cost_engine.readRaster(dem_path, grid))
+
+    print(f"Computing {', '.join(statistics)} for windows {', '.join(map(str, sizes))}...")
+    results = tiledFocalStatistics(os.path.join(work_dir, "dem.npy"), work_dir, sizes, statistics, grid.cell,
+                                   chunk_rows, workers)
+
+    saved = []
+    for (statistic, size), values in results.items():
+        saved.append(cost_engine.writeRaster(np.asarray(values), grid,
+                                             os.path.join(workspace, outputName(statistic, size))))
+    return saved
@@ -0,0 +1,152 @@
+#-------------------------------------------------------------------------------
+# Name:        Grid Statistics
+# Purpose:     Bulk NumPy version of the Grid Statistics block. Attributes and
+#              geometry are pulled into structured arrays in one call per layer
+#              and rasters are read as arrays, then the zonal means, per-class
+#              area sums, route lengths and grid listings are computed with
+#              bincount/unique instead of a tool, a table and a cursor each.
+#              Tables are only written when asked for (one write, no read back).
+#-------------------------------------------------------------------------------
+
+import os
+
+import numpy as np
+
+import cost_engine
+
+
+#-------------------------------------------------------------------------------
+# Array functions
+#-------------------------------------------------------------------------------
+
+# Function to sum values by key (like Statistics with a case field)
+# Returns (sorted unique keys, sums, counts)
+def groupSum(keys, values):
+    unique, inverse = np.unique(keys, return_inverse=True)
+    sums = np.bincount(inverse, weights=values, minlength=len(unique))
+    counts = np.bincount(inverse, minlength=len(unique))
+    return unique, sums, counts
+
+
+# Function to get the mean of a value array in every zone (like ZonalStatistics MEAN)
+# values is a float array, zones is an integer array of the same shape (0 = no zone)
+# NoData (NaN) cells are left out
+# Returns (zone ids, means, cell counts) of the zones that have data
+def zonalMeans(values, zones):
+    zones = np.asarray(zones).ravel()
+    values = np.asarray(values, dtype=np.float64).ravel()
+    keep = (zones > 0) & ~np.isnan(values)
+    zones = zones[keep].astype(np.int64)
+
+    sums = np.bincount(zones, weights=values[keep])
+    counts = np.bincount(zones, minlength=len(sums))
+    ids = np.flatnonzero(counts)
+    return ids, sums[ids] / counts[ids], counts[ids]
+
+
+# Function to turn NumPy values into plain Python values (for JSON and printing)
+def plain(value):
+    return value.item() if isinstance(value, np.generic) else value
+
+
+#-------------------------------------------------------------------------------
+# arcpy input/output
+#-------------------------------------------------------------------------------
+
+# Function to read the fields of a feature class or table into a structured array
+# fields can use geometry tokens (SHAPE@AREA, SHAPE@LENGTH, OID@)
+def featureArray(in_features, fields, where=None):
+    import arcpy
+
+    return arcpy.da.FeatureClassToNumPyArray(in_features, fields, where, null_value=-1)
+
+
+# Function to get the values of one field of every feature, in order
+def fieldValues(in_features, field):
+    return [plain(value) for value in featureArray(in_features, [field])[field]]
+
+
+# Function to get the mean of a raster in each zone of a feature class
+# zone_field names the zones in the result (any field, the zones are burned by OID)
+# value_raster sets the grid
+# Returns a list of [zone, mean, cell count, area]
+def zonalMeansFromGDB(workspace, zone_features, zone_field, value_raster):
+    import arcpy
+
+    value_path = os.path.join(workspace, value_raster)
+    grid = cost_engine.gridFromRaster(value_path)
+    with arcpy.EnvManager(workspace=workspace, extent=value_path, snapRaster=value_path,
+                          cellSize=grid.cell, outputCoordinateSystem=value_path):
+        zones = np.nan_to_num(cost_engine.featuresToArray(zone_features, "OBJECTID", grid), nan=0).astype(np.int64)
+        values = cost_engine.readRaster(value_path, grid)
+
+    names = featureArray(os.path.join(workspace, zone_features), ["OID@", zone_field])
+    name_of = {plain(oid): plain(name) for oid, name in names}
+
+    ids, means, counts = zonalMeans(values, zones)
+    return [[name_of.get(int(zone), int(zone)), float(mean), int(count), float(count * grid.cell**2)]
+            for zone, mean, count in zip(ids, means, counts)]
+
+
+# Function to get the total area of each class of a polygon feature class
+# Returns a list of [class, total area, polygon count]
+def classAreas(workspace, in_features, class_field):
+    rows = featureArray(os.path.join(workspace, in_features), [class_field, "SHAPE@AREA"])
+    classes, areas, counts = groupSum(rows[class_field], rows["SHAPE@AREA"])
+    return [[plain(c), float(a), int(n)] for c, a, n in zip(classes, areas, counts)]
+
+
+# Function to get the length of each route (REGION1, REGION2, length)
+def routeLengths(workspace, routes):
+    rows = featureArray(os.path.join(workspace, routes), ["REGION1", "REGION2", "SHAPE@LENGTH"])
+    return [[plain(r1), plain(r2), float(length)] for r1, r2, length in rows]
+
+
+# Function to write a list of rows to a gdb table in one call (the table is replaced)
+# fields is a list of (name, NumPy type)
+def writeTable(rows, fields, out_table):
+    import arcpy
+
+    if arcpy.Exists(out_table):
+        arcpy.management.Delete(out_table)
+    array = np.array([tuple(row) for row in rows], dtype=fields)
+    arcpy.da.NumPyArrayToTable(array, out_table)
+    return out_table
+
+
+# Function to compute all the Grid Statistics of the park in bulk
+# workspace is the output gdb, study_area is the boundary (one zone per polygon)
+# write_tables also saves the zonal and landcover tables (<dem>_stats, <landcover>_stats)
+# Returns a dictionary: mean_elevation, zones (every zone of the study area),
+# landcover_areas, route_lengths, nts, townships
+def parkStatistics(workspace, study_area, dem_name="ab_dem", landcover="AB_Landcover", class_field="LC_class",
+                   routes="Optimal_Routes", nts="NTS50", township="AB_Township", zone_field="GEONAME",
+                   write_tables=True):
+    print("Computing zonal mean elevation...")
+    zones = zonalMeansFromGDB(workspace, study_area, zone_field, dem_name)
+    total_cells = sum(zone[2] for zone in zones)
+
+    print("Computing landcover areas...")
+    landcover_areas = classAreas(workspace, landcover, class_field)
+
+    stats = {
+        # mean of the whole park (the zones weighted by their cell counts)
+        "mean_elevation": sum(zone[1] * zone[2] for zone in zones) / total_cells if total_cells else None,
+        "zones": zones,
+        "landcover_areas": [[c, area] for c, area, _ in landcover_areas],
+        "route_lengths": routeLengths(workspace, routes),
+        "nts": fieldValues(os.path.join(workspace, nts), "NAME"),
+        "townships": fieldValues(os.path.join(workspace, township), "DESCRIPTOR"),
+    }
+
+    if write_tables:
+        print("Saving statistics tables...")
+        zone_type = "U64" if any(isinstance(zone[0], str) for zone in zones) else np.int64
+        writeTable([(zone, count, area, mean) for zone, mean, count, area in zones],
+                   [(zone_field, zone_type), ("COUNT", np.int64), ("AREA", np.float64), ("MEAN", np.float64)],
+                   os.path.join(workspace, f"{dem_name}_stats"))
+        class_type = "U64" if any(isinstance(row[0], str) for row in landcover_areas) else np.int64
+        writeTable([(c, n, area) for c, area, n in landcover_areas],
+                   [(class_field, class_type), ("FREQUENCY", np.int64), ("SUM_Shape_Area", np.float64)],
+                   os.path.join(workspace, f"{landcover}_stats"))
+    return stats
@@ -0,0 +1,153 @@
+#-------------------------------------------------------------------------------
+# Name:        Ingest
+# Purpose:     Single-pass discovery of the source data. Walks the source folder
+#              once and yields a de-duplicated manifest of the shapefiles and
+#              rasters with their spatial references, so each dataset is
+#              described and converted exactly once.
+#              Each dataset is then projected and clipped/masked in one pass,
+#              without the Scratch.gdb round trip.
+#-------------------------------------------------------------------------------
+
+import os
+from collections import namedtuple
+
+import arcpy
+
+import pipeline
+
+
+# One source dataset
+# name is the name used in the output gdb, path is the full source path
+# kind is "vector" or "raster", spatial_reference is the arcpy SpatialReference
+# cell_size is the cell size of a raster (None for vectors)
+Dataset = namedtuple("Dataset", ["name", "path", "kind", "spatial_reference", "cell_size"])
+
+# Cells of the source raster kept around the boundary window (for the resampling)
+WINDOW_PAD = 2
+
+# Function to walk the source folder and yield every dataset once
+# root_path is the source folder, skip is the work folders and outputs of the configs
+# (e.g. the maps, which Walk lists as rasters), gdbs are always left out
+# The same paths are left out of the source fingerprint (pipeline.skipped)
+def discoverDatasets(root_path, skip=()):
+    seen_paths = set()
+    seen_names = {}
+    skip = pipeline.skipSet(skip)
+
+    for dirpath, dirnames, filenames in arcpy.da.Walk(root_path, datatype=["FeatureClass", "RasterDataset"]):
+        if pipeline.skipped(dirpath, skip):
+            dirnames[:] = [] # don't walk into it
+            continue
+        dirnames[:] = [d for d in dirnames if not pipeline.skipped(os.path.join(dirpath, d), skip)]
+
+        # .bnd files belong to rasters in the folder, list those rasters once for the folder
+        names = [f for f in filenames if not f.lower().endswith(".bnd")]
+        if len(names) < len(filenames):
+            with arcpy.EnvManager(workspace=dirpath):
+                names += [r for r in arcpy.ListRasters() or [] if r not in names]
+
+        for filename in names:
+            path = os.path.join(dirpath, filename)
+            key = os.path.normcase(os.path.abspath(path))
+            if key in seen_paths or pipeline.skipped(path, skip):
+                continue
+            seen_paths.add(key)
+
+            desc = arcpy.Describe(path)
+            kind = "vector" if desc.dataType in ("ShapeFile", "FeatureClass") else "raster"
+            name = os.path.splitext(filename)[0]
+
+            if name in seen_names:
+                print(f"Skipping {path}, {name} was already found at {seen_names[name]}")
+                continue
+            seen_names[name] = path
+
+            cell_size = desc.meanCellWidth if kind == "raster" else None
+            yield Dataset(name, path, kind, desc.spatialReference, cell_size)
+
+
+# Function to put the study area first and stream the other datasets after it
+# datasets is the manifest (a generator is fine), study_area is the study area name
+# Datasets found before the study area are held back until it is found
+def studyAreaFirst(datasets, study_area):
+    held = []
+    found = False
+    for dataset in datasets:
+        if found:
+            yield dataset
+        elif dataset.name == study_area:
+            found = True
+            yield dataset
+            yield from held
+            held = []
+        else:
+            held.append(dataset)
+
+    if not found:
+        raise ValueError(f"Study area {study_area} was not found in the source data")
+
+
+#-------------------------------------------------------------------------------
+# Project and clip in one pass
+#-------------------------------------------------------------------------------
+
+# Function to get the extent of the study area in the coordinate system of a dataset
+def boundaryExtent(study_area_path, spatial_reference):
+    extent = arcpy.Describe(study_area_path).extent
+    if spatial_reference.name != extent.spatialReference.name:
+        extent = extent.projectAs(spatial_reference)
+    return extent
+
+
+# Function to check that a dataset has a spatial reference
+def checkKnownCS(dataset):
+    if dataset.spatial_reference.name == "Unknown":
+        raise ValueError(f"{dataset.path} has unknown spatial reference")
+
+
+# Function to project and clip a vector dataset in one pass
+# Features outside the bounding box of the study area are filtered out first so
+# they are never projected, the clip writes the output in out_cs directly
+# dataset is a Dataset from the manifest, study_area_path is the boundary
+# out_fc is the output feature class, out_cs is the output coordinate system
+def ingestVector(dataset, study_area_path, out_fc, out_cs):
+    checkKnownCS(dataset)
+
+    # bounding box filter in the coordinate system of the source
+    layer = arcpy.management.MakeFeatureLayer(dataset.path, f"{dataset.name}_layer")[0]
+    box = boundaryExtent(study_area_path, dataset.spatial_reference).polygon
+    arcpy.management.SelectLayerByLocation(layer, "INTERSECT", box)
+
+    print(f"Projecting and clipping to the boundary... ")
+    with arcpy.EnvManager(outputCoordinateSystem=out_cs):
+        arcpy.analysis.Clip(in_features=layer, clip_features=study_area_path, out_feature_class=out_fc)
+
+    arcpy.management.Delete(layer)
+    return out_fc
+
+
+# Function to project and mask a raster dataset in one pass
+# The source is cut to the window of the study area (plus a few cells) before it is
+# projected and resampled to cell, ExtractByMask then does the projection, the
+# resampling and the mask together
+# dataset is a Dataset from the manifest, study_area_path is the boundary
+# out_raster is the output raster, out_cs is the output coordinate system
+def ingestRaster(dataset, study_area_path, out_raster, out_cs, cell):
+    from arcpy.sa import ExtractByMask
+
+    checkKnownCS(dataset)
+
+    print("Cutting the raster to the boundary window...")
+    extent = boundaryExtent(study_area_path, dataset.spatial_reference)
+    pad = WINDOW_PAD * dataset.cell_size
+    rectangle = f"{extent.XMin - pad} {extent.YMin - pad} {extent.XMax + pad} {extent.YMax + pad}"
+    window = os.path.join("memory", f"{dataset.name}_window")
+    arcpy.management.Clip(dataset.path, rectangle, window)
+
+    print("Projecting and extracting by mask with park boundary...")
+    with arcpy.EnvManager(outputCoordinateSystem=out_cs, cellSize=cell, extent=study_area_path):
+        out_extract = ExtractByMask(in_raster=window, in_mask_data=study_area_path)
+        out_extract.save(out_raster)
+
+    arcpy.management.Delete(window)
+    return out_raster
@@ -0,0 +1,446 @@
+#-------------------------------------------------------------------------------
+# Name:        Map Export
+# Purpose:     Batch version of the Mapping block. A list of map jobs (one per study
+#              area, scenario or extra map) is exported from one .aprx template
+#              opened read-only in each worker process, so no .lyrx files are made
+#              and the project is never saved. A headless renderer draws the same
+#              maps from arrays and geometries to PNG or PDF with matplotlib, or
+#              with a built-in PNG/PDF writer when matplotlib isn't installed. The
+#              map data can be saved to a folder first so the headless renderer
+#              runs on machines without ArcGIS Pro.
+#
+# Usage:       python map_export.py configs/park_a.json configs/park_b.json --workers 4
+#              python map_export.py configs/park_a.json --export-data MapData
+#              python map_export.py configs/park_a.json --data MapData (no arcpy)
+#-------------------------------------------------------------------------------
+
+import json
+import os
+import struct
+import zlib
+from collections import namedtuple
+
+import numpy as np
+
+import cost_engine
+import rasterizer
+import task_runner
+
+
+# One map to export
+# name names the map in the messages, workspace is the gdb with the layers
+# layers is the list of feature classes drawn on the map (in drawing order, the first
+# one sets the extent), background is a raster drawn under them (headless only) or None
+# title is the map title, out_path the .pdf (or .png for the headless renderer)
+MapJob = namedtuple("MapJob", ["name", "workspace", "layers", "background", "title", "out_path"])
+
+# Renderers
+RENDERERS = ("aprx", "headless")
+
+# Headless style of a layer: (fill RGB or None, outline RGB or None, line width in pixels)
+STYLES = {
+    "Bear_Habitat": ((76, 153, 0), (38, 102, 0), 1),
+    "Optimal_Routes": (None, (204, 0, 0), 3),
+}
+STUDY_AREA_STYLE = (None, (0, 0, 0), 2)
+DEFAULT_STYLE = (None, (0, 0, 153), 2)
+
+# Background colour ramp (low to high) and the colour of NoData
+RAMP = [(255, 255, 204), (253, 141, 60), (128, 0, 38)]
+NODATA_RGB = (255, 255, 255)
+
+
+#-------------------------------------------------------------------------------
+# Jobs
+#-------------------------------------------------------------------------------
+
+# Function to get the map jobs of a run context (see config.py)
+# The first job is the main map (study area, habitat patches and routes), the jobs of
+# the map_export setting add more maps of the same gdb, e.g.
+# {"name": ..., "title": ..., "out": ..., "layers": [...], "background": ...}
+def jobsFromContext(ctx):
+    study_area = ctx["study_area"]
+    main_layers = [study_area, "Bear_Habitat", "Optimal_Routes"]
+    jobs = [MapJob(ctx["name"], ctx["out_path"], main_layers, "Combined_Cost", ctx["map_title"], ctx["pdf_path"])]
+    for n, job in enumerate((ctx["map_export"] or {}).get("jobs", [])):
+        layers = job.get("layers", main_layers)
+        if study_area not in layers:
+            layers = [study_area] + layers
+        jobs.append(MapJob(f"{ctx['name']} {job.get('name', n + 1)}", ctx["out_path"], layers,
+                           job.get("background", "Combined_Cost"), job.get("title", ctx["map_title"]),
+                           os.path.join(ctx["root_path"], job["out"])))
+    return jobs
+
+
+# Function to get the output files of the map jobs of a run context
+def jobOutputs(ctx):
+    return [job.out_path for job in jobsFromContext(ctx)]
+
+
+#-------------------------------------------------------------------------------
+# ArcGIS Pro layouts
+#-------------------------------------------------------------------------------
+
+# Function to export one map from the layout of a template (a task of exportMaps)
+# The template is opened but never saved, the layers are added from their paths
+# Returns the path of the PDF
+def exportLayout(template, job):
+    import arcpy.mp as MAP
+
+    aprx = MAP.ArcGISProject(template)
+    m = aprx.listMaps("Map")[0]
+    layers = [m.addDataFromPath(os.path.join(job.workspace, fc)) for fc in job.layers]
+
+    layout = aprx.listLayouts()[0]
+    for elem in layout.listElements():
+        if elem.name == "Map Title":
+            elem.text = job.title
+        if elem.name == "Legend":
+            elem.title = "Legend"
+
+    # zoom to the first layer (the study area)
+    mf = layout.listElements("mapframe_element")[0]
+    mf.camera.setExtent(mf.getLayerExtent(layers[0], True))
+
+    layout.exportToPDF(job.out_path)
+    del aprx # release the template without saving it
+    return job.out_path
+
+
+#-------------------------------------------------------------------------------
+# Headless renderer
+#-------------------------------------------------------------------------------
+
+# Function to get the grid of a map image
+# extent is (x_min, y_min, x_max, y_max), size is the longest side in pixels
+# margin is the space around the extent as a share of its longest side
+def imageGrid(extent, size=2000, margin=0.02, spatial_reference=None):
+    x_min, y_min, x_max, y_max = extent
+    pad = max(x_max - x_min, y_max - y_min) * margin
+    x_min, y_min, x_max, y_max = x_min - pad, y_min - pad, x_max + pad, y_max + pad
+    cell = max(x_max - x_min, y_max - y_min) / size
+    return cost_engine.Grid(x_min, y_min, cell, max(int(np.ceil((y_max - y_min) / cell)), 1),
+                            max(int(np.ceil((x_max - x_min) / cell)), 1), spatial_reference)
+
+
+# Function to resample an array of one grid onto another grid (nearest cell)
+def resample(array, grid, out_grid):
+    top = grid.y_min + grid.rows * grid.cell
+    out_top = out_grid.y_min + out_grid.rows * out_grid.cell
+    y = out_top - (np.arange(out_grid.rows) + 0.5) * out_grid.cell
+    x = out_grid.x_min + (np.arange(out_grid.cols) + 0.5) * out_grid.cell
+    r = np.floor((top - y) / grid.cell).astype(np.int64)
+    c = np.floor((x - grid.x_min) / grid.cell).astype(np.int64)
+    out = np.full((out_grid.rows, out_grid.cols), np.nan, dtype=np.float32)
+    rows_in, cols_in = (r >= 0) & (r < grid.rows), (c >= 0) & (c < grid.cols)
+    out[np.ix_(rows_in, cols_in)] = array[np.ix_(r[rows_in], c[cols_in])]
+    return out
+
+
+# Function to colour an array with the ramp (stretched between its 2nd and 98th percentiles)
+# Returns a (rows x cols x 3) uint8 image
+def colourRamp(values, ramp=RAMP, nodata_rgb=NODATA_RGB):
+    image = np.empty(values.shape + (3,), dtype=np.uint8)
+    image[:] = nodata_rgb
+    valid = ~np.isnan(values)
+    if not valid.any():
+        return image
+
+    low, high = np.percentile(values[valid], [2, 98])
+    t = np.clip((values[valid] - low) / ((high - low) or 1), 0, 1) * (len(ramp) - 1)
+    stops = np.asarray(ramp, dtype=np.float32)
+    i = np.minimum(t.astype(np.int64), len(ramp) - 2)
+    f = (t - i)[:, None]
+    image[valid] = (stops[i] * (1 - f) + stops[i + 1] * f).astype(np.uint8)
+    return image
+
+
+# Function to thicken a mask by a number of pixels (square)
+def thicken(mask, width):
+    out = mask.copy()
+    for step in range(1, width // 2 + 1):
+        out[step:] |= mask[:-step]
+        out[:-step] |= mask[step:]
+    grown = out.copy()
+    for step in range(1, width // 2 + 1):
+        grown[:, step:] |= out[:, :-step]
+        grown[:, :-step] |= out[:, step:]
+    return grown
+
+
+# Function to draw Shapes on an image with a style (see STYLES)
+def drawShapes(image, shapes, style):
+    fill, outline, width = style
+    shape = image.shape[:2]
+    if fill is not None and shapes.kind == "polygon":
+        image[~np.isnan(rasterizer.rasterize(shapes, shape))] = fill
+    if outline is not None:
+        lines = shapes._replace(kind="line")
+        image[thicken(~np.isnan(rasterizer.rasterize(lines, shape)), width)] = outline
+    return image
+
+
+# Function to save an RGB image as a PNG (zlib only)
+def writePNG(image, out_path, title=None):
+    rows, cols, _ = image.shape
+    raw = np.concatenate([np.zeros((rows, 1), dtype=np.uint8), image.reshape(rows, cols * 3)], axis=1)
+
+    def chunk(tag, data):
+        return struct.pack(">I", len(data)) + tag + data + struct.pack(">I", zlib.crc32(tag + data) & 0xFFFFFFFF)
+
+    with open(out_path, "wb") as f:
+        f.write(b"\x89PNG\r\n\x1a\n")
+        f.write(chunk(b"IHDR", struct.pack(">IIBBBBB", cols, rows, 8, 2, 0, 0, 0)))
+        if title:
+            f.write(chunk(b"tEXt", b"Title\x00" + title.encode("latin-1", "replace")))
+        f.write(chunk(b"IDAT", zlib.compress(raw.tobytes(), 6)))
+        f.write(chunk(b"IEND", b""))
+    return out_path
+
+
+# Function to save an RGB image as a one page PDF with the title above it (zlib only)
+# The title uses Helvetica, which every PDF reader has
+def writePDF(image, out_path, title=None, page_width=792):
+    rows, cols, _ = image.shape
+    width = page_width - 72
+    height = width * rows / cols
+    title_space = 48 if title else 0
+    page_height = height + 72 + title_space
+
+    text = (title or "").replace("\\", "\\\\").replace("(", "\\(").replace(")", "\\)")
+    content = f"q {width:.2f} 0 0 {height:.2f} 36 36 cm /Im0 Do Q\n".encode()
+    if title:
+        content += f"BT /F1 20 Tf 36 {page_height - 48:.2f} Td ({text}) Tj ET\n".encode("latin-1", "replace")
+    pixels = zlib.compress(image.tobytes(), 6)
+
+    objects = [
+        b"<< /Type /Catalog /Pages 2 0 R >>",
+        b"<< /Type /Pages /Kids [3 0 R] /Count 1 >>",
+        f"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 {page_width} {page_height:.2f}] "
+        f"/Resources << /XObject << /Im0 4 0 R >> /Font << /F1 6 0 R >> >> /Contents 5 0 R >>".encode(),
+        f"<< /Type /XObject /Subtype /Image /Width {cols} /Height {rows} /ColorSpace /DeviceRGB "
+        f"/BitsPerComponent 8 /Filter /FlateDecode /Length {len(pixels)} >>\nstream\n".encode() + pixels + b"\nendstream",
+        f"<< /Length {len(content)} >>\nstream\n".encode() + content + b"endstream",
+        b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>",
+        f"<< /Title ({text}) >>".encode("latin-1", "replace"),
+    ]
+
+    with open(out_path, "wb") as f:
+        f.write(b"%PDF-1.4\n")
+        offsets = []
+        for n, body in enumerate(objects):
+            offsets.append(f.tell())
+            f.write(f"{n + 1} 0 obj\n".encode() + body + b"\nendobj\n")
+        xref = f.tell()
+        f.write(f"xref\n0 {len(objects) + 1}\n0000000000 65535 f \n".encode())
+        for offset in offsets:
+            f.write(f"{offset:010d} 00000 n \n".encode())
+        f.write(f"trailer\n<< /Size {len(objects) + 1} /Root 1 0 R /Info {len(objects)} 0 R >>\n"
+                f"startxref\n{xref}\n%%EOF\n".encode())
+    return out_path
+
+
+# Function to save an RGB image with matplotlib (PNG or PDF from the extension)
+# legend is a list of (label, RGB) shown under the map
+def writeFigure(image, out_path, title=None, legend=()):
+    import matplotlib
+    matplotlib.use("Agg")
+    import matplotlib.pyplot as plt
+    from matplotlib.patches import Patch
+
+    rows, cols, _ = image.shape
+    fig, ax = plt.subplots(figsize=(11, 11 * rows / cols + 1))
+    ax.imshow(image, interpolation="nearest")
+    ax.set_axis_off()
+    if title:
+        ax.set_title(title, fontsize=18)
+    if legend:
+        ax.legend(handles=[Patch(color=np.asarray(rgb) / 255, label=label) for label, rgb in legend],
+                  loc="upper center", bbox_to_anchor=(0.5, 0), ncol=len(legend), frameon=False)
+    fig.savefig(out_path, dpi=150, bbox_inches="tight")
+    plt.close(fig)
+    return out_path
+
+
+# Function to render a map from arrays and Shapes
+# grid is the grid of the image, background an array on that grid (or None)
+# layers is a list of (name, Shapes on the grid, style)
+# Writes a PNG or a PDF (from the extension of out_path), with matplotlib when it's
+# installed and the built-in writers when it isn't
+def renderMap(out_path, grid, background=None, layers=(), title=None):
+    if background is None:
+        image = np.full((grid.rows, grid.cols, 3), 255, dtype=np.uint8)
+    else:
+        image = colourRamp(background)
+    for _, shapes, style in layers:
+        drawShapes(image, shapes, style)
+
+    legend = [(name, style[0] or style[1]) for name, _, style in layers]
+    try:
+        return writeFigure(image, out_path, title, legend)
+    except ImportError:
+        pass
+    if out_path.lower().endswith(".pdf"):
+        return writePDF(image, out_path, title)
+    return writePNG(image, out_path, title)
+
+
+# Function to convert a GeoJSON geometry to an Esri JSON one (rings or paths)
+def esriGeometry(geometry):
+    if geometry is None or "type" not in geometry:
+        return geometry
+    kind, coordinates = geometry["type"], geometry["coordinates"]
+    if kind == "Polygon":
+        return {"rings": coordinates}
+    if kind == "MultiPolygon":
+        return {"rings": [ring for polygon in coordinates for ring in polygon]}
+    if kind == "LineString":
+        return {"paths": [coordinates]}
+    if kind == "MultiLineString":
+        return {"paths": coordinates}
+    return None
+
+
+# Function to get the extent (x_min, y_min, x_max, y_max) of Esri JSON geometries
+def geometryExtent(geometries):
+    points = np.concatenate([np.asarray(part, dtype=np.float64)[:, :2] for geometry in geometries if geometry
+                             for part in geometry.get("rings") or geometry.get("paths") or []])
+    return tuple(points.min(axis=0)) + tuple(points.max(axis=0))
+
+
+# Function to read the geometries of a layer as Esri JSON
+# From <name>.json (Esri JSON or GeoJSON features, see exportMapData) when the
+# workspace is a folder, from the feature class with arcpy otherwise
+def readGeometries(workspace, name):
+    path = os.path.join(workspace, f"{name}.json")
+    if os.path.isfile(path):
+        with open(path) as f:
+            features = json.load(f)["features"]
+        return [esriGeometry(feature.get("geometry")) for feature in features]
+
+    import arcpy
+    with arcpy.da.SearchCursor(os.path.join(workspace, name), ["SHAPE@JSON"]) as cursor:
+        return [json.loads(shape) if shape else None for shape, in cursor]
+
+
+# Function to read a background raster and its grid
+# From <name>.npy and <name>.grid.json (see exportMapData) when the workspace is a
+# folder, from the raster with arcpy otherwise
+# Returns (array, grid), or None when there is no such raster
+def readBackground(workspace, name):
+    path = os.path.join(workspace, f"{name}.npy")
+    if os.path.isfile(path):
+        with open(os.path.join(workspace, f"{name}.grid.json")) as f:
+            grid = cost_engine.Grid(**json.load(f))
+        return np.load(path, mmap_mode="r"), grid
+    if os.path.isdir(workspace) and not workspace.lower().endswith(".gdb"):
+        return None
+
+    import arcpy
+    raster = os.path.join(workspace, name)
+    if not arcpy.Exists(raster):
+        return None
+    grid = cost_engine.gridFromRaster(raster)
+    return cost_engine.readRaster(raster, grid), grid
+
+
+# Function to render one map job without a layout (a task of exportMaps)
+# The data comes from the gdb with the arcpy data access functions (no .aprx, no
+# Spatial Analyst) or from a folder made by exportMapData (no arcpy at all)
+def renderJob(job, size=2000):
+    geometries = {fc: readGeometries(job.workspace, fc) for fc in job.layers}
+    grid = imageGrid(geometryExtent(geometries[job.layers[0]]), size)
+
+    background = None
+    raster = readBackground(job.workspace, job.background) if job.background else None
+    if raster is not None:
+        background = resample(raster[0], raster[1], grid)
+
+    layers = []
+    for n, fc in enumerate(job.layers):
+        style = STUDY_AREA_STYLE if n == 0 else STYLES.get(fc, DEFAULT_STYLE)
+        shapes = rasterizer.shapesFromJSON(geometries[fc], np.ones(len(geometries[fc])), grid)
+        layers.append((fc, shapes, style))
+    return renderMap(job.out_path, grid, background, layers, job.title)
+
+
+#-------------------------------------------------------------------------------
+# Batch
+#-------------------------------------------------------------------------------
+
+# Function to export a list of map jobs
+# renderer is "aprx" (the layout of the template) or "headless" (renderJob)
+# workers is the number of processes, each one renders a share of the maps
+# Returns the list of exported files
+def exportMaps(jobs, template=None, renderer="aprx", workers=1):
+    if renderer not in RENDERERS:
+        raise ValueError(f"Unknown renderer {renderer}, use one of {', '.join(RENDERERS)}")
+
+    tasks = []
+    for job in jobs:
+        if renderer == "aprx":
+            tasks.append(task_runner.task(f"Map {job.name}", exportLayout, template, job))
+        else:
+            tasks.append(task_runner.task(f"Map {job.name}", renderJob, job))
+    return list(task_runner.runTasks(tasks, workers).values())
+
+
+#-------------------------------------------------------------------------------
+# arcpy input/output
+#-------------------------------------------------------------------------------
+
+# Function to save the data of map jobs to a folder so the headless renderer can draw
+# them on a machine without arcpy (layers as Esri JSON, backgrounds as .npy with their grid)
+# Returns the jobs with the folder as their workspace
+def exportMapData(jobs, folder):
+    import arcpy
+
+    os.makedirs(folder, exist_ok=True)
+    saved = set()
+    for job in jobs:
+        for fc in job.layers:
+            if fc not in saved:
+                features = [{"geometry": geometry} for geometry in readGeometries(job.workspace, fc)]
+                with open(os.path.join(folder, f"{fc}.json"), "w") as f:
+                    json.dump({"features": features}, f)
+                saved.add(fc)
+        if job.background and job.background not in saved and arcpy.Exists(os.path.join(job.workspace, job.background)):
+            array, grid = readBackground(job.workspace, job.background)
+            np.save(os.path.join(folder, f"{job.background}.npy"), array)
+            with open(os.path.join(folder, f"{job.background}.grid.json"), "w") as f:
+                json.dump(grid._replace(spatial_reference=None)._asdict(), f)
+            saved.add(job.background)
+        print(f"Saved the data of map {job.name}")
+    return [job._replace(workspace=folder) for job in jobs]
+
+
+if __name__ == "__main__":
+    import argparse
+
+    import config
+
+    parser = argparse.ArgumentParser(description="Export the maps of one or more configs")
+    parser.add_argument("configs", nargs="*", default=[config.DEFAULT_CONFIG], help="config files (JSON)")
+    parser.add_argument("--renderer", choices=RENDERERS, help="renderer (the map_export renderer of each config by default)")
+    parser.add_argument("--workers", type=int, default=None, help="worker processes (default: number of cores)")
+    parser.add_argument("--export-data", metavar="FOLDER", help="save the map data of each config to FOLDER/<config name> and stop")
+    parser.add_argument("--data", metavar="FOLDER", help="headless renderer: read the map data from FOLDER/<config name> instead of the gdb")
+    args = parser.parse_args()
+
+    # one batch per renderer and template, the maps of all the configs share the workers
+    batches = {}
+    for settings in [config.loadConfig(path) for path in args.configs]:
+        ctx = config.buildContext(settings)
+        jobs = jobsFromContext(ctx)
+        if args.export_data:
+            exportMapData(jobs, os.path.join(args.export_data, ctx["name"]))
+            continue
+        renderer = args.renderer or (ctx["map_export"] or {}).get("renderer", "aprx")
+        if args.data:
+            renderer = "headless"
+            jobs = [job._replace(workspace=os.path.join(args.data, ctx["name"])) for job in jobs]
+        batches.setdefault((renderer, ctx["aprx_path"]), []).extend(jobs)
+
+    for (renderer, template), jobs in batches.items():
+        for path in exportMaps(jobs, template, renderer, args.workers):
+            print(f"Saved {path}")
@@ -0,0 +1,304 @@
+#-------------------------------------------------------------------------------
+# Name:        Pipeline
+# Purpose:     Runs the script as a declared graph of stages (conversion, cost,
+#              corridors, mapping, statistics, ...). Each stage lists its inputs,
+#              outputs and parameters, and a stage is skipped when none of them
+#              changed since its last successful run and its outputs still exist.
+#              Each finished stage is checkpointed with a hash of its outputs, and
+#              a stage can checkpoint its parts (e.g. each dataset of the
+#              conversion) so --resume continues a failed stage where it stopped.
+#-------------------------------------------------------------------------------
+
+import hashlib
+import json
+import os
+from collections import namedtuple
+
+import profiling
+import raster_cache
+
+
+# One stage of the pipeline
+# name is a unique stage name, func is called with the run context (a dictionary)
+# inputs are dataset names made by other stages or paths of source files/folders
+# outputs are dataset names (or paths) the stage makes
+# params is a dictionary of the settings that change the outputs of the stage
+# A stage without outputs (e.g. printing a report) always runs
+Stage = namedtuple("Stage", ["name", "func", "inputs", "outputs", "params"])
+
+# Files in the source folder that are not source data
+# (the work folders and outputs of a config are passed as skip, see skipped)
+IGNORE_EXTENSIONS = (".aprx", ".pdf", ".png", ".lyrx", ".json", ".csv", ".lock", ".npy")
+
+
+#-------------------------------------------------------------------------------
+# Signatures
+#-------------------------------------------------------------------------------
+
+# Function to normalize the paths to skip (work folders and outputs of the configs)
+def skipSet(paths):
+    return frozenset(os.path.normcase(os.path.abspath(path)) for path in paths or ())
+
+
+# Function to check if a path in a source folder is left out (a gdb, or a path of skip
+# or inside one), skip is a set from skipSet
+def skipped(path, skip):
+    if path.endswith(".gdb"):
+        return True
+    path = os.path.normcase(os.path.abspath(path))
+    while True:
+        if path in skip:
+            return True
+        parent = os.path.dirname(path)
+        if parent == path:
+            return False
+        path = parent
+
+
+# Function to get a fingerprint of a source folder, skipping outputs and work folders
+# skip is a set from skipSet
+def sourceFingerprint(folder, skip=frozenset()):
+    h = hashlib.sha256()
+    for dirpath, dirnames, filenames in os.walk(folder):
+        dirnames[:] = sorted(d for d in dirnames if not skipped(os.path.join(dirpath, d), skip))
+        for filename in sorted(filenames):
+            if filename.lower().endswith(IGNORE_EXTENSIONS) or skipped(os.path.join(dirpath, filename), skip):
+                continue
+            stat = os.stat(os.path.join(dirpath, filename))
+            h.update(f"{os.path.join(dirpath, filename)}|{stat.st_size}|{stat.st_mtime_ns}\n".encode())
+    return h.hexdigest()
+
+
+# Function to get the fingerprint of one input (a folder, a file or a dataset name)
+def inputFingerprint(item, skip=frozenset()):
+    if os.path.isdir(item) and not item.endswith(".gdb"):
+        return sourceFingerprint(item, skip)
+    if os.path.exists(item):
+        return raster_cache.fingerprint(item)
+    return None
+
+
+# Function to find the stage that makes each dataset
+def producers(stages):
+    made_by = {}
+    for stage in stages:
+        for output in stage.outputs:
+            made_by[output] = stage.name
+    return made_by
+
+
+# Function to get the stages that depend on a stage (directly or not), in order
+def downstream(stages, name):
+    made_by = producers(stages)
+    found = {name}
+    for stage in stages:
+        if any(made_by.get(item) in found for item in stage.inputs):
+            found.add(stage.name)
+    return [stage.name for stage in stages if stage.name in found]
+
+
+# Function to get the signature of a stage from its params, its source inputs and the
+# signatures of the stages that make its inputs (skip as in sourceFingerprint)
+def stageSignature(stage, made_by, signatures, skip=frozenset()):
+    parts = {"name": stage.name, "params": stage.params, "inputs": {}}
+    for item in stage.inputs:
+        if item in made_by:
+            parts["inputs"][item] = signatures.get(made_by[item])
+        else:
+            parts["inputs"][item] = inputFingerprint(item, skip)
+    text = json.dumps(parts, sort_keys=True, default=str)
+    return hashlib.sha256(text.encode()).hexdigest()
+
+
+#-------------------------------------------------------------------------------
+# State of the last run
+#-------------------------------------------------------------------------------
+
+# Function to read the state file ({stage name: {"signature": ..., "status": ...,
+# "results": ..., "outputs": {output: hash}, "parts": {part: hash}}})
+def loadState(state_path):
+    if not os.path.exists(state_path):
+        return {}
+    with open(state_path) as f:
+        return json.load(f)
+
+
+# Function to save the state file (written to a temporary file and synced to disk first,
+# so a crash leaves the old or the new state, never half of one)
+def saveState(state_path, state):
+    with open(state_path + ".tmp", "w") as f:
+        json.dump(state, f, indent=2, default=str)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(state_path + ".tmp", state_path)
+
+
+# Function to get the validity hash of each output of a stage
+# output_hash is a function that gets the hash of one output (None when it's missing)
+def outputHashes(stage, output_hash):
+    return {item: output_hash(item) for item in stage.outputs}
+
+
+# Function to check the checkpoint of a finished stage
+# The outputs must exist and still have the hashes of the checkpoint (states from before
+# the hashes were recorded only check that the outputs exist)
+def checkpointValid(stage, last, exists, output_hash=None):
+    if last.get("status", "done") != "done":
+        return False
+    recorded = last.get("outputs")
+    if output_hash is None or recorded is None:
+        return all(exists(item) for item in stage.outputs)
+    return all(recorded.get(item) is not None and recorded.get(item) == output_hash(item) for item in stage.outputs)
+
+
+#-------------------------------------------------------------------------------
+# Checkpoints of the parts of a stage
+# A long stage records each part it finishes, a --resume run of the same stage (same
+# signature) skips the parts whose output still has the recorded hash
+#-------------------------------------------------------------------------------
+
+# Function to check if the running stage is resuming (it has parts from a failed run)
+def resuming(ctx):
+    run = ctx.get("pipeline_run")
+    return bool(run and run["resume"] and run["state"][run["stage"]].get("parts"))
+
+
+# Function to check if a part of the running stage was finished by the failed run
+# item is the output of the part (a dataset name or a path)
+def partDone(ctx, item):
+    run = ctx.get("pipeline_run")
+    if not (run and run["resume"]):
+        return False
+    recorded = run["state"][run["stage"]].get("parts", {}).get(item)
+    return recorded is not None and recorded == run["output_hash"](item)
+
+
+# Function to checkpoint a part of the running stage (saved to the state file at once)
+def markPart(ctx, item):
+    run = ctx.get("pipeline_run")
+    if run is None:
+        return
+    run["state"][run["stage"]].setdefault("parts", {})[item] = run["output_hash"](item)
+    saveState(run["state_path"], run["state"])
+
+
+#-------------------------------------------------------------------------------
+# Runner
+#-------------------------------------------------------------------------------
+
+# Function to run the stages in order
+# stages is the list of Stage (in order), ctx is the run context passed to each stage
+# exists is a function that checks if an output exists (e.g. arcpy.Exists in the gdb)
+# state_path is the json file that records the last successful run of each stage
+# from_stage reruns that stage and every stage that depends on it
+# only_stage reruns just that stage (the other stages are not run at all)
+# force reruns every stage
+# resume keeps the checkpointed parts of a stage that failed (see partDone)
+# output_hash gets the validity hash of an output (None when it's missing), the hashes
+# are checked before a stage is skipped, by default the outputs only have to exist
+# skip is the work folders and outputs to leave out of the source folder fingerprints
+# Each stage that runs is timed in the run report (see profiling.py)
+# A stage can return a dictionary of results, they are added to ctx and saved in the
+# state so a skipped stage still provides them to the later stages
+def runPipeline(stages, ctx, exists, state_path, from_stage=None, only_stage=None, force=False, resume=False,
+                output_hash=None, skip=()):
+    names = [stage.name for stage in stages]
+    for name in (from_stage, only_stage):
+        if name is not None and name not in names:
+            raise ValueError(f"Unknown stage {name}, the stages are: {', '.join(names)}")
+
+    forced = set()
+    if force:
+        forced = set(names)
+    elif from_stage:
+        forced = set(downstream(stages, from_stage))
+    elif only_stage:
+        forced = {only_stage}
+
+    if output_hash is None:
+        output_hash = lambda item: "exists" if exists(item) else None
+
+    state = loadState(state_path)
+    made_by = producers(stages)
+    signatures = {}
+    skip = skipSet(skip)
+
+    for stage in stages:
+        signatures[stage.name] = stageSignature(stage, made_by, signatures, skip)
+        last = state.get(stage.name, {})
+
+        if only_stage and stage.name != only_stage:
+            run = False
+        elif stage.name in forced or not stage.outputs:
+            run = True
+        else:
+            # rerun only if the inputs or params changed or an output is missing or changed
+            run = (last.get("signature") != signatures[stage.name]
+                   or not checkpointValid(stage, last, exists, output_hash))
+
+        if not run:
+            print(f"Skipping stage {stage.name}.\n")
+            ctx.update(last.get("results") or {})
+            continue
+
+        # the parts checkpointed by a failed run of the same stage are kept when resuming
+        parts = {}
+        if resume and last.get("status") == "running" and last.get("signature") == signatures[stage.name]:
+            parts = last.get("parts", {})
+            print(f"Resuming stage {stage.name} ({len(parts)} parts done)...\n")
+        else:
+            print(f"Running stage {stage.name}...\n")
+        state[stage.name] = {"signature": signatures[stage.name], "status": "running", "parts": parts}
+        saveState(state_path, state)
+
+        ctx["pipeline_run"] = {"state_path": state_path, "state": state, "stage": stage.name, "resume": resume,
+                               "output_hash": output_hash}
+        try:
+            with profiling.timed(stage.name, "stage", profile=True):
+                results = stage.func(ctx) or {}
+        finally:
+            ctx.pop("pipeline_run", None)
+        ctx.update(results)
+
+        state[stage.name] = {"signature": signatures[stage.name], "status": "done", "results": results,
+                             "outputs": outputHashes(stage, output_hash)}
+        saveState(state_path, state)
+    return ctx
+
+
+# Function to get the status of each stage from the state file, without running anything
+# (the outputs are not checked, that needs the tools that made them)
+# Returns a list of (stage name, status, outputs), status is "up to date", "changed",
+# "never run", "failed" (can be resumed) or "always runs"
+def stageStatus(stages, state_path, skip=()):
+    state = loadState(state_path)
+    made_by = producers(stages)
+    signatures = {}
+    status = []
+    skip = skipSet(skip)
+    for stage in stages:
+        signatures[stage.name] = stageSignature(stage, made_by, signatures, skip)
+        last = state.get(stage.name)
+        if not stage.outputs:
+            status.append((stage.name, "always runs", stage.outputs))
+        elif last is None:
+            status.append((stage.name, "never run", stage.outputs))
+        elif last.get("status", "done") != "done":
+            status.append((stage.name, "failed", stage.outputs))
+        elif last.get("signature") != signatures[stage.name]:
+            status.append((stage.name, "changed", stage.outputs))
+        else:
+            status.append((stage.name, "up to date", stage.outputs))
+    return status
+
+
+# Function to add the pipeline options to a command line parser
+# (the stage names are checked by runPipeline)
+def addArguments(parser):
+    parser.add_argument("--from-stage", help="rerun this stage and every stage that depends on it")
+    parser.add_argument("--only-stage", help="run only this stage")
+    parser.add_argument("--force", action="store_true", help="run every stage even if nothing changed")
+    parser.add_argument("--resume", action="store_true",
+                        help="continue a failed run, keeping the parts of the failed stage that were finished")
+    parser.add_argument("--profile", action="store_true", help="save a cProfile of every stage that runs")
+    return parser
@@ -0,0 +1,300 @@
+#-------------------------------------------------------------------------------
+# Name:        Profiling
+# Purpose:     Records wall time, CPU time, peak RSS (of the block, and of its worker
+#              processes) and bytes read/written for every stage and
+#              geoprocessing call of a run, and writes them as a
+#              JSON/CSV run report. cProfile can be turned on per stage to find
+#              the Python-side hot spots.
+#-------------------------------------------------------------------------------
+
+import cProfile
+import csv
+import io
+import json
+import os
+import pstats
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+
+# Report of the current run (None = not recording, timed() does nothing)
+_report = None
+
+# Columns of the CSV report
+COLUMNS = ["name", "kind", "parent", "start", "wall_s", "cpu_s", "children_cpu_s",
+           "peak_rss_mb", "children_peak_rss_mb", "read_mb", "written_mb"]
+
+# Seconds between two memory samples of a timed block
+SAMPLE_INTERVAL = 0.1
+
+
+#-------------------------------------------------------------------------------
+# Process counters
+#-------------------------------------------------------------------------------
+
+# Function to get the peak resident memory of this process in bytes since it started
+# (None if unknown), psutil only has the peak on Windows (peak_wset), getrusage has it elsewhere
+def peakRSS():
+    try:
+        import psutil
+
+        peak = getattr(psutil.Process().memory_info(), "peak_wset", None)
+        if peak:
+            return peak
+    except ImportError:
+        pass
+
+    try:
+        import resource
+
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak if sys.platform == "darwin" else peak * 1024 # kilobytes on Linux
+    except ImportError:
+        return None
+
+
+# Function to get the largest peak resident memory of the finished child processes in
+# bytes (None if unknown, e.g. on Windows)
+def childrenPeakRSS():
+    try:
+        import resource
+
+        peak = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+        return peak if sys.platform == "darwin" else peak * 1024
+    except ImportError:
+        return None
+
+
+# Function to get the resident memory of this process now in bytes (None if unknown)
+def currentRSS():
+    try:
+        import psutil
+
+        return psutil.Process().memory_info().rss
+    except ImportError:
+        pass
+
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, AttributeError):
+        return None
+
+
+# Function to get the resident memory of the running child processes now in bytes
+# (the process pool workers, None without psutil)
+def childrenRSS():
+    try:
+        import psutil
+
+        total = 0
+        for child in psutil.Process().children(recursive=True):
+            try:
+                total += child.memory_info().rss
+            except psutil.Error: # the worker just exited
+                pass
+        return total
+    except ImportError:
+        return None
+
+
+# Function to get the (bytes read, bytes written) of this process (None if unknown)
+def ioCounters():
+    try:
+        import psutil
+
+        counters = psutil.Process().io_counters()
+        return counters.read_bytes, counters.write_bytes
+    except (ImportError, AttributeError):
+        pass
+
+    try:
+        with open("/proc/self/io") as f:
+            values = dict(line.split(": ") for line in f.read().splitlines())
+        return int(values["read_bytes"]), int(values["write_bytes"])
+    except (OSError, KeyError, ValueError):
+        return None, None
+
+
+# Function to get the CPU time of the finished child processes (process pool workers)
+def childrenCPU():
+    try:
+        import resource
+
+        usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+        return usage.ru_utime + usage.ru_stime
+    except ImportError:
+        return None
+
+
+def _megabytes(value):
+    return None if value is None else round(value / 1024**2, 2)
+
+
+def _difference(end, start):
+    return None if end is None or start is None else end - start
+
+
+def _maximum(*values):
+    values = [value for value in values if value is not None]
+    return max(values) if values else None
+
+
+#-------------------------------------------------------------------------------
+# Memory of a block
+#-------------------------------------------------------------------------------
+
+# Function to start sampling the memory of this process and its children in a thread
+# Returns the sampler, stopSampler gets the peaks of the block from it
+def startSampler(interval=SAMPLE_INTERVAL):
+    sampler = {"stop": threading.Event(), "self": currentRSS(), "children": childrenRSS(),
+               "high": peakRSS(), "children_high": childrenPeakRSS()}
+
+    def sample():
+        while not sampler["stop"].wait(interval):
+            sampler["self"] = _maximum(sampler["self"], currentRSS())
+            sampler["children"] = _maximum(sampler["children"], childrenRSS())
+
+    sampler["thread"] = threading.Thread(target=sample, daemon=True)
+    sampler["thread"].start()
+    return sampler
+
+
+# Function to stop a sampler and get the peaks of the block in bytes
+# The samples can miss a short spike, so a high-water mark (peakRSS, childrenPeakRSS) that
+# went up during the block is used too: it was reached in the block
+# Returns (peak of this process, peak of its children), None when unknown
+def stopSampler(sampler):
+    sampler["stop"].set()
+    sampler["thread"].join()
+
+    peaks = []
+    for key, high_key, now, high in (("self", "high", currentRSS(), peakRSS()),
+                                     ("children", "children_high", childrenRSS(), childrenPeakRSS())):
+        peak = _maximum(sampler[key], now)
+        if high is not None and sampler[high_key] is not None and high > sampler[high_key]:
+            peak = _maximum(peak, high)
+        peaks.append(peak)
+    return tuple(peaks)
+
+
+#-------------------------------------------------------------------------------
+# Recording
+#-------------------------------------------------------------------------------
+
+# Function to start recording a run report
+# profile_dir turns on cProfile for the stages, the .prof files are saved there
+def startReport(profile_dir=None):
+    global _report
+    _report = {"started": time.time(), "profile_dir": profile_dir, "records": [], "open": []}
+    return _report
+
+
+# Function to stop recording and return the report
+def stopReport():
+    global _report
+    report, _report = _report, None
+    return report
+
+
+# Function to add a record to the report (e.g. a task timed in another process)
+def addRecord(name, kind, wall_s, **values):
+    if _report is None:
+        return
+    record = dict.fromkeys(COLUMNS)
+    record.update(name=name, kind=kind, wall_s=round(wall_s, 3),
+                  parent=_report["open"][-1] if _report["open"] else None)
+    record.update(values)
+    _report["records"].append(record)
+
+
+# Context manager to time a stage or a geoprocessing call
+# name is the name in the report, kind is "stage", "tool", "task", ...
+# profile runs cProfile for the block (needs a profile_dir in startReport)
+#
+#   with profiling.timed("DistanceAccumulation Hydro", "tool"):
+#       hydro_dist = DistanceAccumulation("Hydro")
+@contextmanager
+def timed(name, kind="tool", profile=False):
+    if _report is None:
+        yield
+        return
+
+    profiler = None
+    if profile and _report["profile_dir"]:
+        profiler = cProfile.Profile()
+
+    parent = _report["open"][-1] if _report["open"] else None
+    _report["open"].append(name)
+    start_wall = time.perf_counter()
+    start_cpu = time.process_time()
+    start_children = childrenCPU()
+    start_read, start_written = ioCounters()
+    sampler = startSampler()
+    started = time.time() - _report["started"]
+    if profiler:
+        profiler.enable()
+    try:
+        yield
+    finally:
+        if profiler:
+            profiler.disable()
+        end_read, end_written = ioCounters()
+        peak, children_peak = stopSampler(sampler)
+        _report["open"].pop()
+
+        record = {
+            "name": name,
+            "kind": kind,
+            "parent": parent,
+            "start": round(started, 3),
+            "wall_s": round(time.perf_counter() - start_wall, 3),
+            "cpu_s": round(time.process_time() - start_cpu, 3),
+            "children_cpu_s": _difference(childrenCPU(), start_children),
+            "peak_rss_mb": _megabytes(peak),
+            "children_peak_rss_mb": _megabytes(children_peak),
+            "read_mb": _megabytes(_difference(end_read, start_read)),
+            "written_mb": _megabytes(_difference(end_written, start_written)),
+        }
+        if profiler:
+            record["profile"] = saveProfile(profiler, name, _report["profile_dir"])
+        _report["records"].append(record)
+
+
+# Function to save a cProfile result (.prof file) and return the top functions as text
+def saveProfile(profiler, name, profile_dir, top=20):
+    os.makedirs(profile_dir, exist_ok=True)
+    safe_name = "".join(c if c.isalnum() else "_" for c in name)
+    profiler.dump_stats(os.path.join(profile_dir, f"{safe_name}.prof"))
+
+    text = io.StringIO()
+    pstats.Stats(profiler, stream=text).sort_stats("cumulative").print_stats(top)
+    return text.getvalue()
+
+
+#-------------------------------------------------------------------------------
+# Output
+#-------------------------------------------------------------------------------
+
+# Function to write the report as JSON and/or CSV
+def writeReport(report, json_path=None, csv_path=None):
+    if json_path:
+        with open(json_path, "w") as f:
+            json.dump({"started": report["started"], "records": report["records"]}, f, indent=2)
+
+    if csv_path:
+        with open(csv_path, "w", newline="") as f:
+            writer = csv.DictWriter(f, fieldnames=COLUMNS, extrasaction="ignore")
+            writer.writeheader()
+            writer.writerows(report["records"])
+
+
+# Function to print a short summary of the stages of the report
+def printSummary(report, kind="stage"):
+    print(f"{'Name':<30}{'Wall (s)':>10}{'CPU (s)':>10}{'Peak RSS (MB)':>15}{'Workers (MB)':>15}")
+    for record in report["records"]:
+        if record["kind"] == kind:
+            print(f"{record['name']:<30}{record['wall_s']:>10}{record['cpu_s'] or '':>10}"
+                  f"{record['peak_rss_mb'] or '':>15}{record.get('children_peak_rss_mb') or '':>15}")
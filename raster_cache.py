@@ -0,0 +1,224 @@
+#-------------------------------------------------------------------------------
+# Name:        Raster Cache
+# Purpose:     Content-addressed cache for intermediate arrays/rasters across runs.
+#              Each step is keyed by a hash of its source files and parameters
+#              (out_cs, cell size, remap table, rescale function and bounds...),
+#              so changing one weight or remap value only recomputes what depends
+#              on it. The cache folder is size-bounded and evicts the least
+#              recently used entries first.
+#-------------------------------------------------------------------------------
+
+import hashlib
+import json
+import os
+
+import numpy as np
+
+
+# Default size limit of the cache folder
+MAX_BYTES = 20 * 1024**3 # 20 GB
+
+# Windows read along each side of a gdb raster for its content fingerprint, and their size in cells
+SAMPLE_WINDOWS = 4
+SAMPLE_SIZE = 256
+
+
+#-------------------------------------------------------------------------------
+# Keys
+#-------------------------------------------------------------------------------
+
+# Function to get a fingerprint of a source file, folder (gdb, grid) or gdb dataset
+# Uses the path, size and modified time of the files instead of reading them
+def fingerprint(path):
+    path = os.path.abspath(path)
+
+    # datasets inside a gdb aren't files, use the closest folder that exists
+    target = path
+    while not os.path.exists(target) and os.path.dirname(target) != target:
+        target = os.path.dirname(target)
+
+    if os.path.isfile(target):
+        stat = os.stat(target)
+        return [path, stat.st_size, stat.st_mtime_ns]
+
+    # shapefiles come with sidecar files (.dbf, .prj, ...) next to the .shp
+    files = []
+    if os.path.isdir(target):
+        for dirpath, _, filenames in os.walk(target):
+            for filename in filenames:
+                files.append(os.path.join(dirpath, filename))
+    else:
+        files = [target]
+
+    h = hashlib.sha256()
+    for f in sorted(files):
+        stat = os.stat(f)
+        h.update(f"{f}|{stat.st_size}|{stat.st_mtime_ns}\n".encode())
+    return [path, h.hexdigest()]
+
+
+# Function to get a fingerprint of the content of a gdb dataset (a gdb dataset has no file
+# of its own, so its size and modified time aren't known)
+# Feature classes and tables hash every row (geometry and attributes). Rasters hash their
+# pixel type, NoData value and grid, and the values of SAMPLE_WINDOWS x SAMPLE_WINDOWS
+# windows spread over them, a raster rewritten with changes only outside the windows keeps
+# its fingerprint
+def datasetFingerprint(path):
+    import arcpy
+
+    desc = arcpy.Describe(path)
+    h = hashlib.sha256()
+    h.update(f"{desc.dataType}|{getattr(desc, 'extent', None)}\n".encode())
+
+    if desc.dataType in ("RasterDataset", "RasterBand"):
+        raster = arcpy.Raster(path)
+        cell_x, cell_y = raster.meanCellWidth, raster.meanCellHeight
+        h.update(f"{raster.pixelType}|{raster.noDataValue}|{cell_x}|{cell_y}|{raster.width}|{raster.height}\n".encode())
+        rows, cols = min(SAMPLE_SIZE, raster.height), min(SAMPLE_SIZE, raster.width)
+        x_min, y_min = raster.extent.XMin, raster.extent.YMin
+        for row in np.linspace(0, raster.height - rows, SAMPLE_WINDOWS).astype(int):
+            for col in np.linspace(0, raster.width - cols, SAMPLE_WINDOWS).astype(int):
+                corner = arcpy.Point(x_min + col * cell_x, y_min + (raster.height - row - rows) * cell_y)
+                h.update(arcpy.RasterToNumPyArray(raster, corner, cols, rows).tobytes())
+        return h.hexdigest()[:32]
+
+    fields = [f.name for f in desc.fields if f.type not in ("OID", "Geometry", "Blob", "Raster")]
+    if hasattr(desc, "shapeType"):
+        fields = ["SHAPE@WKB"] + fields
+    with arcpy.da.SearchCursor(path, ["OID@"] + fields) as cursor:
+        for row in cursor:
+            h.update(repr(row).encode())
+    return h.hexdigest()[:32]
+
+
+# Function to get the sidecar files of a shapefile so they are part of its fingerprint
+def sourceFiles(path):
+    base, ext = os.path.splitext(path)
+    if ext.lower() != ".shp":
+        return [path]
+    folder = os.path.dirname(path) or "."
+    name = os.path.basename(base).lower()
+    return [os.path.join(folder, f) for f in sorted(os.listdir(folder))
+            if os.path.splitext(f)[0].lower() == name]
+
+
+# Function to get the cache key of a step
+# step is the step name, params is a dictionary of the parameters of the step
+# sources is a list of the source file paths the step reads
+def cacheKey(step, params, sources=()):
+    prints = []
+    for source in sources:
+        prints.extend(fingerprint(f) for f in sourceFiles(source))
+    text = json.dumps({"step": step, "params": params, "sources": prints}, sort_keys=True, default=str)
+    return f"{step}_{hashlib.sha256(text.encode()).hexdigest()[:32]}"
+
+
+#-------------------------------------------------------------------------------
+# Cache folder
+#-------------------------------------------------------------------------------
+
+# Function to get a cached array
+# Returns (array, meta dictionary) or None if the key is not in the cache
+def cacheGet(cache_dir, key):
+    array_path = os.path.join(cache_dir, f"{key}.npy")
+    meta_path = os.path.join(cache_dir, f"{key}.json")
+    if not (os.path.exists(array_path) and os.path.exists(meta_path)):
+        return None
+
+    with open(meta_path) as f:
+        meta = json.load(f)
+    array = np.load(array_path)
+
+    # touch the files so eviction knows they were used
+    os.utime(array_path)
+    os.utime(meta_path)
+    return array, meta
+
+
+# Function to add an array to the cache
+# meta is a dictionary saved next to the array (e.g. the grid of a raster)
+def cachePut(cache_dir, key, array, meta=None, max_bytes=MAX_BYTES):
+    os.makedirs(cache_dir, exist_ok=True)
+    array_path = os.path.join(cache_dir, f"{key}.npy")
+    meta_path = os.path.join(cache_dir, f"{key}.json")
+
+    # write to temporary files first so a failed run never leaves half an entry
+    with open(array_path + ".tmp", "wb") as f:
+        np.save(f, array)
+    with open(meta_path + ".tmp", "w") as f:
+        json.dump(meta or {}, f)
+    os.replace(array_path + ".tmp", array_path)
+    os.replace(meta_path + ".tmp", meta_path)
+
+    evict(cache_dir, max_bytes)
+
+
+# Function to delete the least recently used entries until the cache fits in max_bytes
+def evict(cache_dir, max_bytes=MAX_BYTES):
+    entries = {}
+    for filename in os.listdir(cache_dir):
+        key, ext = os.path.splitext(filename)
+        if ext not in (".npy", ".json"):
+            continue
+        stat = os.stat(os.path.join(cache_dir, filename))
+        size, used = entries.get(key, (0, 0))
+        entries[key] = (size + stat.st_size, max(used, stat.st_mtime))
+
+    total = sum(size for size, _ in entries.values())
+    for key, (size, _) in sorted(entries.items(), key=lambda item: item[1][1]):
+        if total <= max_bytes:
+            break
+        print(f"Evicting {key} from the cache...")
+        for ext in (".npy", ".json"):
+            path = os.path.join(cache_dir, key + ext)
+            if os.path.exists(path):
+                os.remove(path)
+        total -= size
+
+
+# Function to get an array from the cache or compute it and add it to the cache
+# compute is a function with no arguments that returns the array
+# cache_dir can be None to turn the cache off
+def cached(cache_dir, step, params, sources, compute, max_bytes=MAX_BYTES):
+    if cache_dir is None:
+        return compute()
+
+    key = cacheKey(step, params, sources)
+    hit = cacheGet(cache_dir, key)
+    if hit is not None:
+        print(f"Using cached {step}...")
+        return hit[0]
+
+    array = compute()
+    cachePut(cache_dir, key, array, {"step": step, "params": params}, max_bytes)
+    return array
+
+
+# Function to create a raster from the cache or with an arcpy function
+# compute is a function with no arguments that saves the raster to out_raster
+# On a hit the cached array is saved to out_raster instead of running compute
+# The array is cached as it is in the raster (its dtype, NoData cells hold the NoData
+# value of the meta) so a hit makes the same pixel type as a miss
+def cachedRaster(cache_dir, step, params, sources, compute, out_raster, max_bytes=MAX_BYTES):
+    import arcpy
+    import cost_engine
+
+    if cache_dir is None:
+        compute()
+        return out_raster
+
+    key = cacheKey(step, params, sources)
+    hit = cacheGet(cache_dir, key)
+    if hit is not None and "nodata" in hit[1]: # entries without it were saved as float32
+        print(f"Using cached {step}...")
+        array, meta = hit
+        return cost_engine.writeRaster(array, cost_engine.Grid(**meta["grid"]), out_raster, meta["nodata"])
+
+    compute()
+    grid = cost_engine.gridFromRaster(out_raster)
+    raster = arcpy.Raster(out_raster)
+    array = arcpy.RasterToNumPyArray(raster, arcpy.Point(grid.x_min, grid.y_min), grid.cols, grid.rows)
+    meta = {"step": step, "params": params, "grid": grid._asdict(), "nodata": raster.noDataValue,
+            "pixel_type": raster.pixelType}
+    cachePut(cache_dir, key, array, meta, max_bytes)
+    return out_raster
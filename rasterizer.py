@@ -0,0 +1,245 @@
+#-------------------------------------------------------------------------------
+# Name:        Rasterizer
+# Purpose:     In-project version of PolygonToRaster / FeatureToRaster. The
+#              features are read once as segments in grid units, then polygons are
+#              burned with a scanline fill at the cell centres and lines by
+#              sampling each segment. A remap table is applied to the feature
+#              values before the burn, so AB_Landcover goes straight to the
+#              reclassified cost. The grid is split into bands of rows that can
+#              run on several cores.
+#-------------------------------------------------------------------------------
+
+import json
+import os
+import tempfile
+from collections import namedtuple
+
+import numpy as np
+
+import cost_engine
+import task_runner
+import tiling
+
+
+# Features ready to burn
+# kind is "polygon" or "line", segments is an (n x 4) array of x0, y0, x1, y1 in
+# cells from the top left corner of the grid (sorted by their top row)
+# features is the feature number of each segment, values the burn value of each feature
+Shapes = namedtuple("Shapes", ["kind", "segments", "features", "values"])
+
+# Sample spacing along the lines in cells
+LINE_STEP = 0.5
+
+
+#-------------------------------------------------------------------------------
+# Shapes
+#-------------------------------------------------------------------------------
+
+# Function to turn Esri JSON geometries into Shapes on a grid
+# geometries is a list of dictionaries with "rings" (polygons) or "paths" (lines)
+# values is the burn value of each geometry, remap is applied to them (see cost_engine.reclassify)
+def shapesFromJSON(geometries, values, grid, remap=None):
+    top = grid.y_min + grid.rows * grid.cell
+    kind = None
+    segments, features = [], []
+    for n, geometry in enumerate(geometries):
+        if not geometry:
+            continue
+        parts = geometry.get("rings") or geometry.get("paths") or []
+        kind = kind or ("polygon" if "rings" in geometry else "line")
+        for part in parts:
+            xy = np.asarray(part, dtype=np.float64)[:, :2]
+            if len(xy) < 2:
+                continue
+            x = (xy[:, 0] - grid.x_min) / grid.cell
+            y = (top - xy[:, 1]) / grid.cell
+            segments.append(np.column_stack([x[:-1], y[:-1], x[1:], y[1:]]))
+            features.append(np.full(len(xy) - 1, n, dtype=np.int32))
+
+    values = np.asarray(values, dtype=np.float32)
+    if remap is not None:
+        values = cost_engine.reclassify(values, remap)
+    if not segments:
+        return Shapes(kind or "polygon", np.empty((0, 4)), np.empty(0, dtype=np.int32), values)
+
+    segments = np.concatenate(segments)
+    features = np.concatenate(features)
+    order = np.argsort(np.minimum(segments[:, 1], segments[:, 3]), kind="stable")
+    return Shapes(kind, segments[order], features[order], values)
+
+
+# Function to get the segments that can touch a band of rows
+def bandSegments(shapes, row0, row1, pad=0):
+    y0, y1 = shapes.segments[:, 1], shapes.segments[:, 3]
+    end = np.searchsorted(np.minimum(y0, y1), row1 + pad)
+    keep = np.maximum(y0[:end], y1[:end]) >= row0 - pad
+    return shapes.segments[:end][keep], shapes.features[:end][keep]
+
+
+# Function to expand ranges [start, start + length) into one array of indices
+def expandRanges(starts, lengths):
+    offsets = np.repeat(starts - np.cumsum(lengths) + lengths, lengths)
+    return offsets + np.arange(lengths.sum())
+
+
+# Function to put the value of the last feature of each cell into a band
+# cells is the flat index of each burned cell in the band, features the feature of each,
+# in feature order (NumPy assigns repeated indices in order, so the last feature wins)
+def paintCells(cells, features, values, shape):
+    last = np.full(shape[0] * shape[1], -1, dtype=np.int64)
+    last[cells] = features
+    out = np.full(last.size, np.nan, dtype=np.float32)
+    burned = last >= 0
+    out[burned] = values[last[burned]]
+    return out.reshape(shape)
+
+
+#-------------------------------------------------------------------------------
+# Burning
+#-------------------------------------------------------------------------------
+
+# Function to burn polygons into a band of rows (a cell is in a polygon when its
+# centre is, holes and multipart polygons use the even-odd rule)
+# Returns a float32 array (row1 - row0 x cols), NaN where there is no polygon
+def burnPolygons(shapes, row0, row1, cols):
+    segments, features = bandSegments(shapes, row0, row1)
+    x0, y0, x1, y1 = segments.T
+    low, high = np.minimum(y0, y1), np.maximum(y0, y1)
+
+    # rows whose centre line (row + 0.5) crosses each segment, top included, bottom not
+    first = np.maximum(np.ceil(low - 0.5), row0).astype(np.int64)
+    last = np.minimum(np.ceil(high - 0.5), row1).astype(np.int64)
+    counts = np.maximum(last - first, 0)
+    edge = np.repeat(np.arange(len(counts)), counts)
+    rows = expandRanges(first, counts)
+    if rows.size == 0:
+        return np.full((row1 - row0, cols), np.nan, dtype=np.float32)
+
+    yc = rows + 0.5
+    x = x0[edge] + (yc - y0[edge]) * (x1[edge] - x0[edge]) / (y1[edge] - y0[edge])
+    feature = features[edge]
+
+    # crossings of the same feature and row in order of x, filled in pairs
+    order = np.lexsort((x, rows, feature))
+    x, rows, feature = x[order], rows[order], feature[order]
+    group = np.ones(len(x), dtype=bool)
+    group[1:] = (rows[1:] != rows[:-1]) | (feature[1:] != feature[:-1])
+    starts = np.flatnonzero(group)
+    rank = np.arange(len(x)) - np.repeat(starts, np.diff(np.append(starts, len(x))))
+    pair = np.flatnonzero((rank % 2 == 0)[:-1] & ~group[1:])
+
+    c0 = np.clip(np.ceil(x[pair] - 0.5), 0, cols).astype(np.int64)
+    c1 = np.clip(np.ceil(x[pair + 1] - 0.5), 0, cols).astype(np.int64)
+    lengths = np.maximum(c1 - c0, 0)
+    cells = expandRanges((rows[pair] - row0) * cols + c0, lengths)
+    return paintCells(cells, np.repeat(feature[pair], lengths), shapes.values, (row1 - row0, cols))
+
+
+# Function to burn lines into a band of rows (every cell a line passes through,
+# found by sampling each segment every LINE_STEP cells)
+# Returns a float32 array (row1 - row0 x cols), NaN where there is no line
+def burnLines(shapes, row0, row1, cols):
+    segments, features = bandSegments(shapes, row0, row1, pad=1)
+    x0, y0, x1, y1 = segments.T
+    samples = np.ceil(np.hypot(x1 - x0, y1 - y0) / LINE_STEP).astype(np.int64) + 1
+    segment = np.repeat(np.arange(len(samples)), samples)
+    t = (np.arange(samples.sum()) - np.repeat(np.cumsum(samples) - samples, samples)) / np.maximum(samples - 1, 1)[segment]
+
+    r = np.floor(y0[segment] + t * (y1[segment] - y0[segment])).astype(np.int64)
+    c = np.floor(x0[segment] + t * (x1[segment] - x0[segment])).astype(np.int64)
+    inside = (r >= row0) & (r < row1) & (c >= 0) & (c < cols)
+    feature = features[segment][inside]
+    order = np.argsort(feature, kind="stable")
+    cells = (r[inside] - row0) * cols + c[inside]
+    return paintCells(cells[order], feature[order], shapes.values, (row1 - row0, cols))
+
+
+# Function to burn a band of rows of any kind of shapes
+def burnRows(shapes, row0, row1, cols):
+    if shapes.kind == "polygon":
+        return burnPolygons(shapes, row0, row1, cols)
+    return burnLines(shapes, row0, row1, cols)
+
+
+# Function to save Shapes to a folder so worker processes can map them
+def saveShapes(shapes, folder):
+    os.makedirs(folder, exist_ok=True)
+    for name in ("segments", "features", "values"):
+        np.save(os.path.join(folder, f"{name}.npy"), getattr(shapes, name))
+    with open(os.path.join(folder, "shapes.json"), "w") as f:
+        json.dump({"kind": shapes.kind}, f)
+    return folder
+
+
+# Function to open Shapes saved by saveShapes
+def loadShapes(folder):
+    with open(os.path.join(folder, "shapes.json")) as f:
+        kind = json.load(f)["kind"]
+    return Shapes(kind, *[tiling.openMemmap(os.path.join(folder, f"{name}.npy"))
+                          for name in ("segments", "features", "values")])
+
+
+# Function to burn a band of rows into the output memmap (a task of rasterize)
+def burnTask(shapes_dir, out_path, row0, row1):
+    out = tiling.openMemmap(out_path, "r+")
+    out[row0:row1] = burnRows(loadShapes(shapes_dir), row0, row1, out.shape[1])
+    out.flush()
+    return row1 - row0
+
+
+# Function to burn Shapes onto a grid of the given shape (rows, cols)
+# workers > 1 burns the bands of rows in worker processes into a memmap in work_dir
+# (a temporary folder by default), otherwise the bands are burned here
+def rasterize(shapes, shape, work_dir=None, workers=1, chunk_rows=1024):
+    rows, cols = shape
+    if workers <= 1 or rows <= chunk_rows:
+        out = np.empty(shape, dtype=np.float32)
+        for row0 in range(0, rows, chunk_rows):
+            out[row0:row0 + chunk_rows] = burnRows(shapes, row0, min(row0 + chunk_rows, rows), cols)
+        return out
+
+    if work_dir is None:
+        with tempfile.TemporaryDirectory() as temp:
+            return rasterize(shapes, shape, temp, workers, chunk_rows)
+
+    shapes_dir = saveShapes(shapes, os.path.join(work_dir, "Shapes"))
+    out_path = os.path.join(work_dir, "Burned.npy")
+    tiling.createMemmap(out_path, shape).flush()
+    tasks = [task_runner.task(f"Rows {row0}-{min(row0 + chunk_rows, rows)}", burnTask, shapes_dir, out_path,
+                              row0, min(row0 + chunk_rows, rows))
+             for row0 in range(0, rows, chunk_rows)]
+    task_runner.runTasks(tasks, workers)
+    return np.array(tiling.openMemmap(out_path))
+
+
+#-------------------------------------------------------------------------------
+# arcpy input
+#-------------------------------------------------------------------------------
+
+# Function to read the geometry and a value of every feature as Shapes
+# (one cursor pass, the geometry comes as Esri JSON)
+def readShapes(in_features, value_field, grid, remap=None):
+    import arcpy
+
+    geometries, values = [], []
+    with arcpy.da.SearchCursor(in_features, ["SHAPE@JSON", value_field]) as cursor:
+        for shape, value in cursor:
+            geometries.append(json.loads(shape) if shape else None)
+            values.append(np.nan if value is None else float(value))
+    return shapesFromJSON(geometries, values, grid, remap)
+
+
+# Function to convert features to an array aligned to the grid (like
+# cost_engine.featuresToArray, but burned in the project)
+# in_features is the input feature class(es), the first one wins where they overlap
+# remap is applied to the values of value_field before the burn
+def rasterizeFeatures(in_features, value_field, grid, remap=None, work_dir=None, workers=1, chunk_rows=1024):
+    if isinstance(in_features, str):
+        in_features = [in_features]
+
+    out = np.full((grid.rows, grid.cols), np.nan, dtype=np.float32)
+    for fc in in_features:
+        shapes = readShapes(fc, value_field, grid, remap)
+        array = rasterize(shapes, (grid.rows, grid.cols), work_dir, workers, chunk_rows)
+        out = np.where(np.isnan(out), array, out)
+    return out
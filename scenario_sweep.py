@@ -0,0 +1,169 @@
+#-------------------------------------------------------------------------------
+# Name:        Scenario Sweep
+# Purpose:     Evaluates many WeightedSum weightings against one set of cost factor
+#              arrays. The five factors are loaded once as a stack, the combined
+#              cost of a batch of scenarios is one tensordot over the stack, and
+#              the corridors of each scenario are solved with the corridor solver.
+#              The stack can also be the factor stack file of the cost stage,
+#              which worker processes open without copying it.
+#              Writes a comparison table of route lengths and costs per scenario.
+#-------------------------------------------------------------------------------
+
+import csv
+import itertools
+import os
+
+import numpy as np
+
+import cost_engine
+import corridor_solver
+import factor_stack
+import task_runner
+
+
+#-------------------------------------------------------------------------------
+# Scenarios
+#-------------------------------------------------------------------------------
+
+# Function to make a list of weight dictionaries from a grid of values per factor
+# values is a dictionary of {factor name: list of weights}, factors not in it keep weight 1
+# e.g. weightGrid({"Hydro": [1, 2], "Road": [1, 2, 3]}) gives 6 scenarios
+def weightGrid(values):
+    names = [name for name in cost_engine.FACTORS if name in values]
+    scenarios = []
+    for combo in itertools.product(*[values[name] for name in names]):
+        weights = dict(cost_engine.WEIGHTS)
+        weights.update(zip(names, combo))
+        scenarios.append(weights)
+    return scenarios
+
+
+# Function to turn a list of weight dictionaries into an array (scenarios x factors)
+def weightMatrix(scenarios):
+    return np.array([[scenario[name] for name in cost_engine.FACTORS] for scenario in scenarios],
+                    dtype=np.float32)
+
+
+# Function to stack the factor layers into one array (factors x rows x cols)
+# layers is the dictionary of {factor name: array} from the cost engine
+def factorStack(layers):
+    return np.stack([layers[name] for name in cost_engine.FACTORS]).astype(np.float32)
+
+
+# Function to compute the combined cost of the scenarios, a batch at a time
+# stack is the factor stack, weights is the (scenarios x factors) array
+# batch_size is how many combined cost arrays are computed together (memory vs speed)
+# Yields (scenario index, combined cost array)
+def combinedCosts(stack, weights, mask=None, batch_size=8):
+    for first in range(0, len(weights), batch_size):
+        batch = np.tensordot(weights[first:first + batch_size], stack, axes=(1, 0))
+        if mask is not None:
+            batch[:, ~mask] = np.nan
+        for n, cost in enumerate(batch):
+            yield first + n, cost
+
+
+#-------------------------------------------------------------------------------
+# Sweep
+#-------------------------------------------------------------------------------
+
+# Function to run the corridors of every scenario
+# stack is the factor stack, mask is the study area, regions is the habitat region array
+# scenarios is a list of weight dictionaries, cell is the cell size
+# solver_kwargs are passed to corridor_solver.optimalRegionConnections
+# Returns a list of (scenario index, weights, list of Route)
+def runSweep(stack, mask, regions, cell, scenarios, batch_size=8, **solver_kwargs):
+    results = []
+    for n, cost in combinedCosts(stack, weightMatrix(scenarios), mask, batch_size):
+        print(f"Solving corridors for scenario {n + 1} of {len(scenarios)}...")
+        routes = corridor_solver.optimalRegionConnections(regions, cost, cell, **solver_kwargs)
+        results.append((n, scenarios[n], routes))
+    return results
+
+
+# Function to write the comparison table (one row per scenario)
+# and a second table of every route of every scenario (<name>_routes.csv)
+def writeSweepTable(results, out_csv):
+    with open(out_csv, "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(["SCENARIO"] + [f"W_{name}" for name in cost_engine.FACTORS] +
+                        ["ROUTES", "TOTAL_LENGTH", "TOTAL_COST", "MEAN_COST_PER_M"])
+        for n, weights, routes in results:
+            length = sum(route.length for route in routes)
+            cost = sum(route.cost for route in routes)
+            writer.writerow([n] + [weights[name] for name in cost_engine.FACTORS] +
+                            [len(routes), round(length, 2), round(cost, 2),
+                             round(cost / length, 4) if length else ""])
+
+    routes_csv = os.path.splitext(out_csv)[0] + "_routes.csv"
+    with open(routes_csv, "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(["SCENARIO", "REGION1", "REGION2", "LENGTH", "COST"])
+        for n, _, routes in results:
+            for route in routes:
+                writer.writerow([n, route.region1, route.region2, round(route.length, 2), round(route.cost, 2)])
+    return out_csv
+
+
+# Function to run a sweep from the gdb data
+# workspace is the output gdb, study_area the boundary, in_regions the habitat patches
+# scenarios is a list of weight dictionaries (see weightGrid), out_csv the comparison table
+# The factors come from the cost engine (and its cache when cache_dir is set), with the
+# rasterizer of the cost stage (rasterizer_workers, see factorLayersFromGDB) so the cache
+# entries it wrote are reused
+def sweepFromGDB(workspace, study_area, in_regions, scenarios, out_csv, remap=cost_engine.LANDCOVER_REMAP,
+                 cache_dir=None, sources=None, batch_size=8, rescale=cost_engine.RESCALE, rasterizer_workers=None,
+                 **solver_kwargs):
+    import arcpy
+
+    grid, mask, layers, _ = cost_engine.factorLayersFromGDB(workspace, study_area, remap=remap, cache_dir=cache_dir,
+                                                            sources=sources, rescale=rescale,
+                                                            rasterizer_workers=rasterizer_workers)
+    stack = factorStack(layers)
+    del layers
+
+    dem_path = os.path.join(workspace, "ab_dem")
+    with arcpy.EnvManager(workspace=workspace, extent=dem_path, snapRaster=dem_path, cellSize=grid.cell):
+        regions = cost_engine.featuresToArray(in_regions, "OBJECTID", grid)
+    regions = np.nan_to_num(regions, nan=0).astype(np.int32)
+
+    print(f"Running {len(scenarios)} scenarios...")
+    results = runSweep(stack, mask, regions, grid.cell, scenarios, batch_size, **solver_kwargs)
+    return writeSweepTable(results, out_csv)
+
+
+# Function to run some of the scenarios on a factor stack (a task of sweepFromStack)
+# Every worker opens the stack read-only, so they share one copy in the page cache
+# first is the index of the first scenario, the results are numbered from it
+def sweepStackBatch(stack_path, regions, scenarios, first, batch_size, solver_kwargs):
+    stack = factor_stack.openStack(stack_path)
+    results = runSweep(factor_stack.factorBands(stack), np.asarray(stack.mask), regions, stack.grid.cell,
+                       scenarios, batch_size, **solver_kwargs)
+    return [(first + n, weights, routes) for n, weights, routes in results]
+
+
+# Function to run a sweep on a factor stack saved by the cost stage
+# stack_path is the stack folder, workspace is the output gdb with the habitat patches
+# workers is the number of processes, each one solves a share of the scenarios
+# (see sweepFromGDB for the other parameters)
+def sweepFromStack(stack_path, workspace, in_regions, scenarios, out_csv, workers=1, batch_size=8,
+                   **solver_kwargs):
+    import arcpy
+
+    grid = factor_stack.openStack(stack_path).grid
+    dem_path = os.path.join(workspace, "ab_dem")
+    with arcpy.EnvManager(workspace=workspace, extent=dem_path, snapRaster=dem_path, cellSize=grid.cell):
+        regions = cost_engine.featuresToArray(in_regions, "OBJECTID", grid)
+    regions = np.nan_to_num(regions, nan=0).astype(np.int32)
+
+    workers = max(1, min(workers, len(scenarios)))
+    share = -(-len(scenarios) // workers) # scenarios per worker, rounded up
+    tasks = [task_runner.task(f"Scenarios {first + 1}-{min(first + share, len(scenarios))}", sweepStackBatch,
+                              stack_path, regions, scenarios[first:first + share], first, batch_size, solver_kwargs)
+             for first in range(0, len(scenarios), share)]
+
+    print(f"Running {len(scenarios)} scenarios...")
+    results = []
+    for batch in task_runner.runTasks(tasks, workers).values():
+        results += batch
+    return writeSweepTable(sorted(results, key=lambda result: result[0]), out_csv)
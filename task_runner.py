@@ -0,0 +1,87 @@
+#-------------------------------------------------------------------------------
+# Name:        Task Runner
+# Purpose:     Runs a small graph of tasks (e.g. the cost factor branches) in a
+#              process pool. A task starts as soon as the tasks it depends on are
+#              finished. With one worker everything runs in order in this process.
+#-------------------------------------------------------------------------------
+
+import os
+import time
+from collections import namedtuple
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+import profiling
+
+
+# One task of the graph
+# name is a unique name, func must be a module level function (so it can be pickled)
+# args are the arguments of func, the results of the depends tasks are added after them
+Task = namedtuple("Task", ["name", "func", "args", "depends"])
+
+
+# Function to create a task
+def task(name, func, *args, depends=()):
+    return Task(name, func, args, tuple(depends))
+
+
+# Function to sort the tasks so every task comes after the tasks it depends on
+def orderTasks(tasks):
+    by_name = {t.name: t for t in tasks}
+    ordered, state = [], {}
+
+    def visit(t):
+        if state.get(t.name) == "done":
+            return
+        if state.get(t.name) == "visiting":
+            raise ValueError(f"Task {t.name} depends on itself")
+        state[t.name] = "visiting"
+        for dep in t.depends:
+            if dep not in by_name:
+                raise ValueError(f"Task {t.name} depends on unknown task {dep}")
+            visit(by_name[dep])
+        state[t.name] = "done"
+        ordered.append(t)
+
+    for t in tasks:
+        visit(t)
+    return ordered
+
+
+# Function to run the tasks
+# workers is the number of processes (None = number of cores, 1 = serial fallback)
+# initializer runs once in each worker process (e.g. licence checkout)
+# Returns a dictionary of {task name: result}
+def runTasks(tasks, workers=1, initializer=None):
+    tasks = orderTasks(tasks)
+    if workers is None:
+        workers = os.cpu_count() or 1
+    workers = min(workers, len(tasks))
+
+    results = {}
+    if workers <= 1:
+        for t in tasks:
+            print(f"Running task {t.name}...")
+            with profiling.timed(t.name, "task"):
+                results[t.name] = t.func(*t.args, *[results[d] for d in t.depends])
+        return results
+
+    print(f"Running {len(tasks)} tasks on {workers} worker processes...")
+    waiting = list(tasks)
+    running = {}
+    submitted = {}
+    with ProcessPoolExecutor(max_workers=workers, initializer=initializer) as pool:
+        while waiting or running:
+            # submit every task that has all its inputs
+            for t in [t for t in waiting if all(d in results for d in t.depends)]:
+                waiting.remove(t)
+                running[pool.submit(t.func, *t.args, *[results[d] for d in t.depends])] = t.name
+                submitted[t.name] = time.perf_counter()
+
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                name = running.pop(future)
+                results[name] = future.result() # raises the error of a failed task
+                print(f"Task {name} finished.")
+                # wall time only, the worker's CPU and memory aren't visible from here
+                profiling.addRecord(name, "task", time.perf_counter() - submitted[name])
+    return results
@@ -0,0 +1,12 @@
+#-------------------------------------------------------------------------------
+# Name:        Test configuration
+# Purpose:     Puts the repository folder on the path so the tests import the
+#              modules the same way the script does. The tests only cover the
+#              pure NumPy engines (no arcpy), each one against a brute-force
+#              reference on tiny grids.
+#-------------------------------------------------------------------------------
+
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,139 @@
+#-------------------------------------------------------------------------------
+# Name:        Connectivity tests
+# Purpose:     The network metrics against dense references: the pseudo-inverse
+#              of the Laplacian, a current solve for every pair of regions,
+#              Floyd-Warshall paths and a PC recomputed after every removal.
+#-------------------------------------------------------------------------------
+
+import itertools
+import math
+
+import numpy as np
+import pytest
+
+import connectivity
+
+
+# Function to get the least-cost distances of every pair of nodes (Floyd-Warshall)
+# keep_nodes and keep_edges are boolean masks of the nodes and edges to use
+def bruteDistances(graph, keep_nodes, keep_edges):
+    n = len(graph.nodes)
+    distances = np.full((n, n), np.inf)
+    for (u, v), cost, keep in zip(graph.edges, graph.costs, keep_edges):
+        if keep and keep_nodes[u] and keep_nodes[v]:
+            distances[u, v] = distances[v, u] = min(distances[u, v], cost)
+    np.fill_diagonal(distances, 0)
+    for k in range(n):
+        distances = np.minimum(distances, distances[:, [k]] + distances[[k], :])
+    return distances
+
+
+# Function to get the PC sum of the network without some nodes and edges
+def brutePC(graph, dispersal_cost, keep_nodes, keep_edges):
+    probability = np.exp(-bruteDistances(graph, keep_nodes, keep_edges) * math.log(2) / dispersal_cost)
+    probability[probability < connectivity.CUTOFF] = 0
+    areas = graph.areas * keep_nodes
+    return areas @ probability @ areas
+
+
+# Function to get the current-flow betweenness and effective resistance by solving the
+# currents of every pair of connected regions with the pseudo-inverse of the Laplacian
+def bruteCurrentFlow(graph):
+    n = len(graph.nodes)
+    lap = np.zeros((n, n))
+    for (u, v), cost in zip(graph.edges, graph.costs):
+        lap[[u, v], [v, u]] -= 1 / cost
+        lap[[u, v], [u, v]] += 1 / cost
+    inverse = np.linalg.pinv(lap)
+    connected = ~np.isinf(bruteDistances(graph, np.ones(n, dtype=bool), np.ones(len(graph.edges), dtype=bool)))
+
+    node_flow, edge_flow = np.zeros(n), np.zeros(len(graph.edges))
+    for s, t in itertools.combinations(range(n), 2):
+        if not connected[s, t]:
+            continue
+        potential = inverse[:, s] - inverse[:, t]
+        current = np.abs(potential[graph.edges[:, 0]] - potential[graph.edges[:, 1]]) / graph.costs
+        edge_flow += current
+        through = np.bincount(graph.edges.ravel(), weights=np.repeat(current, 2), minlength=n) / 2
+        through[[s, t]] = 0
+        node_flow += through
+
+    diagonal = np.diag(inverse)
+    resistance = np.where(connected, diagonal[:, None] + diagonal[None, :] - 2 * inverse, np.inf)
+    return node_flow, edge_flow, resistance
+
+
+# Function to make a random corridor network (a tree plus extra corridors, and an
+# isolated pair of regions when split is set)
+def randomGraph(seed, split=False):
+    rng = np.random.default_rng(seed)
+    n = int(rng.integers(4, 11))
+    regions = {10 * i + 1: float(rng.uniform(1, 5)) for i in range(n)}
+    ids = sorted(regions)
+    routes = [(ids[i], ids[int(rng.integers(0, i))], float(rng.uniform(1, 10)), 100.0) for i in range(1, n)]
+    for _ in range(int(rng.integers(0, n))):
+        i, j = rng.choice(n, 2, replace=False)
+        routes.append((ids[i], ids[j], float(rng.uniform(1, 10)), 100.0))
+    if split:
+        regions.update({1001: 2.0, 1011: 3.0})
+        routes.append((1001, 1011, 2.5, 100.0))
+    return connectivity.buildGraph(regions, routes)
+
+
+@pytest.mark.parametrize("seed, split", [(1, False), (2, False), (3, True), (4, True)])
+def testCurrentFlow(seed, split):
+    graph = randomGraph(seed, split)
+    node_flow, edge_flow, resistance = bruteCurrentFlow(graph)
+    inverses = connectivity.groundedInverses(graph)
+    np.testing.assert_allclose(connectivity.effectiveResistance(graph, inverses), resistance, atol=1e-9)
+    flows = connectivity.currentFlowBetweenness(graph, inverses)
+    np.testing.assert_allclose(flows[0], node_flow, atol=1e-9)
+    np.testing.assert_allclose(flows[1], edge_flow, atol=1e-9)
+
+
+@pytest.mark.parametrize("seed, split", [(5, False), (6, True)])
+def testShortestPathBetweenness(seed, split):
+    graph = randomGraph(seed, split)
+    n = len(graph.nodes)
+    d = bruteDistances(graph, np.ones(n, dtype=bool), np.ones(len(graph.edges), dtype=bool))
+
+    # with random costs every least-cost path is unique, a node or edge is on it when
+    # the costs through it add up to the distance
+    node_between, edge_between = np.zeros(n), np.zeros(len(graph.edges))
+    for s, t in itertools.combinations(range(n), 2):
+        if np.isinf(d[s, t]):
+            continue
+        on_path = np.isclose(d[s] + d[:, t], d[s, t])
+        on_path[[s, t]] = False
+        node_between += on_path
+        u, v = graph.edges.T
+        edge_between += np.isclose(d[s, u] + graph.costs + d[v, t], d[s, t]) | \
+            np.isclose(d[s, v] + graph.costs + d[u, t], d[s, t])
+
+    distances, predecessors = connectivity.leastCostDistances(graph)
+    result = connectivity.shortestPathBetweenness(graph, distances, predecessors)
+    np.testing.assert_array_equal(result[0], node_between)
+    np.testing.assert_array_equal(result[1], edge_between)
+
+
+@pytest.mark.parametrize("seed, split", [(7, False), (8, False), (9, True)])
+def testConnectivityLoss(seed, split):
+    graph = randomGraph(seed, split)
+    dispersal_cost = 6.0
+    metrics = connectivity.networkMetrics(graph, dispersal_cost)
+    nodes, edges = np.ones(len(graph.nodes), dtype=bool), np.ones(len(graph.edges), dtype=bool)
+    pc = brutePC(graph, dispersal_cost, nodes, edges)
+    np.testing.assert_allclose(metrics["pc"], pc)
+
+    for k in range(len(graph.nodes)):
+        keep = nodes.copy()
+        keep[k] = False
+        expected = (pc - brutePC(graph, dispersal_cost, keep, edges)) / pc * 100
+        np.testing.assert_allclose(metrics["node_dpc"][k], expected, atol=1e-6)
+    for e in range(len(graph.edges)):
+        keep = edges.copy()
+        keep[e] = False
+        expected = (pc - brutePC(graph, dispersal_cost, nodes, keep)) / pc * 100
+        np.testing.assert_allclose(metrics["edge_dpc"][e], expected, atol=1e-6)
+    np.testing.assert_allclose(metrics["node_intra"] + metrics["node_flux"] + metrics["node_connector"],
+                               metrics["node_dpc"])
@@ -0,0 +1,112 @@
+#-------------------------------------------------------------------------------
+# Name:        Corridor solver tests
+# Purpose:     Dijkstra, A* and the minimum spanning tree against brute-force
+#              relaxation and enumeration on tiny grids.
+#-------------------------------------------------------------------------------
+
+import itertools
+import math
+
+import numpy as np
+
+import corridor_solver
+
+
+# Function to get the least accumulated cost from the start cells to every cell by
+# relaxing every move until nothing changes (Bellman-Ford)
+def bruteAccumulate(cost, start, cell):
+    rows, cols = cost.shape
+    dist = np.where(start & ~np.isnan(cost), 0.0, np.inf)
+    changed = True
+    while changed:
+        changed = False
+        for r, c in itertools.product(range(rows), range(cols)):
+            if np.isnan(cost[r, c]):
+                continue
+            for dr, dc, f in corridor_solver.NEIGHBOURS:
+                rr, cc = r + dr, c + dc
+                if 0 <= rr < rows and 0 <= cc < cols and not np.isnan(cost[rr, cc]):
+                    nd = dist[rr, cc] + (cost[r, c] + cost[rr, cc]) * 0.5 * cell * f
+                    if nd < dist[r, c] - 1e-9:
+                        dist[r, c] = nd
+                        changed = True
+    return dist
+
+
+# Function to get the cost of a path of flat cell indices
+def pathCost(cost, cells, cell):
+    rows, cols = cost.shape
+    total = 0.0
+    for a, b in zip(cells, cells[1:]):
+        (ra, ca), (rb, cb) = divmod(a, cols), divmod(b, cols)
+        assert max(abs(ra - rb), abs(ca - cb)) == 1
+        f = math.sqrt(2) if ra != rb and ca != cb else 1.0
+        total += (cost[ra, ca] + cost[rb, cb]) * 0.5 * cell * f
+    return total
+
+
+def tinyLandscape(seed):
+    rng = np.random.default_rng(seed)
+    cost = rng.uniform(1, 10, (9, 10))
+    cost[4, 2:7] = np.nan # a barrier
+    regions = np.zeros(cost.shape, dtype=np.int32)
+    regions[0:2, 0:2] = 1
+    regions[7:9, 0:2] = 2
+    regions[0, 8:10] = 3
+    regions[8, 9] = 4
+    return cost, regions
+
+
+def testAccumulate():
+    cost, regions = tinyLandscape(1)
+    dist, alloc, pred = corridor_solver.accumulate(cost, regions, 25)
+    expected = bruteAccumulate(cost, regions > 0, 25)
+    np.testing.assert_allclose(dist.reshape(cost.shape), expected, rtol=1e-9)
+
+    # every cell belongs to the region its own path leads back to
+    for i in np.flatnonzero(np.isfinite(dist)):
+        path = corridor_solver.tracePath(pred, i)
+        assert regions.ravel()[path[-1]] == alloc[i]
+        assert math.isclose(pathCost(cost, path[::-1], 25), dist[i], rel_tol=1e-9)
+
+
+def testLeastCostPath():
+    cost, regions = tinyLandscape(2)
+    start, goal = regions == 1, regions == 4
+    total, cells = corridor_solver.leastCostPath(cost, start, goal, 25)
+    expected = bruteAccumulate(cost, start, 25)[goal].min()
+    assert math.isclose(total, expected, rel_tol=1e-9)
+    assert math.isclose(pathCost(cost, cells, 25), total, rel_tol=1e-9)
+    assert start.ravel()[cells[0]] and goal.ravel()[cells[-1]]
+
+
+def testMinimumSpanningTree():
+    rng = np.random.default_rng(3)
+    pairs = [(a, b) for a in range(1, 6) for b in range(a + 1, 6) if rng.random() < 0.8] + [(1, 2), (2, 3), (3, 4), (4, 5)]
+    candidates = sorted({pair: (float(rng.uniform(1, 100)), *pair) for pair in pairs}.values())
+    tree = corridor_solver.minimumSpanningTree(candidates)
+
+    # the cheapest set of 4 connections that joins the 5 regions
+    best = math.inf
+    for subset in itertools.combinations(candidates, 4):
+        joined = {1}
+        for _ in range(4):
+            joined |= {n for _, a, b in subset for n in (a, b) if a in joined or b in joined}
+        if len(joined) == 5:
+            best = min(best, sum(c for c, _, _ in subset))
+    assert len(tree) == 4
+    assert math.isclose(sum(c[0] for c in tree), best)
+
+
+def testOptimalRegionConnections():
+    cost, regions = tinyLandscape(4)
+    routes = corridor_solver.optimalRegionConnections(regions, cost, 25)
+    assert len(routes) == 3
+    for route in routes:
+        # the route is a real path between the two regions with the cost it reports, and no
+        # cheaper path between them exists
+        cells = route.cells
+        assert {regions.ravel()[cells[0]], regions.ravel()[cells[-1]]} == {route.region1, route.region2}
+        assert math.isclose(pathCost(cost, cells, 25), route.cost, rel_tol=1e-9)
+        least = bruteAccumulate(cost, regions == route.region1, 25)[regions == route.region2].min()
+        assert route.cost >= least - 1e-6
@@ -0,0 +1,98 @@
+#-------------------------------------------------------------------------------
+# Name:        Cost engine tests
+# Purpose:     The Cost Analysis arrays against cell by cell references.
+#-------------------------------------------------------------------------------
+
+import math
+
+import numpy as np
+
+import cost_engine
+
+
+# Function to compute the 3x3 range of each cell one window at a time (NaN ignored)
+def bruteFocalRange(dem):
+    rows, cols = dem.shape
+    out = np.full(dem.shape, np.nan)
+    for r in range(rows):
+        for c in range(cols):
+            if np.isnan(dem[r, c]):
+                continue
+            window = dem[max(r - 1, 0):r + 2, max(c - 1, 0):c + 2]
+            out[r, c] = np.nanmax(window) - np.nanmin(window)
+    return out
+
+
+# Function to compute the distance of each cell to the closest source cell
+def bruteDistance(sources, cell):
+    points = np.argwhere(sources)
+    out = np.zeros(sources.shape)
+    for (r, c), _ in np.ndenumerate(sources):
+        out[r, c] = min(math.hypot(r - pr, c - pc) for pr, pc in points) * cell
+    return out
+
+
+# Function to rescale one value at a time with the TfLarge formula
+def bruteRescale(values, from_scale, to_scale, spread=5):
+    lower, upper, midpoint = np.nanmin(values), np.nanmax(values), np.nanmean(values)
+    tf = lambda x: 1 / (1 + (midpoint / x) ** spread)
+    out = np.full(values.shape, np.nan)
+    with np.errstate(divide="ignore"): # a distance of 0 gives tf = 0
+        for index, x in np.ndenumerate(values):
+            if not np.isnan(x):
+                out[index] = from_scale + (tf(x) - tf(lower)) / (tf(upper) - tf(lower)) * (to_scale - from_scale)
+    return out
+
+
+def testReclassify():
+    values = np.array([[20, 31, 99], [210, np.nan, 50]])
+    out = cost_engine.reclassify(values, {"20": 10, "31": 8, "50": 3, "210": 1})
+    np.testing.assert_array_equal(out, [[10, 8, 99], [1, np.nan, 3]])
+    out = cost_engine.reclassify(values, {20: 10, 31: 8}, missing="NODATA")
+    np.testing.assert_array_equal(out, [[10, 8, np.nan], [np.nan, np.nan, np.nan]])
+
+
+def testFocalRange():
+    rng = np.random.default_rng(1)
+    dem = rng.uniform(1000, 2000, (7, 9))
+    dem[2, 3] = dem[0, 0] = np.nan
+    np.testing.assert_allclose(cost_engine.focalRange(dem), bruteFocalRange(dem), rtol=1e-5)
+
+
+def testRescaleByFunction():
+    rng = np.random.default_rng(2)
+    values = rng.uniform(1, 500, (6, 5))
+    values[1, 1] = np.nan
+    for scales in ((10, 1), (1, 10)):
+        np.testing.assert_allclose(cost_engine.rescaleByFunction(values, *scales), bruteRescale(values, *scales),
+                                   rtol=1e-4, atol=1e-4)
+    flat = cost_engine.rescaleByFunction(np.full((2, 2), 7.0), 10, 1)
+    np.testing.assert_array_equal(flat, 10)
+
+
+def testEuclideanDistance():
+    rng = np.random.default_rng(3)
+    sources = rng.random((9, 11)) < 0.08
+    sources[4, 5] = True
+    np.testing.assert_allclose(cost_engine.euclideanDistance(sources, 25), bruteDistance(sources, 25), rtol=1e-5)
+
+
+def testCombinedCost():
+    rng = np.random.default_rng(4)
+    shape = (8, 10)
+    landcover = rng.choice(list(cost_engine.LANDCOVER_REMAP), shape).astype(np.float64)
+    hydro, trails, road = (rng.random(shape) < 0.1 for _ in range(3))
+    dem = rng.uniform(1200, 1800, shape)
+    mask = np.ones(shape, dtype=bool)
+    mask[0, :3] = False
+    weights = {"Landcover": 1, "Hydro": 2, "Trails": 0.5, "Road": 1, "TerrainR": 3}
+
+    expected = weights["Landcover"] * np.vectorize(cost_engine.LANDCOVER_REMAP.get)(landcover.astype(int))
+    for name, sources in (("Hydro", hydro), ("Trails", trails), ("Road", road)):
+        distance = np.where(mask, bruteDistance(sources, 25), np.nan)
+        expected = expected + weights[name] * bruteRescale(distance, *cost_engine.RESCALE[name])
+    terrain = np.where(mask, bruteFocalRange(dem), np.nan)
+    expected = expected + weights["TerrainR"] * bruteRescale(terrain, *cost_engine.RESCALE["TerrainR"])
+
+    out = cost_engine.combinedCost(landcover, hydro, trails, road, dem, 25, mask, weights=weights)
+    np.testing.assert_allclose(out, expected, rtol=1e-4, atol=1e-3)
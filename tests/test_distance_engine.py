@@ -0,0 +1,58 @@
+#-------------------------------------------------------------------------------
+# Name:        Distance engine tests
+# Purpose:     The linear-time distance transform against the distance to every
+#              source cell.
+#-------------------------------------------------------------------------------
+
+import numpy as np
+import pytest
+
+import cost_engine
+import distance_engine
+
+
+# Function to get the distance of each cell to its closest source cell (inf without sources)
+def bruteDistance(sources, cell):
+    points = np.argwhere(sources)
+    rows, cols = np.indices(sources.shape)
+    if len(points) == 0:
+        return np.full(sources.shape, np.inf)
+    d2 = (rows[..., None] - points[:, 0]) ** 2 + (cols[..., None] - points[:, 1]) ** 2
+    return np.sqrt(d2.min(axis=-1)) * cell
+
+
+def testEuclideanDistance():
+    rng = np.random.default_rng(1)
+    for shape, share in (((1, 9), 0.2), ((12, 7), 0.05), ((15, 16), 0.01), ((6, 6), 0.6)):
+        sources = rng.random(shape) < share
+        sources.flat[rng.integers(sources.size)] = True
+        np.testing.assert_allclose(distance_engine.euclideanDistance(sources, 25), bruteDistance(sources, 25),
+                                   rtol=1e-6)
+
+
+def testStackAndChunks():
+    rng = np.random.default_rng(2)
+    stack = rng.random((3, 10, 11)) < 0.04
+    stack[2] = False # a layer without sources is inf everywhere
+    out = distance_engine.euclideanDistance(stack, 10, chunk_lines=3)
+    for layer, sources in zip(out, stack):
+        np.testing.assert_allclose(layer, bruteDistance(sources, 10), rtol=1e-6)
+
+
+def testDistanceFactors():
+    rng = np.random.default_rng(3)
+    layers = {name: rng.random((9, 12)) < 0.06 for name in ("Hydro", "Trails", "Road")}
+    mask = np.ones((9, 12), dtype=bool)
+    mask[-1] = False
+    factors = distance_engine.distanceFactors(distance_engine.labelGrid(layers), 25, mask)
+    for name, sources in layers.items():
+        expected = cost_engine.rescaleByFunction(np.where(mask, bruteDistance(sources, 25), np.nan),
+                                                 *cost_engine.RESCALE[name])
+        np.testing.assert_allclose(factors[name], expected, rtol=1e-5, atol=1e-5)
+
+
+def testDistanceFactorsWithoutSources():
+    labels = distance_engine.labelGrid({"Hydro": np.eye(5, dtype=bool), "Trails": np.eye(5, dtype=bool),
+                                        "Road": np.zeros((5, 5), dtype=bool)})
+    with pytest.raises(ValueError):
+        distance_engine.distanceFactors(labels, 25)
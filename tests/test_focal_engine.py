@@ -0,0 +1,85 @@
+#-------------------------------------------------------------------------------
+# Name:        Focal engine tests
+# Purpose:     The sliding min/max and integral image statistics against the
+#              values of every window, and the bands of rows against one pass.
+#-------------------------------------------------------------------------------
+
+import numpy as np
+
+import focal_engine
+
+
+# Function to get the valid values of the window of a cell and the (row, col) of each one
+def window(values, r, c, size):
+    half = size // 2
+    rows, cols = np.mgrid[max(r - half, 0):min(r + half + 1, values.shape[0]),
+                          max(c - half, 0):min(c + half + 1, values.shape[1])]
+    keep = ~np.isnan(values[rows, cols])
+    return values[rows, cols][keep], rows[keep], cols[keep]
+
+
+# Function to get the unit normal of one cell with Horn's method (NaN at the edge or next to NoData)
+def bruteNormal(dem, r, c, cell):
+    if r == 0 or c == 0 or r == dem.shape[0] - 1 or c == dem.shape[1] - 1:
+        return np.full(3, np.nan)
+    z = dem[r - 1:r + 2, c - 1:c + 2].astype(np.float64)
+    dz_dx = ((z[0, 2] + 2 * z[1, 2] + z[2, 2]) - (z[0, 0] + 2 * z[1, 0] + z[2, 0])) / (8 * cell)
+    dz_dy = ((z[2, 0] + 2 * z[2, 1] + z[2, 2]) - (z[0, 0] + 2 * z[0, 1] + z[0, 2])) / (8 * cell)
+    normal = np.array([-dz_dx, -dz_dy, 1.0])
+    return normal / np.linalg.norm(normal)
+
+
+# Function to compute the focal statistics of every cell from its window
+def bruteFocal(dem, size, cell):
+    normals = np.array([[bruteNormal(dem, r, c, cell) for c in range(dem.shape[1])] for r in range(dem.shape[0])])
+    has_normal = ~np.isnan(normals[..., 0])
+    out = {key: np.full(dem.shape, np.nan) for key in focal_engine.STATISTICS}
+    for r, c in np.argwhere(~np.isnan(dem)):
+        v, rows, cols = window(dem.astype(np.float64), r, c, size)
+        out["range"][r, c] = v.max() - v.min()
+        out["std"][r, c] = v.std()
+        out["tri"][r, c] = np.sqrt(((v - float(dem[r, c])) ** 2).sum())
+        _, rows, cols = window(np.where(has_normal, 0.0, np.nan), r, c, size)
+        if len(rows):
+            out["vrm"][r, c] = 1 - np.linalg.norm(normals[rows, cols].sum(axis=0)) / len(rows)
+    return out
+
+
+# Function to make a small DEM with a NoData hole and a NoData corner
+def tinyDEM():
+    rng = np.random.default_rng(1)
+    dem = (1200 + np.cumsum(rng.normal(0, 8, (13, 16)), axis=1)).astype(np.float32)
+    dem[5:7, 6:8] = np.nan
+    dem[:2, -3:] = np.nan
+    return dem
+
+
+def testSlidingMax():
+    rng = np.random.default_rng(2)
+    values = rng.random((4, 11))
+    for size in (1, 3, 5, 7, 13, 25):
+        half = size // 2
+        expected = [[values[i, max(j - half, 0):j + half + 1].max() for j in range(11)] for i in range(4)]
+        np.testing.assert_array_equal(focal_engine.slidingMax(values, size, 1), expected)
+        np.testing.assert_array_equal(focal_engine.slidingMax(values.T, size, 0), np.transpose(expected))
+
+
+def testFocalStatistics():
+    dem = tinyDEM()
+    sizes = [3, 5, 9]
+    out = focal_engine.focalStatistics(dem, sizes, cell=25)
+    for size in sizes:
+        expected = bruteFocal(dem, size, 25)
+        for statistic in focal_engine.STATISTICS:
+            np.testing.assert_allclose(out[(statistic, size)], expected[statistic], rtol=1e-4, atol=1e-4,
+                                       err_msg=f"{statistic} {size}")
+
+
+def testTiledFocalStatistics(tmp_path):
+    dem = tinyDEM()
+    dem_path = str(tmp_path / "dem.npy")
+    np.save(dem_path, dem)
+    tiled = focal_engine.tiledFocalStatistics(dem_path, str(tmp_path / "out"), sizes=[3, 9], chunk_rows=4)
+    whole = focal_engine.focalStatistics(dem, [3, 9])
+    for key, values in whole.items():
+        np.testing.assert_allclose(np.asarray(tiled[key]), values, rtol=1e-5, atol=1e-3, err_msg=str(key))
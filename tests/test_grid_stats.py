@@ -0,0 +1,38 @@
+#-------------------------------------------------------------------------------
+# Name:        Grid statistics tests
+# Purpose:     The bincount group sums and zonal means against a loop over
+#              every key and zone.
+#-------------------------------------------------------------------------------
+
+import numpy as np
+
+import grid_stats
+
+
+def testGroupSum():
+    rng = np.random.default_rng(1)
+    keys = rng.choice(np.array(["Forest", "Water", "Rock", "Grass"]), 40)
+    values = rng.random(40) * 100
+    unique, sums, counts = grid_stats.groupSum(keys, values)
+    assert list(unique) == sorted(set(keys))
+    for key, total, count in zip(unique, sums, counts):
+        np.testing.assert_allclose(total, values[keys == key].sum())
+        assert count == (keys == key).sum()
+
+
+def testZonalMeans():
+    rng = np.random.default_rng(2)
+    values = rng.random((11, 13)) * 2000
+    values[rng.random(values.shape) < 0.2] = np.nan
+    zones = rng.integers(0, 6, values.shape)
+    zones[zones == 4] = 0 # a zone id with no cells is left out
+    ids, means, counts = grid_stats.zonalMeans(values, zones)
+
+    expected = {}
+    for zone, value in zip(zones.ravel(), values.ravel()):
+        if zone > 0 and not np.isnan(value):
+            expected.setdefault(zone, []).append(value)
+    assert list(ids) == sorted(expected)
+    for zone, mean, count in zip(ids, means, counts):
+        np.testing.assert_allclose(mean, np.mean(expected[zone]))
+        assert count == len(expected[zone])
@@ -0,0 +1,97 @@
+#-------------------------------------------------------------------------------
+# Name:        Rasterizer tests
+# Purpose:     The scanline polygon fill and the line burn against a test of
+#              every cell centre and every cell box.
+#-------------------------------------------------------------------------------
+
+import numpy as np
+
+import cost_engine
+import rasterizer
+
+
+# Grid of the tests (18 x 21 cells of 10 m)
+GRID = cost_engine.Grid(1000.0, 5000.0, 10.0, 18, 21, None)
+
+
+# Function to test if a point is in the rings of a polygon (even-odd rule)
+def insideRings(x, y, rings):
+    inside = False
+    for ring in rings:
+        for (xa, ya), (xb, yb) in zip(ring[:-1], ring[1:]):
+            if (ya > y) != (yb > y) and x < xa + (y - ya) * (xb - xa) / (yb - ya):
+                inside = not inside
+    return inside
+
+
+# Function to burn polygons by testing the centre of every cell (the last polygon wins)
+def brutePolygons(geometries, values, grid):
+    out = np.full((grid.rows, grid.cols), np.nan, dtype=np.float32)
+    top = grid.y_min + grid.rows * grid.cell
+    for r in range(grid.rows):
+        for c in range(grid.cols):
+            x, y = grid.x_min + (c + 0.5) * grid.cell, top - (r + 0.5) * grid.cell
+            for geometry, value in zip(geometries, values):
+                if insideRings(x, y, geometry["rings"]):
+                    out[r, c] = value
+    return out
+
+
+# Function to get the length of a segment inside a cell box (Liang-Barsky clip), None if it misses the box
+def clipLength(x0, y0, x1, y1, r, c):
+    t0, t1 = 0.0, 1.0
+    for p, q in ((x0 - x1, x0 - c), (x1 - x0, c + 1 - x0), (y0 - y1, y0 - r), (y1 - y0, r + 1 - y0)):
+        if p == 0:
+            if q < 0:
+                return None
+        elif p < 0:
+            t0 = max(t0, q / p)
+        else:
+            t1 = min(t1, q / p)
+    return np.hypot(x1 - x0, y1 - y0) * (t1 - t0) if t0 <= t1 else None
+
+
+# Function to make polygons with a hole, two parts and an overlap, away from the cell centres
+def polygons():
+    x, y = GRID.x_min, GRID.y_min
+    square = [[x + 12.3, y + 13.1], [x + 121.7, y + 13.1], [x + 121.7, y + 152.9], [x + 12.3, y + 152.9],
+              [x + 12.3, y + 13.1]]
+    hole = [[x + 40.2, y + 50.4], [x + 80.6, y + 50.4], [x + 80.6, y + 90.8], [x + 40.2, y + 50.4]]
+    triangle = [[x + 90.4, y + 30.3], [x + 203.1, y + 95.2], [x + 110.9, y + 171.6], [x + 90.4, y + 30.3]]
+    island = [[x + 150.2, y + 10.7], [x + 198.4, y + 10.7], [x + 170.1, y + 52.3], [x + 150.2, y + 10.7]]
+    return [{"rings": [square, hole]}, {"rings": [triangle, island]}, {}], [1, 2, 3]
+
+
+def testBurnPolygons():
+    geometries, values = polygons()
+    shapes = rasterizer.shapesFromJSON(geometries, values, GRID)
+    expected = brutePolygons(geometries[:2], values[:2], GRID)
+    for chunk_rows in (1024, 5):
+        out = rasterizer.rasterize(shapes, (GRID.rows, GRID.cols), chunk_rows=chunk_rows)
+        np.testing.assert_array_equal(out, expected)
+
+
+def testRemap():
+    geometries, values = polygons()
+    shapes = rasterizer.shapesFromJSON(geometries, values, GRID, remap={1: 50, 2: 5, 3: 1})
+    out = rasterizer.rasterize(shapes, (GRID.rows, GRID.cols))
+    expected = brutePolygons(geometries[:2], [50, 5], GRID)
+    np.testing.assert_array_equal(out, expected)
+
+
+def testBurnLines():
+    x, y = GRID.x_min, GRID.y_min
+    path = [[x + 3.3, y + 171.2], [x + 202.6, y + 98.1], [x + 61.7, y + 7.9], [x + 64.2, y + 150.4]]
+    shapes = rasterizer.shapesFromJSON([{"paths": [path]}], [7], GRID)
+    out = rasterizer.rasterize(shapes, (GRID.rows, GRID.cols), chunk_rows=4)
+
+    # every burned cell is crossed by the line and every cell the line crosses for more
+    # than one sample step is burned
+    for r in range(GRID.rows):
+        for c in range(GRID.cols):
+            lengths = [clipLength(*segment, r, c) for segment in shapes.segments]
+            lengths = [length for length in lengths if length is not None]
+            if out[r, c] == 7:
+                assert lengths, (r, c)
+            else:
+                assert np.isnan(out[r, c]) and max(lengths, default=0) <= rasterizer.LINE_STEP, (r, c)
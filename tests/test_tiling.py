@@ -0,0 +1,38 @@
+#-------------------------------------------------------------------------------
+# Name:        Tiling tests
+# Purpose:     The tiled cost pipeline against the in-memory cost engine.
+#-------------------------------------------------------------------------------
+
+import numpy as np
+
+import cost_engine
+import tiling
+
+
+def testIterTilesCoversTheGrid():
+    seen = np.zeros((11, 13), dtype=int)
+    for tile in tiling.iterTiles(11, 13, 4, halo=2):
+        seen[tile.row0:tile.row1, tile.col0:tile.col1] += 1
+    np.testing.assert_array_equal(seen, 1)
+
+
+def testTiledCombinedCost(tmp_path):
+    rng = np.random.default_rng(1)
+    shape = (13, 17)
+    mask = np.ones(shape, dtype=bool)
+    mask[:2, :4] = False
+    inputs = {
+        "landcover": rng.choice(list(cost_engine.LANDCOVER_REMAP), shape).astype(np.float32),
+        "hydro": rng.random(shape) < 0.05,
+        "trails": rng.random(shape) < 0.05,
+        "road": rng.random(shape) < 0.05,
+        "dem": rng.uniform(1200, 1800, shape).astype(np.float32),
+        "mask": mask,
+    }
+
+    # distances capped past the grid are exact, so the tiles must give the in-memory result
+    out = tiling.tiledCombinedCost(inputs, 25, str(tmp_path), str(tmp_path / "cost.npy"), tile_size=5,
+                                   max_distance=25 * 30)
+    expected = cost_engine.combinedCost(inputs["landcover"], inputs["hydro"], inputs["trails"], inputs["road"],
+                                        inputs["dem"], 25, mask)
+    np.testing.assert_allclose(np.asarray(out), expected, rtol=1e-4, atol=1e-4)
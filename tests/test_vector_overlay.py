@@ -0,0 +1,100 @@
+#-------------------------------------------------------------------------------
+# Name:        Vector overlay tests
+# Purpose:     The STR tree against a test of every pair of boxes and the
+#              tiled overlay against an exact test of every feature and every
+#              boundary edge.
+#-------------------------------------------------------------------------------
+
+import numpy as np
+import pytest
+
+import vector_overlay
+
+
+# Function to check if two segments cross (the test geometries have no touching or collinear segments)
+def crosses(a, b):
+    def orient(p, q, r):
+        return np.sign((q[0] - p[0]) * (r[1] - p[1]) - (q[1] - p[1]) * (r[0] - p[0]))
+
+    p, q, r, s = a[:2], a[2:], b[:2], b[2:]
+    return orient(p, q, r) != orient(p, q, s) and orient(r, s, p) != orient(r, s, q)
+
+
+# Function to test if a point is in the rings of polygons (even-odd rule)
+def insideRings(point, rings):
+    inside = False
+    for ring in rings:
+        for (xa, ya), (xb, yb) in zip(ring[:-1], ring[1:]):
+            if (ya > point[1]) != (yb > point[1]) and point[0] < xa + (point[1] - ya) * (xb - xa) / (yb - ya):
+                inside = not inside
+    return inside
+
+
+# Function to classify a geometry against the boundary rings with no index or tiles
+def bruteClass(geometry, boundary_rings):
+    parts = geometry.get("rings") or geometry.get("paths")
+    edges = [ring[i] + ring[i + 1] for ring in boundary_rings for i in range(len(ring) - 1)]
+    for part in parts:
+        for i in range(len(part) - 1):
+            if any(crosses(np.array(part[i] + part[i + 1]), np.array(edge)) for edge in edges):
+                return vector_overlay.CROSSING
+    if "rings" in geometry and any(insideRings(ring[0], parts) for ring in boundary_rings):
+        return vector_overlay.CROSSING
+    return vector_overlay.INSIDE if insideRings(parts[0][0], boundary_rings) else vector_overlay.OUTSIDE
+
+
+# Function to make a boundary of two parts (a ring with a hole and an island)
+def boundaryRings():
+    angles = np.linspace(0, 2 * np.pi, 23)[:-1]
+    radius = 400 + 120 * np.sin(5 * angles)
+    outer = np.column_stack([500 + radius * np.cos(angles), 500 + radius * np.sin(angles)]).tolist()
+    hole = [[430.3, 440.1], [430.3, 560.7], [570.2, 560.7], [570.2, 440.1]]
+    island = [[1300.4, 200.2], [1420.9, 260.7], [1360.1, 390.3]]
+    return [ring + ring[:1] for ring in (outer, hole[::-1], island)]
+
+
+# Function to make random lines or triangles of many sizes over the boundary
+def randomGeometries(kind, count, seed):
+    rng = np.random.default_rng(seed)
+    geometries = []
+    for _ in range(count):
+        centre = rng.uniform(-200, 1600, 2)
+        points = (centre + rng.normal(0, rng.choice([5, 40, 300]), (3, 2))).round(3).tolist()
+        geometries.append({"rings": [points + points[:1]]} if kind == "polygon" else {"paths": [points]})
+    if kind == "polygon":
+        # a polygon around the island and one in the hole, with no edge crossing
+        for x0, y0, x1, y1 in ((1250.5, 150.5, 1480.5, 450.5), (440.5, 450.5, 560.5, 550.5)):
+            geometries.append({"rings": [[[x0, y0], [x0, y1], [x1, y1], [x1, y0], [x0, y0]]]})
+    return geometries
+
+
+def testQueryIndex():
+    rng = np.random.default_rng(1)
+    corners = rng.uniform(0, 1000, (500, 2))
+    boxes = np.hstack([corners, corners + rng.uniform(0, 60, (500, 2))])
+    corners = rng.uniform(0, 1000, (80, 2))
+    queries = np.hstack([corners, corners + rng.uniform(0, 200, (80, 2))])
+    for capacity in (4, 16):
+        index = vector_overlay.buildIndex(boxes, capacity)
+        found = set(zip(*vector_overlay.queryIndex(index, queries)))
+        expected = {(q, i) for q in range(80) for i in range(500)
+                    if vector_overlay.boxesOverlap(queries[q:q + 1], boxes[i:i + 1])[0]}
+        assert found == expected
+
+
+@pytest.mark.parametrize("kind", ["polygon", "line"])
+def testOverlay(kind):
+    rings = boundaryRings()
+    boundary = vector_overlay.featuresFromJSON([{"rings": rings}])
+    geometries = randomGeometries(kind, 300, 2)
+    features = vector_overlay.featuresFromJSON(geometries)
+    expected = [bruteClass(geometry, rings) for geometry in geometries]
+    assert len(set(expected)) == 3
+    for tiles in (4, 64):
+        classes = vector_overlay.overlay(features, boundary, chunk_size=70, tiles=tiles)
+        np.testing.assert_array_equal(classes, expected)
+
+
+def testPointsAreNotSupported():
+    with pytest.raises(ValueError):
+        vector_overlay.featuresFromJSON([{"x": 1.0, "y": 2.0}])
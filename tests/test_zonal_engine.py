@@ -0,0 +1,70 @@
+#-------------------------------------------------------------------------------
+# Name:        Zonal engine tests
+# Purpose:     The one-pass zone statistics and histograms against NumPy run on
+#              the cells of each zone, and the path buffers against a check of
+#              every cell.
+#-------------------------------------------------------------------------------
+
+import numpy as np
+
+import zonal_engine
+
+
+# Function to get the cells of each zone of a Members (one array per zone)
+def zoneCells(members):
+    return [members.cells[members.zones == n] for n in range(len(members.names))]
+
+
+def testBufferMembers():
+    shape = (12, 14)
+    paths = [np.array([0, 15, 30, 45]), np.array([5 * 14 + 6, 5 * 14 + 7]), np.array([167])]
+    members = zonal_engine.bufferMembers(paths, shape, 2.5, names=["a", "b", "c"])
+    assert members.names == ["a", "b", "c"]
+
+    rows, cols = np.indices(shape)
+    for path, cells in zip(paths, zoneCells(members)):
+        r, c = np.divmod(path, shape[1])
+        near = ((rows.ravel()[:, None] - r) ** 2 + (cols.ravel()[:, None] - c) ** 2 <= 2.5 ** 2).any(axis=1)
+        assert sorted(cells) == list(np.flatnonzero(near))
+
+
+def testZonalStatistics():
+    rng = np.random.default_rng(1)
+    values = rng.random((10, 12)) * 100
+    values[rng.random(values.shape) < 0.15] = np.nan
+    classes = rng.integers(1, 5, values.shape).astype(np.float64)
+    classes[0, :4] = np.nan
+
+    # overlapping buffers, a single cell and a zone that is all NoData
+    paths = [np.arange(20, 30), np.array([27, 39, 51]), np.array([100])]
+    members = zonal_engine.bufferMembers(paths, values.shape, 1.5)
+    nodata = np.flatnonzero(np.isnan(values))[:2]
+    members = zonal_engine.Members(np.concatenate([members.cells, nodata]),
+                                   np.concatenate([members.zones, np.full(len(nodata), 3)]), members.names + [4])
+
+    result = zonal_engine.zonalStatistics(members, {"v": values}, classes, percentiles=(0, 25, 50, 90, 100))
+    stats = result["values"]["v"]
+    for n, cells in enumerate(zoneCells(members)):
+        v = values.ravel()[cells]
+        v = v[~np.isnan(v)]
+        assert result["cells"][n] == len(cells)
+        assert stats["count"][n] == len(v)
+        if len(v) == 0:
+            assert all(np.isnan(stats[key][n]) for key in ("mean", "std", "min", "max", "p50"))
+        else:
+            np.testing.assert_allclose([stats["mean"][n], stats["std"][n], stats["min"][n], stats["max"][n]],
+                                       [v.mean(), v.std(), v.min(), v.max()])
+            for q in (0, 25, 50, 90, 100):
+                np.testing.assert_allclose(stats[f"p{q}"][n], np.percentile(v, q))
+
+        c = classes.ravel()[cells]
+        c = c[~np.isnan(c)]
+        np.testing.assert_array_equal(result["histogram"][n], [(c == code).sum() for code in result["classes"]])
+
+
+def testLabelMembers():
+    labels = np.array([[0, 3, 3], [7, 0, 3], [7, 7, 0]])
+    members = zonal_engine.labelMembers(labels, {7: "seven"})
+    assert members.names == [3, "seven"]
+    cells = zoneCells(members)
+    assert list(cells[0]) == [1, 2, 5] and list(cells[1]) == [3, 6, 7]
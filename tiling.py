@@ -0,0 +1,294 @@
+#-------------------------------------------------------------------------------
+# Name:        Tiling
+# Purpose:     Tiled, out-of-core version of the NumPy cost pipeline for extents
+#              that don't fit in memory (e.g. all of Alberta at 25 m).
+#              The extent is split into fixed-size tiles with a halo sized to each
+#              operator, the tiles are streamed through memory-mapped arrays and
+#              the tile cores are mosaicked into the output.
+#-------------------------------------------------------------------------------
+
+import math
+import os
+from collections import namedtuple
+
+import numpy as np
+
+import cost_engine
+
+
+# One tile of the grid
+# row0, row1, col0, col1 is the core of the tile (what gets written to the output)
+# the halo_ values are the window that is read (core plus the halo, cut at the grid edge)
+Tile = namedtuple("Tile", ["row0", "row1", "col0", "col1",
+                           "halo_row0", "halo_row1", "halo_col0", "halo_col1"])
+
+# Halo in cells needed by each operator
+# Focal RANGE uses a 3x3 window so it needs 1 cell, distances depend on max_distance
+FOCAL_HALO = 1
+
+
+#-------------------------------------------------------------------------------
+# Tiles
+#-------------------------------------------------------------------------------
+
+# Function to get the halo (in cells) for a distance operator
+# max_distance is the largest distance that has to be exact, in meters
+def distanceHalo(max_distance, cell):
+    return int(math.ceil(max_distance / cell))
+
+
+# Function to split a grid into tiles
+# rows, cols is the size of the grid, tile_size is the core size in cells
+# halo is the number of cells of overlap read around each core
+def iterTiles(rows, cols, tile_size, halo=0):
+    for row0 in range(0, rows, tile_size):
+        row1 = min(row0 + tile_size, rows)
+        for col0 in range(0, cols, tile_size):
+            col1 = min(col0 + tile_size, cols)
+            yield Tile(row0, row1, col0, col1,
+                       max(row0 - halo, 0), min(row1 + halo, rows),
+                       max(col0 - halo, 0), min(col1 + halo, cols))
+
+
+# Function to get the window (with halo) of a tile from an array or memmap
+def readWindow(array, tile):
+    return array[tile.halo_row0:tile.halo_row1, tile.halo_col0:tile.halo_col1]
+
+
+# Function to get the core of a tile out of an array computed on its window
+def cropCore(window, tile):
+    top = tile.row0 - tile.halo_row0
+    left = tile.col0 - tile.halo_col0
+    return window[top:top + tile.row1 - tile.row0, left:left + tile.col1 - tile.col0]
+
+
+# Function to write the core of a tile into the output (mosaic)
+def writeCore(out, tile, window):
+    out[tile.row0:tile.row1, tile.col0:tile.col1] = cropCore(window, tile)
+
+
+# Function to create a memory-mapped array on disk (.npy file)
+def createMemmap(path, shape, dtype=np.float32, fill=np.nan):
+    out = np.lib.format.open_memmap(path, mode="w+", dtype=dtype, shape=shape)
+    for row0 in range(0, shape[0], 1024):
+        out[row0:row0 + 1024] = fill
+    return out
+
+
+# Function to open an existing memory-mapped array
+def openMemmap(path, mode="r"):
+    return np.load(path, mmap_mode=mode)
+
+
+#-------------------------------------------------------------------------------
+# Tiled operators
+#-------------------------------------------------------------------------------
+
+# Running min/max/sum/count of the values written by a tiled operator,
+# RescaleByFunction needs them for the whole extent and not per tile
+def newStats():
+    return {"min": np.inf, "max": -np.inf, "sum": 0.0, "count": 0}
+
+
+def updateStats(stats, values):
+    values = values[~np.isnan(values)]
+    if values.size:
+        stats["min"] = min(stats["min"], float(values.min()))
+        stats["max"] = max(stats["max"], float(values.max()))
+        stats["sum"] += float(values.sum(dtype=np.float64))
+        stats["count"] += values.size
+
+
+# Function to compute the focal range tile by tile
+# dem, mask, out are arrays or memmaps of the same shape
+def tiledFocalRange(dem, mask, out, tile_size):
+    stats = newStats()
+    for tile in iterTiles(dem.shape[0], dem.shape[1], tile_size, FOCAL_HALO):
+        window = cost_engine.focalRange(np.asarray(readWindow(dem, tile)))
+        window[~readWindow(mask, tile)] = np.nan
+        writeCore(out, tile, window)
+        updateStats(stats, cropCore(window, tile))
+    return stats
+
+
+# Function to compute the distance to the source cells tile by tile
+# Distances are exact up to max_distance and capped at max_distance past it
+# sources, mask, out are arrays or memmaps of the same shape
+def tiledDistance(sources, mask, out, cell, max_distance, tile_size):
+    stats = newStats()
+    halo = distanceHalo(max_distance, cell)
+    for tile in iterTiles(sources.shape[0], sources.shape[1], tile_size, halo):
+        window_sources = np.asarray(readWindow(sources, tile), dtype=bool)
+        if window_sources.any():
+            window = np.minimum(cost_engine.euclideanDistance(window_sources, cell), max_distance)
+        else:
+            window = np.full(window_sources.shape, max_distance, dtype=np.float32)
+        window[~readWindow(mask, tile)] = np.nan
+        writeCore(out, tile, window)
+        updateStats(stats, cropCore(window, tile))
+    return stats
+
+
+# Function to run the whole cost pipeline tile by tile
+# inputs is a dictionary of arrays/memmaps: landcover, hydro, trails, road, dem, mask
+# work_dir holds the memmaps of the distance and ruggedness fields
+# out_path is the .npy file for the combined cost
+# Pass 1 computes the distance/ruggedness fields and their statistics for the whole
+# extent, pass 2 rescales them and does the weighted sum
+# stack is a writable factor stack (factor_stack.createStack) that gets the rescaled
+# factors of each tile in pass 2, or None
+def tiledCombinedCost(inputs, cell, work_dir, out_path, tile_size=2048, max_distance=5000,
+                      remap=cost_engine.LANDCOVER_REMAP, weights=cost_engine.WEIGHTS, rescale=cost_engine.RESCALE,
+                      stack=None):
+    shape = inputs["dem"].shape
+    mask = inputs["mask"]
+
+    fields = {}
+    stats = {}
+    for name in ("Hydro", "Trails", "Road"):
+        print(f"Computing {name} distance tile by tile...")
+        fields[name] = createMemmap(os.path.join(work_dir, f"{name}_Dist.npy"), shape)
+        stats[name] = tiledDistance(inputs[name.lower()], mask, fields[name], cell, max_distance, tile_size)
+
+    print("Computing terrain ruggedness tile by tile...")
+    fields["TerrainR"] = createMemmap(os.path.join(work_dir, "TerrainR.npy"), shape)
+    stats["TerrainR"] = tiledFocalRange(inputs["dem"], mask, fields["TerrainR"], tile_size)
+
+    print("Computing combined cost tile by tile...")
+    out = createMemmap(out_path, shape)
+    for tile in iterTiles(shape[0], shape[1], tile_size):
+        core = (slice(tile.row0, tile.row1), slice(tile.col0, tile.col1))
+        inside = np.asarray(mask[core], dtype=bool)
+        factors = {"Landcover": cost_engine.reclassify(np.asarray(inputs["landcover"][core]), remap)}
+        for name, field in fields.items():
+            s = stats[name]
+            factors[name] = cost_engine.rescaleByFunction(
+                np.asarray(field[core]), *rescale[name],
+                lower=s["min"], upper=s["max"], midpoint=s["sum"] / max(s["count"], 1))
+
+        total = np.zeros(inside.shape, dtype=np.float32)
+        for name, factor in factors.items():
+            total += np.float32(weights[name]) * factor
+            if stack is not None:
+                stack.bands[(stack.names.index(name),) + core] = np.where(inside, factor, np.nan)
+        total[~inside] = np.nan
+        out[core] = total
+    out.flush()
+    return out
+
+
+#-------------------------------------------------------------------------------
+# arcpy input/output
+#-------------------------------------------------------------------------------
+
+# Function to get the grid of one tile (for reading and writing rasters)
+def tileGrid(grid, tile):
+    return cost_engine.Grid(grid.x_min + tile.col0 * grid.cell,
+                            grid.y_min + (grid.rows - tile.row1) * grid.cell,
+                            grid.cell, tile.row1 - tile.row0, tile.col1 - tile.col0,
+                            grid.spatial_reference)
+
+
+# Function to read a raster into a memmap tile by tile
+def rasterToMemmap(in_raster, grid, path, tile_size):
+    out = createMemmap(path, (grid.rows, grid.cols))
+    for tile in iterTiles(grid.rows, grid.cols, tile_size):
+        out[tile.row0:tile.row1, tile.col0:tile.col1] = cost_engine.readRaster(in_raster, tileGrid(grid, tile))
+    out.flush()
+    return out
+
+
+# Function to save a memmap as a raster by mosaicking one raster per tile
+def memmapToRaster(array, grid, out_raster, tile_size, work_gdb):
+    import arcpy
+
+    tiles = []
+    for n, tile in enumerate(iterTiles(grid.rows, grid.cols, tile_size)):
+        core = np.asarray(array[tile.row0:tile.row1, tile.col0:tile.col1])
+        tiles.append(cost_engine.writeRaster(core, tileGrid(grid, tile), os.path.join(work_gdb, f"tile_{n}")))
+
+    out_path, out_name = os.path.split(out_raster)
+    arcpy.management.MosaicToNewRaster(tiles, out_path, out_name, pixel_type="32_BIT_FLOAT",
+                                       cellsize=grid.cell, number_of_bands=1)
+    for path in tiles:
+        arcpy.management.Delete(path)
+    return out_raster
+
+
+# Function to rasterize features to a memmap (1 where there's a feature)
+# The full raster is written to the work gdb and read back one tile at a time
+def featuresToMemmap(in_features, value_field, grid, path, tile_size, work_gdb):
+    import arcpy
+
+    if isinstance(in_features, str):
+        in_features = [in_features]
+
+    out = createMemmap(path, (grid.rows, grid.cols))
+    for fc in in_features:
+        temp = os.path.join(work_gdb, f"{os.path.basename(fc)}_Ras")
+        arcpy.conversion.FeatureToRaster(fc, value_field, temp, grid.cell)
+        for tile in iterTiles(grid.rows, grid.cols, tile_size):
+            core = (slice(tile.row0, tile.row1), slice(tile.col0, tile.col1))
+            array = cost_engine.readRaster(temp, tileGrid(grid, tile))
+            out[core] = np.where(np.isnan(out[core]), array, out[core])
+        arcpy.management.Delete(temp)
+    out.flush()
+    return out
+
+
+# Function to run the tiled cost pipeline from the gdb and save Combined_Cost (and the
+# terrain ruggedness as terrain_name, like cost_engine.combinedCostFromGDB)
+# work_dir is a folder for the memmaps (and a work gdb for temporary rasters)
+# stack_path also saves the factors as a factor stack (see factor_stack.py)
+# Returns the path of the saved Combined_Cost raster
+def combinedCostTiledFromGDB(workspace, study_area, work_dir, tile_size=2048, max_distance=5000,
+                             dem_name="ab_dem", out_name="Combined_Cost", terrain_name="TerrainR",
+                             remap=cost_engine.LANDCOVER_REMAP, weights=cost_engine.WEIGHTS,
+                             rescale=cost_engine.RESCALE, stack_path=None):
+    import arcpy
+
+    os.makedirs(work_dir, exist_ok=True)
+    work_gdb = os.path.join(work_dir, "Tiles.gdb")
+    if not arcpy.Exists(work_gdb):
+        arcpy.management.CreateFileGDB(work_dir, "Tiles.gdb")
+
+    dem_path = os.path.join(workspace, dem_name)
+    grid = cost_engine.gridFromRaster(dem_path)
+    print(f"Splitting {grid.rows} x {grid.cols} cells into tiles of {tile_size} x {tile_size}...")
+
+    def memmapPath(name):
+        return os.path.join(work_dir, f"{name}.npy")
+
+    with arcpy.EnvManager(workspace=workspace, extent=dem_path, snapRaster=dem_path,
+                          cellSize=grid.cell, outputCoordinateSystem=dem_path):
+        print("Reading rasters into memory-mapped arrays...")
+        inputs = {
+            "dem": rasterToMemmap(dem_path, grid, memmapPath("dem"), tile_size),
+            "landcover": featuresToMemmap("AB_Landcover", "LC_class", grid, memmapPath("landcover"), tile_size, work_gdb),
+        }
+        features = {"mask": study_area, "hydro": "Hydro", "trails": "Trails", "road": ["Road", "Transportation"]}
+        for name, fc in features.items():
+            array = featuresToMemmap(fc, "OBJECTID", grid, memmapPath(f"{name}_Ras"), tile_size, work_gdb)
+            flags = np.lib.format.open_memmap(memmapPath(name), mode="w+", dtype=bool, shape=array.shape)
+            for tile in iterTiles(grid.rows, grid.cols, tile_size):
+                core = (slice(tile.row0, tile.row1), slice(tile.col0, tile.col1))
+                flags[core] = ~np.isnan(array[core])
+            inputs[name] = flags
+
+        stack = None
+        if stack_path:
+            import factor_stack
+
+            stack = factor_stack.createStack(stack_path, cost_engine.FACTORS, grid, inputs["mask"], tile_size)
+
+        cost = tiledCombinedCost(inputs, grid.cell, work_dir, memmapPath("Combined_Cost"), tile_size, max_distance,
+                                 remap, weights, rescale, stack)
+        if stack is not None:
+            factor_stack.finishStack(stack)
+
+        print("Mosaicking tiles...")
+        if terrain_name:
+            # the ruggedness field of pass 1 (already masked to the study area)
+            terrain = np.load(memmapPath("TerrainR"), mmap_mode="r")
+            memmapToRaster(terrain, grid, os.path.join(workspace, terrain_name), tile_size, work_gdb)
+        return memmapToRaster(cost, grid, os.path.join(workspace, out_name), tile_size, work_gdb)
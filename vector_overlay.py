@@ -0,0 +1,448 @@
+#-------------------------------------------------------------------------------
+# Name:        Vector Overlay
+# Purpose:     Faster clip of the vector sources to the study area. The boundary
+#              edges go into an STR tree and the boundary extent is split into
+#              tiles that are inside, outside or on the boundary. Each feature is
+#              rejected or kept whole from its bounding box and the tiles, the
+#              rest are tested segment by segment against the edges the tree
+#              returns, and only the features that cross the boundary are clipped.
+#              The features are classified in chunks that can run on several cores.
+#-------------------------------------------------------------------------------
+
+import json
+import os
+from collections import namedtuple
+
+import numpy as np
+
+import focal_engine
+import task_runner
+import tiling
+
+
+# Features as flat arrays
+# kind is "polygon" or "line", points is an (n x 2) array of coordinates
+# parts is the first point of each part (and the end), offsets the first part of each
+# feature (and the end), so feature f has parts offsets[f]:offsets[f + 1]
+Features = namedtuple("Features", ["kind", "points", "parts", "offsets"])
+
+# STR tree of boxes (x_min, y_min, x_max, y_max)
+# boxes are the item boxes in tree order, order is the original index of each one
+# levels are the node boxes of each level (leaves' parents first), capacity the children per node
+Index = namedtuple("Index", ["boxes", "order", "levels", "capacity"])
+
+# Boundary ready for the overlay
+# edges is an (n x 4) array of x0, y0, x1, y1, index the STR tree of the edges
+# tiles is the class of each tile (INSIDE, OUTSIDE or CROSSING), origin the top left
+# corner of the tiles (x_min, y_max), size the tile size
+# corners is the first point of each part of the boundary and part_boxes their boxes
+Boundary = namedtuple("Boundary", ["edges", "index", "tiles", "origin", "size", "corners", "part_boxes"])
+
+# Classes of a feature
+OUTSIDE = 0
+INSIDE = 1
+CROSSING = 2
+
+# Tiles along the longest side of the boundary extent
+TILES = 64
+
+
+#-------------------------------------------------------------------------------
+# Features
+#-------------------------------------------------------------------------------
+
+# Function to turn Esri JSON geometries into Features
+# geometries is a list of dictionaries with "rings" (polygons) or "paths" (lines), points
+# and multipoints are not supported (ingestVectorIndexed clips them with ingest.ingestVector)
+def featuresFromJSON(geometries):
+    kind = None
+    points, parts, offsets = [], [0], [0]
+    for geometry in geometries:
+        if geometry:
+            if "x" in geometry or "points" in geometry:
+                raise ValueError("Point geometries are not supported by the indexed overlay")
+            kind = kind or ("polygon" if "rings" in geometry else "line")
+            for part in geometry.get("rings") or geometry.get("paths") or []:
+                xy = np.asarray(part, dtype=np.float64)[:, :2]
+                points.append(xy)
+                parts.append(parts[-1] + len(xy))
+        offsets.append(len(parts) - 1)
+
+    points = np.concatenate(points) if points else np.empty((0, 2))
+    return Features(kind or "polygon", points, np.asarray(parts, dtype=np.int64), np.asarray(offsets, dtype=np.int64))
+
+
+# Function to get the segments of Features
+# Returns (segments as an (n x 4) array of x0, y0, x1, y1, feature of each segment)
+def featureSegments(features):
+    count = len(features.points)
+    starts = np.ones(count, dtype=bool)
+    starts[features.parts[1:] - 1] = False # the last point of a part starts no segment
+    first = np.flatnonzero(starts)
+    part = np.repeat(np.arange(len(features.parts) - 1), np.diff(features.parts))
+    feature = np.repeat(np.arange(len(features.offsets) - 1), np.diff(features.offsets))
+    segments = np.hstack([features.points[first], features.points[first + 1]])
+    return segments, feature[part[first]]
+
+
+# Function to get the bounding box of each feature (NaN for empty features)
+def featureBoxes(features):
+    starts = features.parts[features.offsets[:-1]]
+    counts = features.parts[features.offsets[1:]] - starts
+    boxes = np.full((len(starts), 4), np.nan)
+    has_points = counts > 0
+    if has_points.any():
+        at = starts[has_points]
+        # empty features have no points, so each reduction runs to the next feature with points
+        boxes[has_points, :2] = np.minimum.reduceat(features.points, at, axis=0)
+        boxes[has_points, 2:] = np.maximum.reduceat(features.points, at, axis=0)
+    return boxes
+
+
+# Function to get the features start:stop of Features (the arrays are sliced, not copied)
+def featureRange(features, start, stop):
+    parts = features.parts[features.offsets[start]:features.offsets[stop] + 1]
+    points = features.points[parts[0]:parts[-1]]
+    return Features(features.kind, points, parts - parts[0], features.offsets[start:stop + 1] - features.offsets[start])
+
+
+# Function to save Features to a folder so worker processes can map them
+def saveFeatures(features, folder):
+    os.makedirs(folder, exist_ok=True)
+    for name in ("points", "parts", "offsets"):
+        np.save(os.path.join(folder, f"{name}.npy"), getattr(features, name))
+    with open(os.path.join(folder, "features.json"), "w") as f:
+        json.dump({"kind": features.kind}, f)
+    return folder
+
+
+# Function to open Features saved by saveFeatures
+def loadFeatures(folder):
+    with open(os.path.join(folder, "features.json")) as f:
+        kind = json.load(f)["kind"]
+    return Features(kind, *[tiling.openMemmap(os.path.join(folder, f"{name}.npy"))
+                            for name in ("points", "parts", "offsets")])
+
+
+#-------------------------------------------------------------------------------
+# STR tree
+#-------------------------------------------------------------------------------
+
+# Function to check which pairs of boxes overlap (touching boxes overlap)
+def boxesOverlap(a, b):
+    return (a[:, 0] <= b[:, 2]) & (a[:, 2] >= b[:, 0]) & (a[:, 1] <= b[:, 3]) & (a[:, 3] >= b[:, 1])
+
+
+# Function to bulk load an STR tree (Sort-Tile-Recursive) from boxes
+# The boxes are sorted into vertical slices by x and each slice by y, so the leaves
+# hold capacity boxes that are near each other
+def buildIndex(boxes, capacity=16):
+    boxes = np.asarray(boxes, dtype=np.float64).reshape(-1, 4)
+    count = len(boxes)
+    leaves = -(-count // capacity)
+    slices = max(int(np.ceil(np.sqrt(leaves))), 1)
+    slice_size = capacity * -(-leaves // slices)
+
+    slice_of = np.empty(count, dtype=np.int64)
+    slice_of[np.argsort(boxes[:, 0] + boxes[:, 2], kind="stable")] = np.arange(count) // slice_size
+    order = np.lexsort((boxes[:, 1] + boxes[:, 3], slice_of))
+
+    levels = []
+    current = boxes[order]
+    while len(current) > capacity:
+        starts = np.arange(0, len(current), capacity)
+        current = np.hstack([np.minimum.reduceat(current[:, :2], starts, axis=0),
+                             np.maximum.reduceat(current[:, 2:], starts, axis=0)])
+        levels.append(current)
+    return Index(boxes[order], order, levels, capacity)
+
+
+# Function to find the items of an STR tree whose boxes overlap each query box
+# Returns (query, item) arrays, one pair per overlap (item is the original index)
+def queryIndex(index, boxes):
+    boxes = np.asarray(boxes, dtype=np.float64).reshape(-1, 4)
+    levels = index.levels[::-1] + [index.boxes]
+    top = len(levels[0])
+    query = np.repeat(np.arange(len(boxes)), top)
+    node = np.tile(np.arange(top), len(boxes))
+    keep = boxesOverlap(boxes[query], levels[0][node])
+    query, node = query[keep], node[keep]
+
+    for level in levels[1:]:
+        children = (node[:, None] * index.capacity + np.arange(index.capacity)).ravel()
+        query = np.repeat(query, index.capacity)
+        valid = children < len(level)
+        query, children = query[valid], children[valid]
+        keep = boxesOverlap(boxes[query], level[children])
+        query, node = query[keep], children[keep]
+    return query, index.order[node]
+
+
+#-------------------------------------------------------------------------------
+# Boundary
+#-------------------------------------------------------------------------------
+
+# Function to check which pairs of segments intersect (touching counts), for pairs
+# whose boxes are known to overlap (which makes the collinear case exact)
+def segmentsIntersect(a, b):
+    def orient(px, py, qx, qy, rx, ry):
+        return (qx - px) * (ry - py) - (qy - py) * (rx - px)
+
+    d1 = orient(b[:, 0], b[:, 1], b[:, 2], b[:, 3], a[:, 0], a[:, 1])
+    d2 = orient(b[:, 0], b[:, 1], b[:, 2], b[:, 3], a[:, 2], a[:, 3])
+    d3 = orient(a[:, 0], a[:, 1], a[:, 2], a[:, 3], b[:, 0], b[:, 1])
+    d4 = orient(a[:, 0], a[:, 1], a[:, 2], a[:, 3], b[:, 2], b[:, 3])
+    return (d1 * d2 <= 0) & (d3 * d4 <= 0)
+
+
+# Function to get the boxes of segments
+def segmentBoxes(segments):
+    return np.column_stack([np.minimum(segments[:, 0], segments[:, 2]), np.minimum(segments[:, 1], segments[:, 3]),
+                            np.maximum(segments[:, 0], segments[:, 2]), np.maximum(segments[:, 1], segments[:, 3])])
+
+
+# Function to check which points are inside a boundary (even-odd rule)
+# A ray goes right from each point, only the edges the tree finds on it are tested
+def pointsInside(boundary, points):
+    points = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+    x_max = boundary.index.boxes[:, 2].max() if len(boundary.edges) else 0
+    rays = np.column_stack([points, np.maximum(points[:, 0], x_max), points[:, 1]])
+    point, edge = queryIndex(boundary.index, rays)
+
+    x0, y0, x1, y1 = boundary.edges[edge].T
+    py = points[point, 1]
+    straddle = (y0 > py) != (y1 > py)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        x = x0 + (py - y0) * (x1 - x0) / (y1 - y0)
+    crossings = np.bincount(point[straddle & (points[point, 0] < x)], minlength=len(points))
+    return crossings % 2 == 1
+
+
+# Function to get the tiles of a box (clipped to the tiles)
+# Returns (row0, row1, col0, col1) arrays, the last row and column included
+def tileRanges(boundary, boxes):
+    rows, cols = boundary.tiles.shape
+    x_min, y_max = boundary.origin
+    col0 = np.clip(np.floor((boxes[:, 0] - x_min) / boundary.size), 0, cols - 1).astype(np.int64)
+    col1 = np.clip(np.floor((boxes[:, 2] - x_min) / boundary.size), 0, cols - 1).astype(np.int64)
+    row0 = np.clip(np.floor((y_max - boxes[:, 3]) / boundary.size), 0, rows - 1).astype(np.int64)
+    row1 = np.clip(np.floor((y_max - boxes[:, 1]) / boundary.size), 0, rows - 1).astype(np.int64)
+    return row0, row1, col0, col1
+
+
+# Function to prepare a boundary from its polygon Features
+# tiles is the number of tiles along the longest side of the boundary extent
+def boundaryIndex(features, tiles=TILES):
+    edges, _ = featureSegments(features)
+    starts = features.parts[:-1]
+    part_boxes = np.hstack([np.minimum.reduceat(features.points, starts), np.maximum.reduceat(features.points, starts)])
+    boundary = Boundary(edges, buildIndex(segmentBoxes(edges)), None, None, None, features.points[starts], part_boxes)
+
+    x_min, y_min = features.points.min(axis=0)
+    x_max, y_max = features.points.max(axis=0)
+    size = max(x_max - x_min, y_max - y_min) / tiles or 1.0
+    shape = (max(int(np.ceil((y_max - y_min) / size)), 1), max(int(np.ceil((x_max - x_min) / size)), 1))
+    boundary = boundary._replace(tiles=np.zeros(shape, dtype=np.int8), origin=(x_min, y_max), size=size)
+
+    # tiles an edge touches are on the boundary, the others are inside or outside as a whole
+    # (the edges are cut into pieces no longer than a tile, so each piece touches 2 x 2 tiles at most)
+    pieces = np.ceil(np.abs(edges[:, 2:] - edges[:, :2]).max(axis=1) / size).astype(np.int64) + 1
+    edge = np.repeat(np.arange(len(edges)), pieces)
+    t0 = (np.arange(pieces.sum()) - np.repeat(np.cumsum(pieces) - pieces, pieces)) / pieces[edge]
+    t1 = t0 + 1 / pieces[edge]
+    start, end = edges[edge, :2], edges[edge, 2:]
+    cut = np.hstack([start + (end - start) * t0[:, None], start + (end - start) * t1[:, None]])
+    row0, row1, col0, col1 = tileRanges(boundary, segmentBoxes(cut))
+    crossing = np.zeros(shape, dtype=bool)
+    for r in range(2):
+        for c in range(2):
+            keep = (row0 + r <= row1) & (col0 + c <= col1)
+            crossing[row0[keep] + r, col0[keep] + c] = True
+
+    centres_y, centres_x = np.mgrid[0:shape[0], 0:shape[1]]
+    centres = np.column_stack([x_min + (centres_x.ravel() + 0.5) * size, y_max - (centres_y.ravel() + 0.5) * size])
+    classes = np.where(pointsInside(boundary, centres), INSIDE, OUTSIDE).reshape(shape)
+    classes[crossing] = CROSSING
+    return boundary._replace(tiles=classes.astype(np.int8))
+
+
+#-------------------------------------------------------------------------------
+# Overlay
+#-------------------------------------------------------------------------------
+
+# Function to classify features against a boundary
+# 1. a box outside the boundary extent or only on outside tiles is OUTSIDE
+# 2. a box only on inside tiles is INSIDE (kept whole, no exact test)
+# 3. the other features are CROSSING when one of their segments meets an edge the tree
+#    returns for it, INSIDE or OUTSIDE from one of their points otherwise (a polygon
+#    around a part of the boundary is CROSSING)
+# Returns an int8 array of classes
+def classifyFeatures(features, boundary):
+    boxes = featureBoxes(features)
+    classes = np.full(len(boxes), OUTSIDE, dtype=np.int8)
+    rows, cols = boundary.tiles.shape
+    x_min, y_max = boundary.origin
+    extent = (x_min, y_max - rows * boundary.size, x_min + cols * boundary.size, y_max)
+
+    valid = ~np.isnan(boxes[:, 0])
+    valid[valid] = boxesOverlap(boxes[valid], np.array([extent]))
+    todo = np.flatnonzero(valid)
+    if todo.size == 0:
+        return classes
+
+    # summed tiles: a box is inside when it's on no other tile, outside when on no other tile
+    row0, row1, col0, col1 = tileRanges(boundary, boxes[todo])
+    not_inside = focal_engine.integralImage(boundary.tiles != INSIDE)
+    not_outside = focal_engine.integralImage(boundary.tiles != OUTSIDE)
+
+    def tileCount(integral):
+        return (integral[row1 + 1, col1 + 1] - integral[row0, col1 + 1] - integral[row1 + 1, col0] + integral[row0, col0])
+
+    within = boxesWithin(boxes[todo], extent)
+    inside = (tileCount(not_inside) == 0) & within
+    outside = tileCount(not_outside) == 0
+    classes[todo[inside]] = INSIDE
+    todo = todo[~inside & ~outside]
+    if todo.size == 0:
+        return classes
+
+    # exact tests on the features left (segments against the edges near them)
+    segments, feature = featureSegments(features)
+    near = np.isin(feature, todo)
+    segments, feature = segments[near], feature[near]
+    segment, edge = queryIndex(boundary.index, segmentBoxes(segments))
+    hits = segmentsIntersect(segments[segment], boundary.edges[edge])
+    crossing = np.zeros(len(boxes), dtype=bool)
+    crossing[feature[segment[hits]]] = True
+
+    first_points = features.points[features.parts[features.offsets[todo]]]
+    classes[todo] = np.where(crossing[todo], CROSSING,
+                             np.where(pointsInside(boundary, first_points), INSIDE, OUTSIDE))
+
+    # a polygon around a part of the boundary crosses no edge but covers the part
+    if features.kind == "polygon":
+        for f in todo[classes[todo] == OUTSIDE]:
+            feature = featureRange(features, f, f + 1)
+            corners = boundary.corners[boxesWithin(boundary.part_boxes, boxes[f])]
+            if any(pointInFeature(feature, corner) for corner in corners):
+                classes[f] = CROSSING
+    return classes
+
+
+# Function to check which boxes are within another box
+def boxesWithin(boxes, box):
+    return (boxes[:, 0] >= box[0]) & (boxes[:, 1] >= box[1]) & (boxes[:, 2] <= box[2]) & (boxes[:, 3] <= box[3])
+
+
+# Function to check whether a point is inside a polygon feature (even-odd rule)
+def pointInFeature(feature, point):
+    segments, _ = featureSegments(feature)
+    x0, y0, x1, y1 = segments.T
+    straddle = (y0 > point[1]) != (y1 > point[1])
+    with np.errstate(invalid="ignore", divide="ignore"):
+        x = x0 + (point[1] - y0) * (x1 - x0) / (y1 - y0)
+    return np.count_nonzero(straddle & (point[0] < x)) % 2 == 1
+
+
+# Function to classify a chunk of the features saved in work_dir (a task of overlay)
+# The boundary is rebuilt from its saved Features, which is quick next to the chunk
+def classifyTask(work_dir, start, stop, tiles=TILES):
+    boundary = boundaryIndex(loadFeatures(os.path.join(work_dir, "Boundary")), tiles)
+    features = loadFeatures(os.path.join(work_dir, "Features"))
+    return classifyFeatures(featureRange(features, start, stop), boundary)
+
+
+# Function to classify Features against boundary Features
+# workers > 1 classifies chunks of chunk_size features in worker processes, the
+# features are saved to work_dir for them
+# Returns an int8 array of classes (OUTSIDE, INSIDE, CROSSING)
+def overlay(features, boundary_features, work_dir=None, workers=1, chunk_size=50000, tiles=TILES):
+    count = len(features.offsets) - 1
+    if workers <= 1 or count <= chunk_size or work_dir is None:
+        boundary = boundaryIndex(boundary_features, tiles)
+        classes = np.empty(count, dtype=np.int8)
+        for start in range(0, count, chunk_size):
+            stop = min(start + chunk_size, count)
+            classes[start:stop] = classifyFeatures(featureRange(features, start, stop), boundary)
+        return classes
+
+    saveFeatures(boundary_features, os.path.join(work_dir, "Boundary"))
+    saveFeatures(features, os.path.join(work_dir, "Features"))
+    tasks = [task_runner.task(f"Features {start}-{min(start + chunk_size, count)}", classifyTask, work_dir,
+                              start, min(start + chunk_size, count), tiles)
+             for start in range(0, count, chunk_size)]
+    results = task_runner.runTasks(tasks, workers)
+    return np.concatenate([results[t.name] for t in tasks])
+
+
+#-------------------------------------------------------------------------------
+# arcpy input/output
+#-------------------------------------------------------------------------------
+
+# Function to read the object ids and geometries of a feature class as Features
+# spatial_reference projects the geometries while they are read (None keeps them)
+# Returns (object ids, Features)
+def readFeatures(in_features, spatial_reference=None):
+    import arcpy
+
+    ids, geometries = [], []
+    with arcpy.da.SearchCursor(in_features, ["OID@", "SHAPE@JSON"], spatial_reference=spatial_reference) as cursor:
+        for oid, shape in cursor:
+            ids.append(oid)
+            geometries.append(json.loads(shape) if shape else None)
+    return np.asarray(ids, dtype=np.int64), featuresFromJSON(geometries)
+
+
+# Function to build a where clause that selects object ids (as ranges of ids)
+def oidWhere(field, ids):
+    ids = np.unique(ids)
+    breaks = np.flatnonzero(np.diff(ids) != 1) + 1
+    terms = []
+    for run in np.split(ids, breaks):
+        if len(run) == 1:
+            terms.append(f"{field} = {run[0]}")
+        else:
+            terms.append(f"({field} >= {run[0]} AND {field} <= {run[-1]})")
+    return " OR ".join(terms)
+
+
+# Function to clip a vector dataset to the study area with the overlay
+# (like ingest.ingestVector, but only the features that cross the boundary are clipped,
+# the features inside are copied as they are and the ones outside never leave the source)
+# dataset is an ingest.Dataset, work_dir holds the features for the worker processes
+# Returns out_fc
+def ingestVectorIndexed(dataset, study_area_path, out_fc, out_cs, work_dir=None, workers=1, chunk_size=50000):
+    import arcpy
+    import ingest
+
+    ingest.checkKnownCS(dataset)
+
+    # points have no segments to test, the arcpy clip handles them
+    if arcpy.Describe(dataset.path).shapeType in ("Point", "Multipoint"):
+        return ingest.ingestVector(dataset, study_area_path, out_fc, out_cs)
+
+    # the boundary in the coordinate system of the source, so nothing else is projected first
+    _, boundary = readFeatures(study_area_path, dataset.spatial_reference)
+    ids, features = readFeatures(dataset.path)
+    classes = overlay(features, boundary, work_dir, workers, chunk_size)
+    inside, crossing = ids[classes == INSIDE], ids[classes == CROSSING]
+    print(f"{len(inside)} features inside, {len(crossing)} crossing the boundary, "
+          f"{len(ids) - len(inside) - len(crossing)} outside")
+
+    oid_field = arcpy.AddFieldDelimiters(dataset.path, arcpy.Describe(dataset.path).OIDFieldName)
+    with arcpy.EnvManager(outputCoordinateSystem=out_cs):
+        arcpy.management.CreateFeatureclass(os.path.dirname(out_fc), os.path.basename(out_fc),
+                                            template=dataset.path, spatial_reference=out_cs)
+        if len(inside):
+            print("Copying the features inside the boundary...")
+            layer = arcpy.management.MakeFeatureLayer(dataset.path, f"{dataset.name}_inside", oidWhere(oid_field, inside))[0]
+            arcpy.management.Append(layer, out_fc, "NO_TEST")
+            arcpy.management.Delete(layer)
+        if len(crossing):
+            print("Clipping the features crossing the boundary...")
+            layer = arcpy.management.MakeFeatureLayer(dataset.path, f"{dataset.name}_crossing", oidWhere(oid_field, crossing))[0]
+            clipped = os.path.join("memory", f"{dataset.name}_clipped")
+            arcpy.analysis.Clip(in_features=layer, clip_features=study_area_path, out_feature_class=clipped)
+            arcpy.management.Append(clipped, out_fc, "NO_TEST")
+            arcpy.management.Delete([layer, clipped])
+    return out_fc
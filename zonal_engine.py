@@ -0,0 +1,290 @@
+#-------------------------------------------------------------------------------
+# Name:        Zonal Engine
+# Purpose:     Many zonal statistics for many zones in one pass. Zones are kept as
+#              (cell, zone) member pairs so they can overlap (e.g. buffers around
+#              route segments). For each value raster the member values are
+#              sorted once by zone and value, which gives the count, mean, min,
+#              max, std and percentiles of every zone together. Landcover class
+#              histograms come from one bincount over (zone, class).
+#-------------------------------------------------------------------------------
+
+import csv
+import math
+import os
+from collections import namedtuple
+
+import numpy as np
+
+import cost_engine
+
+
+# Members of a set of zones
+# cells are flat cell indices, zones are the zone index of each cell (0 to len(names) - 1)
+# names is the name of each zone
+Members = namedtuple("Members", ["cells", "zones", "names"])
+
+
+#-------------------------------------------------------------------------------
+# Zones
+#-------------------------------------------------------------------------------
+
+# Function to get the members of the zones of a label array (0 = no zone)
+# names is a dictionary of {label: zone name} (the label is the name by default)
+def labelMembers(labels, names=None):
+    flat = np.asarray(labels).ravel()
+    cells = np.flatnonzero(flat > 0)
+    ids, zones = np.unique(flat[cells].astype(np.int64), return_inverse=True)
+    names = names or {}
+    return Members(cells, zones, [names.get(int(i), int(i)) for i in ids])
+
+
+# Function to split a path of flat cell indices into segments of about segment_length meters
+# Returns a list of arrays of flat cell indices
+def splitPath(cells, cols, cell, segment_length):
+    cells = np.asarray(cells, dtype=np.int64)
+    if len(cells) < 2 or not segment_length:
+        return [cells]
+    rows, columns = np.divmod(cells, cols)
+    step = np.hypot(np.diff(rows), np.diff(columns)) * cell
+    along = np.concatenate([[0.0], np.cumsum(step)])
+    segment = np.minimum((along // segment_length).astype(np.int64), int(along[-1] // segment_length))
+    bounds = np.flatnonzero(np.diff(segment)) + 1
+    return np.split(cells, bounds)
+
+
+# Function to get the cell offsets within radius cells of a cell (a disc)
+def discOffsets(radius):
+    r = int(math.ceil(radius))
+    dr, dc = np.mgrid[-r:r + 1, -r:r + 1]
+    inside = dr * dr + dc * dc <= radius * radius
+    return dr[inside], dc[inside]
+
+
+# Function to get the members of a buffer around each path (the buffers can overlap)
+# paths is a list of arrays of flat cell indices, shape is the grid shape
+# radius is the buffer distance in cells, names is the name of each path
+def bufferMembers(paths, shape, radius, names=None):
+    rows, cols = shape
+    dr, dc = discOffsets(radius)
+    cells = []
+    zones = []
+    for n, path in enumerate(paths):
+        r, c = np.divmod(np.asarray(path, dtype=np.int64), cols)
+        rr = (r[:, None] + dr[None, :]).ravel()
+        cc = (c[:, None] + dc[None, :]).ravel()
+        inside = (rr >= 0) & (rr < rows) & (cc >= 0) & (cc < cols)
+        buffer = np.unique(rr[inside] * cols + cc[inside])
+        cells.append(buffer)
+        zones.append(np.full(len(buffer), n, dtype=np.int64))
+
+    if not cells:
+        return Members(np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64), [])
+    return Members(np.concatenate(cells), np.concatenate(zones), list(names or range(1, len(paths) + 1)))
+
+
+#-------------------------------------------------------------------------------
+# Statistics
+#-------------------------------------------------------------------------------
+
+# Function to compute the statistics of one value array for every zone
+# members are the zone members, values is the value array (NaN = NoData)
+# percentiles is a list of percentiles (0-100), computed with linear interpolation
+# Returns a dictionary of {statistic: array with one value per zone}
+def zoneValueStatistics(members, values, percentiles=(10, 50, 90)):
+    count = len(members.names)
+    v = np.asarray(values, dtype=np.float64).ravel()[members.cells]
+    valid = ~np.isnan(v)
+    v = v[valid]
+    zones = members.zones[valid]
+
+    # sort once by zone and value, each zone is then a run of sorted values
+    order = np.lexsort((v, zones))
+    v = v[order]
+    zones = zones[order]
+
+    n = np.bincount(zones, minlength=count)
+    has = n > 0
+    starts = np.concatenate([[0], np.cumsum(n)[:-1]])
+    ends = starts + n - 1
+
+    stats = {"count": n}
+    with np.errstate(invalid="ignore", divide="ignore"):
+        mean = np.bincount(zones, weights=v, minlength=count) / n
+        deviation = v - mean[zones]
+        stats["mean"] = mean
+        stats["std"] = np.sqrt(np.bincount(zones, weights=deviation * deviation, minlength=count) / n)
+
+    stats["min"] = np.where(has, v[np.minimum(starts, len(v) - 1)] if len(v) else np.nan, np.nan)
+    stats["max"] = np.where(has, v[np.maximum(ends, 0)] if len(v) else np.nan, np.nan)
+
+    for q in percentiles:
+        position = starts + q / 100 * np.maximum(n - 1, 0)
+        lo = np.floor(position).astype(np.int64)
+        hi = np.minimum(lo + 1, ends)
+        if len(v):
+            lo = np.minimum(lo, len(v) - 1)
+            hi = np.maximum(np.minimum(hi, len(v) - 1), 0)
+            value = v[lo] + (v[hi] - v[lo]) * (position - lo)
+        else:
+            value = np.zeros(count)
+        stats[f"p{q:g}"] = np.where(has, value, np.nan)
+    return stats
+
+
+# Function to count the cells of each class in every zone
+# classes is an array of class codes (NaN = NoData)
+# Returns (class codes, array of counts (zones x classes))
+def zoneHistograms(members, classes):
+    c = np.asarray(classes, dtype=np.float64).ravel()[members.cells]
+    valid = ~np.isnan(c)
+    codes, index = np.unique(c[valid], return_inverse=True)
+    flat = members.zones[valid] * len(codes) + index
+    counts = np.bincount(flat, minlength=len(members.names) * len(codes))
+    return codes, counts.reshape(len(members.names), len(codes))
+
+
+# Function to compute the statistics of every value array and the class histograms
+# values is a dictionary of {value name: array}, classes is an array of class codes (or None)
+# Returns a dictionary: names (zone names), cells (cells per zone), values ({value name:
+# {statistic: array}}), classes (class codes) and histogram (zones x classes counts)
+def zonalStatistics(members, values, classes=None, percentiles=(10, 50, 90)):
+    result = {
+        "names": members.names,
+        "cells": np.bincount(members.zones, minlength=len(members.names)),
+        "values": {name: zoneValueStatistics(members, array, percentiles) for name, array in values.items()},
+        "classes": None,
+        "histogram": None,
+    }
+    if classes is not None:
+        result["classes"], result["histogram"] = zoneHistograms(members, classes)
+    return result
+
+
+# Function to write the statistics as a table (one row per zone)
+# and the class histograms as a second table (<name>_classes.csv, one row per zone and class)
+# cell is the cell size (for the areas), layer is written in the first column
+def writeZoneTable(result, out_csv, cell, layer=""):
+    value_names = list(result["values"])
+    statistics = list(next(iter(result["values"].values()))) if value_names else []
+
+    with open(out_csv, "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(["LAYER", "ZONE", "CELLS", "AREA"] +
+                        [f"{name}_{stat}".upper() for name in value_names for stat in statistics])
+        for n, zone in enumerate(result["names"]):
+            row = [layer, zone, int(result["cells"][n]), float(result["cells"][n]) * cell * cell]
+            for name in value_names:
+                for stat in statistics:
+                    value = result["values"][name][stat][n]
+                    row.append("" if np.isnan(value) else round(float(value), 4))
+            writer.writerow(row)
+
+    if result["histogram"] is not None:
+        classes_csv = os.path.splitext(out_csv)[0] + "_classes.csv"
+        with open(classes_csv, "w", newline="") as f:
+            writer = csv.writer(f)
+            writer.writerow(["LAYER", "ZONE", "CLASS", "CELLS", "AREA"])
+            for n, zone in enumerate(result["names"]):
+                for code, cells in zip(result["classes"], result["histogram"][n]):
+                    if cells:
+                        writer.writerow([layer, zone, int(code), int(cells), float(cells) * cell * cell])
+    return out_csv
+
+
+#-------------------------------------------------------------------------------
+# arcpy input/output
+#-------------------------------------------------------------------------------
+
+# Function to get the flat cell indices along a polyline (in order, without repeats)
+# parts is a list of (n x 2) arrays of vertex coordinates, grid is the cost_engine.Grid
+def lineCells(parts, grid):
+    paths = []
+    for xy in parts:
+        if len(xy) < 2:
+            continue
+        # sample the line every half cell
+        length = np.hypot(*np.diff(xy, axis=0).T)
+        samples = np.maximum(np.ceil(length / (grid.cell / 2)).astype(np.int64), 1)
+        seg = np.repeat(np.arange(len(length)), samples)
+        t = (np.arange(samples.sum()) - np.repeat(np.cumsum(samples) - samples, samples)) / np.repeat(samples, samples)
+        points = np.vstack([xy[:-1][seg] + (xy[1:][seg] - xy[:-1][seg]) * t[:, None], xy[-1:]])
+
+        cols = np.floor((points[:, 0] - grid.x_min) / grid.cell).astype(np.int64)
+        rows = grid.rows - 1 - np.floor((points[:, 1] - grid.y_min) / grid.cell).astype(np.int64)
+        inside = (rows >= 0) & (rows < grid.rows) & (cols >= 0) & (cols < grid.cols)
+        flat = rows[inside] * grid.cols + cols[inside]
+        if len(flat):
+            paths.append(flat[np.concatenate([[True], np.diff(flat) != 0])])
+    return np.concatenate(paths) if paths else np.zeros(0, dtype=np.int64)
+
+
+# Function to get the zone members of a polygon feature class (one zone per polygon)
+# name_field names the zones (OBJECTID by default)
+def polygonMembersFromGDB(in_features, grid, name_field="OBJECTID"):
+    import arcpy
+
+    labels = np.nan_to_num(cost_engine.featuresToArray(in_features, "OBJECTID", grid), nan=0)
+    names = {}
+    with arcpy.da.SearchCursor(in_features, ["OID@", name_field]) as scursor:
+        for oid, name in scursor:
+            names[oid] = name
+    return labelMembers(labels, names)
+
+
+# Function to get the zone members of buffers around the segments of a polyline feature class
+# buffer is the buffer distance in meters, segment_length splits each line into
+# segments of that length (None = one zone per line)
+# name_fields are joined with the segment number to name the zones (e.g. REGION1-REGION2-3)
+def segmentMembersFromGDB(in_features, grid, buffer, segment_length=None, name_fields=("OID@",)):
+    import arcpy
+
+    paths = []
+    names = []
+    with arcpy.da.SearchCursor(in_features, ["SHAPE@"] + list(name_fields)) as scursor:
+        for row in scursor:
+            parts = [np.array([(p.X, p.Y) for p in part if p]) for part in row[0]]
+            cells = lineCells(parts, grid)
+            label = "-".join(str(value) for value in row[1:])
+            for n, segment in enumerate(splitPath(cells, grid.cols, grid.cell, segment_length)):
+                paths.append(segment)
+                names.append(f"{label}-{n + 1}" if segment_length else label)
+    return bufferMembers(paths, (grid.rows, grid.cols), buffer / grid.cell, names)
+
+
+# Function to run the zonal statistics of several zone layers from the gdb
+# zone_layers is a dictionary of {feature class: name field (or list of fields for
+# polylines, e.g. ["REGION1", "REGION2"])}, polyline layers get a
+# buffer of route_buffer meters around each segment of segment_length meters
+# value_rasters are the rasters to summarize (the first one sets the grid)
+# class_features, class_field give the landcover classes of the histograms (None = no histograms)
+# out_folder gets one table per zone layer (<layer>_zonal.csv and <layer>_zonal_classes.csv)
+# Returns the list of tables
+def zonalStatisticsFromGDB(workspace, zone_layers, value_rasters, out_folder, class_features="AB_Landcover",
+                           class_field="LC_class", percentiles=(10, 50, 90), route_buffer=100, segment_length=1000):
+    import arcpy
+
+    os.makedirs(out_folder, exist_ok=True)
+    grid_path = os.path.join(workspace, value_rasters[0])
+    grid = cost_engine.gridFromRaster(grid_path)
+
+    with arcpy.EnvManager(workspace=workspace, extent=grid_path, snapRaster=grid_path,
+                          cellSize=grid.cell, outputCoordinateSystem=grid_path):
+        print("Reading value rasters...")
+        values = {name: cost_engine.readRaster(os.path.join(workspace, name), grid) for name in value_rasters}
+        classes = None
+        if class_features:
+            classes = cost_engine.featuresToArray(class_features, class_field, grid)
+
+        tables = []
+        for layer, name_field in zone_layers.items():
+            print(f"Zonal statistics of {layer}...")
+            if arcpy.Describe(layer).shapeType == "Polyline":
+                fields = [name_field] if isinstance(name_field, str) else list(name_field or ["OID@"])
+                members = segmentMembersFromGDB(layer, grid, route_buffer, segment_length, fields)
+            else:
+                members = polygonMembersFromGDB(layer, grid, name_field or "OBJECTID")
+
+            result = zonalStatistics(members, values, classes, percentiles)
+            out_csv = os.path.join(out_folder, f"{layer}_zonal.csv")
+            tables.append(writeZoneTable(result, out_csv, grid.cell, layer))
+    return tables